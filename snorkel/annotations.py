@@ -3,6 +3,7 @@ from pandas import DataFrame, Series
 import scipy.sparse as sparse
 from sqlalchemy.sql import bindparam, select
 
+from .db_helpers import CandidateFetchPlan, span_index_scope
 from .features import get_span_feats
 from .models import GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate
 from .models.meta import new_sessionmaker
@@ -92,13 +93,15 @@ class csr_LabelMatrix(csr_AnnotationMatrix):
 
 class Annotator(UDFRunner):
     """Abstract class for annotating candidates and persisting these annotations to DB"""
-    def __init__(self, annotation_class, annotation_key_class, f):
+    def __init__(self, annotation_class, annotation_key_class, f, fetch_plan=None):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
+        self.fetch_plan           = fetch_plan if fetch_plan is not None else CandidateFetchPlan()
         super(Annotator, self).__init__(AnnotatorUDF,
                                         annotation_class=annotation_class,
                                         annotation_key_class=annotation_key_class,
-                                        f=f)
+                                        f=f,
+                                        fetch_plan=self.fetch_plan)
 
     def apply(self, split, key_group=0, replace_key_set=True, **kwargs):
 
@@ -114,7 +117,8 @@ class Annotator(UDFRunner):
         # Note: In the current UDFRunner implementation, we load all these into memory and fill a
         # multiprocessing JoinableQueue with them before starting... so might as well load them here and pass in.
         # Also, if we try to pass in a query iterator instead, with AUTOCOMMIT on, we get a TXN error...
-        cids       = cids_query.all()
+        # The cids are passed to the UDFs in batches, each of which is loaded with the fetch plan
+        cids       = list(self.fetch_plan.batches(cid for cid, in cids_query.all()))
         cids_count = len(cids)
         
         # Run the Annotator
@@ -152,32 +156,44 @@ class Annotator(UDFRunner):
 
 
 class AnnotatorUDF(UDF):
-    def __init__(self, annotation_class, annotation_key_class, f, **kwargs):
+    def __init__(self, annotation_class, annotation_key_class, f, fetch_plan=None, **kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
         self.anno_generator       = _to_annotation_generator(f) if hasattr(f, '__iter__') else f
+        self.batch_fns            = [g for g in f if hasattr(g, 'prepare')] if hasattr(f, '__iter__') else []
+        self.fetch_plan           = fetch_plan if fetch_plan is not None else CandidateFetchPlan()
 
         # For caching key ids during the reduce step
         self.key_cache = {}
 
         super(AnnotatorUDF, self).__init__(**kwargs)
 
-    def apply(self, cid, **kwargs):
+    def apply(self, cids, **kwargs):
         """
-        Applies a given function to a Candidate, yielding a set of Annotations as key_name, value pairs
+        Applies a given function to a batch of Candidates, yielding a set of Annotations as key_name, value pairs
 
-        Note: Accepts a candidate _id_ as argument, because of issues with putting Candidate subclasses
-        into Queues (can't pickle...)
+        Note: Accepts a list of candidate _ids_ as argument, because of issues with putting Candidate subclasses
+        into Queues (can't pickle...); the Candidates are then loaded together with the fetch plan
         """
-        seen = set()
-        cid = cid[0]
-        c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
-        for key_name, value in self.anno_generator(c):
-
-            # Note: Make sure no duplicates emitted here!
-            if (cid, key_name) not in seen:
-                seen.add((cid, key_name))
-                yield cid, key_name, value
+        candidates = self.fetch_plan.fetch(self.session, cids)
+
+        # Batch LFs label the whole batch in one call up front
+        if self.batch_fns:
+            candidates = list(candidates)
+            for g in self.batch_fns:
+                g.prepare(candidates)
+
+        # Span indexes and values cached by the LF helpers are shared within the batch only
+        with span_index_scope():
+            for c in candidates:
+                seen = set()
+                cid  = c.id
+                for key_name, value in self.anno_generator(c):
+
+                    # Note: Make sure no duplicates emitted here!
+                    if key_name not in seen:
+                        seen.add(key_name)
+                        yield cid, key_name, value
 
     def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
         """
@@ -320,8 +336,8 @@ def load_gold_labels(session, annotator_name, **kwargs):
 
 class LabelAnnotator(Annotator):
     """Apply labeling functions to the candidates, generating Label annotations"""
-    def __init__(self, f):
-        super(LabelAnnotator, self).__init__(Label, LabelKey, f)
+    def __init__(self, f, fetch_plan=None):
+        super(LabelAnnotator, self).__init__(Label, LabelKey, f, fetch_plan=fetch_plan)
 
     def load_matrix(self, session, split, **kwargs):
         return load_label_matrix(session, split=split, **kwargs)
@@ -329,8 +345,8 @@ class LabelAnnotator(Annotator):
         
 class FeatureAnnotator(Annotator):
     """Apply feature generators to the candidates, generating Feature annotations"""
-    def __init__(self, f=get_span_feats):
-        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f)
+    def __init__(self, f=get_span_feats, fetch_plan=None):
+        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f, fetch_plan=fetch_plan)
 
     def load_matrix(self, session, split, key_group=0, **kwargs):
         return load_feature_matrix(session, split=split, key_group=key_group, **kwargs)
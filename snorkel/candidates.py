@@ -1,8 +1,9 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 from copy import deepcopy
 from itertools import product
 import re
 from sqlalchemy.sql import select
+from time import time
 
 from .models import Candidate, TemporarySpan, Sentence
 from .udf import UDF, UDFRunner
@@ -42,6 +43,86 @@ class CandidateExtractor(UDFRunner):
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
+    def dry_run(self, xs, split=0, stats=None, **kwargs):
+        """
+        Runs the candidate spaces and matchers over xs without writing anything to the database,
+        and returns a :class:`CandidateExtractionStats` object with the resulting counts.
+
+        Accepts the same keyword arguments as apply (e.g. parallelism, progress_bar, count), except clear.
+        Pass in the stats object returned by a previous call to accumulate counts over several splits.
+        """
+        return _dry_run(CandidateExtractorDryRunUDF, self.udf_init_kwargs, xs, split, stats, **kwargs)
+
+
+class CandidateExtractionStats(object):
+    """
+    Counts collected by a candidate extraction dry run: the number of candidates per split and per
+    document, the distribution of argument set sizes per context, and the extraction throughput.
+    """
+    def __init__(self):
+        self.n_contexts      = 0
+        self.n_candidates    = 0
+        self.split_counts    = Counter()
+        self.document_counts = Counter()
+        self.arg_set_sizes   = None
+        self.elapsed         = 0.0
+
+    def add(self, document_id, split, arg_set_sizes, n_candidates):
+        if self.arg_set_sizes is None:
+            self.arg_set_sizes = [Counter() for _ in arg_set_sizes]
+        for size_counts, size in zip(self.arg_set_sizes, arg_set_sizes):
+            size_counts[size] += 1
+        self.n_contexts                   += 1
+        self.n_candidates                 += n_candidates
+        self.split_counts[split]          += n_candidates
+        self.document_counts[document_id] += n_candidates
+
+    def contexts_per_sec(self):
+        return self.n_contexts / self.elapsed if self.elapsed > 0 else 0.0
+
+    def candidates_per_sec(self):
+        return self.n_candidates / self.elapsed if self.elapsed > 0 else 0.0
+
+    def estimate_time(self, n_contexts):
+        """Estimated seconds needed to run the spaces and matchers over n_contexts contexts"""
+        rate = self.contexts_per_sec()
+        return n_contexts / rate if rate > 0 else float('inf')
+
+    def summary(self):
+        print "========================================"
+        print "Candidate extraction dry run"
+        print "========================================"
+        print "Contexts:   %s" % self.n_contexts
+        print "Candidates: %s" % self.n_candidates
+        for split, n in sorted(self.split_counts.items()):
+            print "  split %s: %s" % (split, n)
+        for i, size_counts in enumerate(self.arg_set_sizes or []):
+            n = sum(size_counts.values())
+            mean = sum(k * v for k, v in size_counts.items()) / float(n) if n > 0 else 0.0
+            print "Argument %s set size: mean=%.2f, max=%s" % (i, mean, max(size_counts.keys()))
+        print "Throughput: %.1f contexts/sec, %.1f candidates/sec" \
+            % (self.contexts_per_sec(), self.candidates_per_sec())
+        print "========================================"
+
+    def __repr__(self):
+        return "%s(contexts=%s, candidates=%s, elapsed=%.2fs)" \
+            % (self.__class__.__name__, self.n_contexts, self.n_candidates, self.elapsed)
+
+
+def _dry_run(udf_class, udf_init_kwargs, xs, split, stats, **kwargs):
+    """Runs a dry-run extractor UDF class, accumulating and returning CandidateExtractionStats"""
+    stats  = stats if stats is not None else CandidateExtractionStats()
+    runner = UDFRunner(udf_class, **udf_init_kwargs)
+    start  = time()
+    runner.apply(xs, clear=False, split=split, stats=stats, **kwargs)
+    stats.elapsed += time() - start
+    return stats
+
+
+def _get_context_document_id(context):
+    """Returns the id of the Document a Context belongs to, without loading any relationships"""
+    return getattr(context, 'document_id', context.id)
+
 
 class CandidateExtractorUDF(UDF):
     def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations, **kwargs):
@@ -71,14 +152,39 @@ class CandidateExtractorUDF(UDF):
     def apply(self, context, clear, split, **kwargs):
         # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
         # by the Matcher
+        self._load_child_contexts(context, insert=True)
+
+        # Generates and persists candidates
+        candidate_args = {'split': split}
+        for args in self._get_arg_tuples():
+
+            # Assemble candidate arguments
+            for i, arg_name in enumerate(self.candidate_class.__argnames__):
+                candidate_args[arg_name + '_id'] = args[i].id
+
+            # Checking for existence
+            if not clear:
+                q = select([self.candidate_class.id])
+                for key, value in candidate_args.items():
+                    q = q.where(getattr(self.candidate_class, key) == value)
+                candidate_id = self.session.execute(q).first()
+                if candidate_id is not None:
+                    continue
+
+            # Add Candidate to session
+            yield self.candidate_class(**candidate_args)
+
+    def _load_child_contexts(self, context, insert=True):
+        """Fills the child context sets, optionally loading or inserting each TemporaryContext's id"""
         for i in range(self.arity):
             self.child_context_sets[i].clear()
             for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(self.session)
+                if insert:
+                    tc.load_id_or_insert(self.session)
                 self.child_context_sets[i].add(tc)
 
-        # Generates and persists candidates
-        candidate_args = {'split': split}
+    def _get_arg_tuples(self):
+        """Yields the tuples of child contexts which form candidates"""
         for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
 
             # TODO: Make this work for higher-order relations
@@ -94,22 +200,19 @@ class CandidateExtractorUDF(UDF):
                     continue
                 elif not self.symmetric_relations and ai > bi:
                     continue
+            yield tuple(arg for _, arg in args)
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
 
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
+class CandidateExtractorDryRunUDF(CandidateExtractorUDF):
+    """Counts the candidates CandidateExtractorUDF would extract from a Context, without any inserts"""
+    def apply(self, context, split, **kwargs):
+        self._load_child_contexts(context, insert=False)
+        n_candidates  = sum(1 for _ in self._get_arg_tuples())
+        arg_set_sizes = tuple(len(child_contexts) for child_contexts in self.child_context_sets)
+        yield _get_context_document_id(context), split, arg_set_sizes, n_candidates
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+    def reduce(self, y, stats, **kwargs):
+        stats.add(*y)
 
 
 class CandidateSpace(object):
@@ -184,6 +287,14 @@ class PretaggedCandidateExtractor(UDFRunner):
     def clear(self, session, split, **kwargs):
         session.query(Candidate).filter(Candidate.split == split).delete()
 
+    def dry_run(self, xs, split=0, stats=None, **kwargs):
+        """
+        Collects the entity spans and candidates over xs without writing anything to the database,
+        and returns a :class:`CandidateExtractionStats` object with the resulting counts.
+        See :meth:`CandidateExtractor.dry_run`.
+        """
+        return _dry_run(PretaggedCandidateExtractorDryRunUDF, self.udf_init_kwargs, xs, split, stats, **kwargs)
+
 
 class PretaggedCandidateExtractorUDF(UDF):
     """
@@ -203,6 +314,34 @@ class PretaggedCandidateExtractorUDF(UDF):
 
     def apply(self, context, clear, split, check_for_existing=True, **kwargs):
         """Extract Candidates from a Context"""
+        entity_spans, entity_cids = self._get_entity_spans(context, insert=True)
+
+        # Generates and persists candidates
+        candidate_args = {'split' : split}
+        for args in self._get_arg_tuples(entity_spans):
+
+            # Assemble candidate arguments
+            for i, arg_name in enumerate(self.candidate_class.__argnames__):
+                candidate_args[arg_name + '_id'] = args[i].id
+                candidate_args[arg_name + '_cid'] = entity_cids[args[i]]
+
+            # Checking for existence
+            if check_for_existing:
+                q = select([self.candidate_class.id])
+                for key, value in candidate_args.items():
+                    q = q.where(getattr(self.candidate_class, key) == value)
+                candidate_id = self.session.execute(q).first()
+                if candidate_id is not None:
+                    continue
+
+            # Add Candidate to session
+            yield self.candidate_class(**candidate_args)
+
+    def _get_entity_spans(self, context, insert=True):
+        """
+        Returns the entity spans of the Context by entity type, and a map from each span to its entity CID,
+        optionally loading or inserting each span's id
+        """
         # For now, just handle Sentences
         if not isinstance(context, Sentence):
             raise NotImplementedError("%s is currently only implemented for Sentence contexts." % self.__name__)
@@ -233,12 +372,14 @@ class PretaggedCandidateExtractorUDF(UDF):
 
                     # Insert / load temporary span, also store map to entity CID
                     tc = TemporarySpan(char_start=char_start, char_end=char_end, sentence=context)
-                    tc.load_id_or_insert(self.session)
-                    entity_cids[tc.id] = cid
+                    if insert:
+                        tc.load_id_or_insert(self.session)
+                    entity_cids[tc] = cid
                     entity_spans[et].append(tc)
+        return entity_spans, entity_cids
 
-        # Generates and persists candidates
-        candidate_args = {'split' : split}
+    def _get_arg_tuples(self, entity_spans):
+        """Yields the tuples of entity spans which form candidates"""
         for args in product(*[enumerate(entity_spans[et]) for et in self.entity_types]):
 
             # TODO: Make this work for higher-order relations
@@ -254,20 +395,16 @@ class PretaggedCandidateExtractorUDF(UDF):
                     continue
                 elif not self.symmetric_relations and ai > bi:
                     continue
+            yield tuple(arg for _, arg in args)
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-                candidate_args[arg_name + '_cid'] = entity_cids[args[i][1].id]
 
-            # Checking for existence
-            if check_for_existing:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
+class PretaggedCandidateExtractorDryRunUDF(PretaggedCandidateExtractorUDF):
+    """Counts the candidates PretaggedCandidateExtractorUDF would extract from a Context, without any inserts"""
+    def apply(self, context, split, **kwargs):
+        entity_spans, _ = self._get_entity_spans(context, insert=False)
+        n_candidates    = sum(1 for _ in self._get_arg_tuples(entity_spans))
+        arg_set_sizes   = tuple(len(entity_spans[et]) for et in self.entity_types)
+        yield _get_context_document_id(context), split, arg_set_sizes, n_candidates
 
-            # Add Candidate to session
-            yield self.candidate_class(**candidate_args)
+    def reduce(self, y, stats, **kwargs):
+        stats.add(*y)
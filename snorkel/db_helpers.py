@@ -1,5 +1,192 @@
-from .models import StableLabel, GoldLabel, Context, GoldLabelKey
+from .models import StableLabel, GoldLabel, Context, GoldLabelKey, Candidate, Span, Sentence, Document
+from contextlib import contextmanager
+from itertools import chain
 from sqlalchemy.orm import object_session
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import select
+
+
+class CandidateFetchPlan(object):
+    """
+    Loads Candidates in batches together with the Contexts which LFs, feature generators and the Viewer
+    typically touch, so that accessing c[0].get_parent() etc. does not lazily load each object with its own query.
+
+    For each batch of Candidates, the argument Spans, their parent Sentences and (optionally) the parent
+    Documents are loaded with one query per type, and attached to the Candidates in the session.
+    """
+    def __init__(self, batch_size=500, spans=True, sentences=True, documents=False):
+        # Note: batch_size also bounds the number of ids in an IN clause (SQLite allows at most 999)
+        self.batch_size = batch_size
+        self.spans      = spans
+        self.sentences  = spans and sentences
+        self.documents  = spans and sentences and documents
+
+    def batches(self, xs):
+        """Splits a sequence into lists of at most batch_size elements"""
+        batch = []
+        for x in xs:
+            batch.append(x)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def fetch(self, session, cids):
+        """Yields the Candidates with ids cids, in order, with their Contexts prefetched"""
+        for batch in self.batches(cids):
+            q = session.query(Candidate).with_polymorphic('*').filter(Candidate.id.in_(batch))
+            candidates = dict((c.id, c) for c in q)
+            self.prefetch(session, candidates.values())
+            for cid in batch:
+                if cid in candidates:
+                    yield candidates[cid]
+
+    def fetch_split(self, session, split, candidate_class=Candidate):
+        """Returns a list of the Candidates of candidate_class in the split, ordered by id"""
+        q = session.query(candidate_class.id).filter(candidate_class.split == split).order_by(candidate_class.id)
+        return list(self.fetch(session, [cid for cid, in q]))
+
+    def prefetch(self, session, candidates):
+        """Loads the Contexts of already loaded Candidates into the session in bulk"""
+        if not self.spans:
+            return
+        arg_ids = set()
+        for c in candidates:
+            arg_ids.update(getattr(c, arg + '_id') for arg in c.__argnames__)
+        arg_ids.discard(None)
+        spans = self._load(session, Span, arg_ids)
+
+        # Many-to-one relationships are resolved from the session's identity map, so accessing them now
+        # is free, and keeps the loaded objects referenced by the Candidates
+        for c in candidates:
+            c.get_contexts()
+        if self.sentences:
+            sentences = self._load(session, Sentence, set(s.sentence_id for s in spans))
+            for s in spans:
+                s.sentence
+            if self.documents:
+                # The session only keeps weak references, so the Documents are held until attached
+                documents = self._load(session, Document, set(s.document_id for s in sentences))
+                for s in sentences:
+                    s.document
+
+    def _load(self, session, context_class, ids):
+        """Loads the Contexts of context_class with ids, skipping those already in the session"""
+        loaded = []
+        todo   = []
+        for id in ids:
+            context = session.identity_map.get(identity_key(Context, id))
+            if context is None:
+                todo.append(id)
+            elif isinstance(context, context_class):
+                loaded.append(context)
+        for batch in self.batches(todo):
+            loaded.extend(session.query(context_class).filter(context_class.id.in_(batch)))
+        return loaded
+
+
+def load_candidates(session, split, candidate_class=Candidate, fetch_plan=None):
+    """Returns the Candidates in a split, ordered by id, loading them with a (default) CandidateFetchPlan"""
+    fetch_plan = fetch_plan if fetch_plan is not None else CandidateFetchPlan()
+    return fetch_plan.fetch_split(session, split, candidate_class=candidate_class)
+
+
+# Number of stable ids / AnnotatorLabels per query when reloading annotator labels
+RELOAD_BATCH_SIZE = 500
+
+# DocumentSpanIndexes, by Document, and LastObjectCaches of the LF helpers, by name, shared within the current
+# span_index_scope
+_span_indexes  = None
+_helper_caches = None
+
+
+class DocumentSpanIndex(object):
+    """
+    The Spans of a Document, grouped by Sentence, in order of Sentence position and then char_start.
+    Loaded with a single query for ORM Documents; other Documents (e.g. snapshot views) are walked.
+    """
+    def __init__(self, document):
+        self.spans          = []
+        self.sentence_spans = {}
+        session             = object_session(document) if isinstance(document, Document) else None
+        if session is not None:
+            q = session.query(Span).join(Sentence, Span.sentence_id == Sentence.id)
+            q = q.filter(Sentence.document_id == document.id).order_by(Sentence.position, Span.char_start)
+            for span in q:
+                self.spans.append(span)
+                self.sentence_spans.setdefault(span.sentence_id, []).append(span)
+        else:
+            for sentence in document.sentences:
+                self.sentence_spans[sentence.id] = list(sentence.spans)
+                self.spans.extend(self.sentence_spans[sentence.id])
+
+    def get_sentence_spans(self, sentence):
+        return self.sentence_spans.get(sentence.id, [])
+
+
+def get_document_span_index(document):
+    """
+    Returns the DocumentSpanIndex of a Document. Within a span_index_scope, each Document is indexed once;
+    otherwise (e.g. when developing LFs in a notebook) the index is rebuilt, so that it reflects the current Spans.
+    """
+    if _span_indexes is None:
+        return DocumentSpanIndex(document)
+    try:
+        return _span_indexes[document]
+    except KeyError:
+        index = _span_indexes[document] = DocumentSpanIndex(document)
+        return index
+
+
+class LastObjectCache(object):
+    """
+    Caches values derived from the object most recently passed to a helper, e.g. the Candidate being labeled,
+    so that the LFs applied to it in turn share them; moving on to another object empties the cache.
+    """
+    def __init__(self):
+        self.obj    = None
+        self.values = {}
+
+    def get(self, obj, key, f):
+        if obj is not self.obj:
+            self.obj    = obj
+            self.values = {}
+        try:
+            return self.values[key]
+        except KeyError:
+            value = self.values[key] = f()
+            return value
+
+
+def get_helper_cache(name):
+    """
+    Returns the LastObjectCache of name in the current span_index_scope, or None outside of one, where the
+    helpers recompute their values so that they reflect modified or reloaded objects
+    """
+    if _helper_caches is None:
+        return None
+    try:
+        return _helper_caches[name]
+    except KeyError:
+        cache = _helper_caches[name] = LastObjectCache()
+        return cache
+
+
+@contextmanager
+def span_index_scope():
+    """
+    Shares DocumentSpanIndexes, and the values cached by the LF helpers, within the block, e.g. over one batch of
+    Candidates being annotated
+    """
+    global _span_indexes, _helper_caches
+    outer          = _span_indexes, _helper_caches
+    _span_indexes  = {}
+    _helper_caches = {}
+    try:
+        yield
+    finally:
+        _span_indexes, _helper_caches = outer
 
 
 def reload_annotator_labels(session, candidate_class, annotator_name, split, filter_label_split=True, create_missing_cands=False):
@@ -10,52 +197,69 @@ def reload_annotator_labels(session, candidate_class, annotator_name, split, fil
         ak = GoldLabelKey(name=annotator_name)
         session.add(ak)
         session.commit()
-    
-    labels = []
-    missed = []
-    sl_query = session.query(StableLabel).filter(StableLabel.annotator_name == annotator_name)
-    sl_query = sl_query.filter(StableLabel.split == split) if filter_label_split else sl_query
-    for sl in sl_query.all():
-        context_stable_ids = sl.context_stable_ids.split('~~')
 
-        # Check for labeled Contexts
-        # TODO: Does not create the Contexts if they do not yet exist! 
-        contexts = []
-        for stable_id in context_stable_ids:
-            context = session.query(Context).filter(Context.stable_id == stable_id).first()
-            if context:
-                contexts.append(context)
-        if len(contexts) < len(context_stable_ids):
-            missed.append(sl)
-            continue
+    sl_query = select([StableLabel.context_stable_ids, StableLabel.value])
+    sl_query = sl_query.where(StableLabel.annotator_name == annotator_name)
+    sl_query = sl_query.where(StableLabel.split == split) if filter_label_split else sl_query
+    sls      = [(sids.split('~~'), value) for sids, value in session.execute(sl_query)]
 
-        # Check for Candidate
-        # Assemble candidate arguments
-        candidate_args  = {'split' : split}
-        for i, arg_name in enumerate(candidate_class.__argnames__):
-            candidate_args[arg_name] = contexts[i]
+    # Resolve all the labeled Contexts' stable ids to ids, in batches
+    # TODO: Does not create the Contexts if they do not yet exist! 
+    stable_ids    = list(set(chain.from_iterable(sids for sids, _ in sls)))
+    stable_id_map = {}
+    for i in range(0, len(stable_ids), RELOAD_BATCH_SIZE):
+        q = select([Context.stable_id, Context.id]).where(Context.stable_id.in_(stable_ids[i:i+RELOAD_BATCH_SIZE]))
+        stable_id_map.update(session.execute(q).fetchall())
 
-        # Assemble query and check
-        candidate_query = session.query(candidate_class)
-        for k, v in candidate_args.iteritems():
-            candidate_query = candidate_query.filter(getattr(candidate_class, k) == v)
-        candidate = candidate_query.first()
+    # Index the Candidates in the split by their argument ids
+    ct = candidate_class.__table__
+    q  = select([ct.c.id] + [ct.c[arg + '_id'] for arg in candidate_class.__argnames__])
+    q  = q.where(ct.c.id == Candidate.__table__.c.id).where(Candidate.__table__.c.split == split)
+    candidate_map = dict((tuple(row[1:]), row[0]) for row in session.execute(q))
 
-        # Optionally construct missing candidates
-        if candidate is None and create_missing_cands:
-            candidate = candidate_class(**candidate_args)
+    # Candidates which already have an AnnotatorLabel
+    q       = select([GoldLabel.candidate_id]).where(GoldLabel.key_id == ak.id)
+    labeled = set(cid for cid, in session.execute(q))
+
+    labels  = []
+    missed  = []
+    created = []
+    for context_stable_ids, value in sls:
 
-        # If candidate is none, mark as missed and continue
-        if candidate is None:
-            missed.append(sl)
+        # Check for labeled Contexts
+        context_ids = tuple(stable_id_map.get(stable_id) for stable_id in context_stable_ids)
+        if None in context_ids:
+            missed.append(context_stable_ids)
+            continue
+
+        # Check for Candidate, optionally constructing missing ones
+        cid = candidate_map.get(context_ids)
+        if cid is None and create_missing_cands:
+            candidate_args = {'split' : split}
+            for i, arg_name in enumerate(candidate_class.__argnames__):
+                candidate_args[arg_name + '_id'] = context_ids[i]
+            candidate = candidate_class(**candidate_args)
+            session.add(candidate)
+            created.append((candidate, value))
+            candidate_map[context_ids] = candidate
+            continue
+        elif cid is None:
+            missed.append(context_stable_ids)
             continue
 
         # Check for AnnotatorLabel, otherwise create
-        label = session.query(GoldLabel).filter(GoldLabel.key == ak).filter(GoldLabel.candidate == candidate).first()
-        if label is None:
-            label = GoldLabel(candidate=candidate, key=ak, value=sl.value)
-            session.add(label)
-            labels.append(label)
+        if not isinstance(cid, candidate_class) and cid not in labeled:
+            labeled.add(cid)
+            labels.append({'candidate_id': cid, 'key_id': ak.id, 'value': value})
+
+    # Created Candidates get their ids once flushed
+    if len(created) > 0:
+        session.flush()
+        for candidate, value in created:
+            labels.append({'candidate_id': candidate.id, 'key_id': ak.id, 'value': value})
 
+    # Insert the new AnnotatorLabels in batches
+    for i in range(0, len(labels), RELOAD_BATCH_SIZE):
+        session.execute(GoldLabel.__table__.insert(), labels[i:i+RELOAD_BATCH_SIZE])
     session.commit()
     print "AnnotatorLabels created: %s" % (len(labels),)
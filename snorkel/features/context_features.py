@@ -1,6 +1,6 @@
 from collections import defaultdict
 from functools import partial
-from snorkel.models import Span
+from snorkel.models import TemporarySpan
 
 
 def get_token_count_feats(candidate, context, attr, ngram, stopwords):
@@ -12,7 +12,7 @@ def get_token_count_feats(candidate, context, attr, ngram, stopwords):
     stopwords: @set of stopwords to filter out from counts
     """
     args = candidate.get_contexts()
-    if not isinstance(args[0], Span):
+    if not isinstance(args[0], TemporarySpan):
         raise ValueError("Accepts Span-type arguments, %s-type found.")
 
     counter = defaultdict(int)
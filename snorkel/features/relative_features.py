@@ -7,7 +7,7 @@ sys.path.append(os.path.join(os.environ['SNORKELHOME'], 'treedlib'))
 from collections import defaultdict
 from entity_features import compile_entity_feature_generator, get_ddlib_feats
 from functools import partial
-from snorkel.models import Span
+from snorkel.models import TemporarySpan
 from snorkel.utils import get_as_dict
 from string import punctuation
 from tree_structs import corenlp_to_xmltree
@@ -64,7 +64,7 @@ def get_span_feats(candidate, stopwords=None):
     stopwords: @set of stopwords to filter out from dependency path
     """
     args = candidate.get_contexts()
-    if not isinstance(args[0], Span):
+    if not isinstance(args[0], TemporarySpan):
         raise ValueError("Accepts Span-type arguments, %s-type found.")
     # Unary candidates
     if len(args) == 1:
@@ -117,7 +117,8 @@ class MentionScorer(Scorer):
 
             # If a gold candidate set is provided, also calculate recall-adjusted scores
             if self.gold_candidate_set is not None:
-                gold_fn    = [c for c in self.gold_candidate_set if c not in self.test_candidates]
+                test_set   = set(self.test_candidates)
+                gold_fn    = [c for c in self.gold_candidate_set if c not in test_set]
                 print "\n"
                 print_scores(len(tp), len(fp), len(tn), len(fn)+len(gold_fn),title="Corpus Recall-adjusted Scores")
 
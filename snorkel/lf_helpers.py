@@ -2,12 +2,39 @@ import numpy as np
 import re
 
 from .annotations import load_gold_labels
+from .db_helpers import get_document_span_index, get_helper_cache, load_candidates
 from .learning.utils import MentionScorer
-from .models import Span, Label, Candidate
+from .models import Span, TemporarySpan, Label, Candidate
 from itertools import chain
 from utils import tokens_to_ngrams
 
 
+_regexes = {}
+
+
+def _cached(name, obj, key, f):
+    """Returns f(), cached for obj by the helper cache name within a span_index_scope"""
+    cache = get_helper_cache(name)
+    return f() if cache is None else cache.get(obj, key, f)
+
+
+def _get_regex(pattern):
+    """Returns pattern compiled with re.I, compiling each pattern only once"""
+    try:
+        return _regexes[pattern]
+    except KeyError:
+        rgx = _regexes[pattern] = re.compile(pattern, flags=re.I)
+        return rgx
+
+
+def _get_tokens(sentence, attrib, case_sensitive):
+    """Returns the tokens of a Sentence for attrib, lowercased unless case_sensitive"""
+    def f():
+        tokens = getattr(sentence, attrib)
+        return tokens if case_sensitive else [w.lower() for w in tokens]
+    return _cached('sentence', sentence, (attrib, case_sensitive), f)
+
+
 def get_text_splits(c):
     """
     Given a k-arity Candidate defined over k Spans, return the chunked parent context (e.g. Sentence)
@@ -15,9 +42,13 @@ def get_text_splits(c):
 
     NOTE: Currently assumes that these Spans are in the same Context
     """
+    return list(_cached('candidate', c, 'text_splits', lambda: tuple(_get_text_splits(c))))
+
+
+def _get_text_splits(c):
     spans = []
     for i, span in enumerate(c.get_contexts()):
-        if not isinstance(span, Span):
+        if not isinstance(span, TemporarySpan):
             raise ValueError("Handles Span-type Candidate arguments only")
 
         # Note: {{0}}, {{1}}, etc. does not work as an un-escaped regex pattern, hence A, B, ...
@@ -41,7 +72,7 @@ def get_tagged_text(c):
     Returns the text of c's parent context with c's unary spans replaced with tags {{A}}, {{B}}, etc.
     A convenience method for writing LFs based on e.g. regexes.
     """
-    return "".join(get_text_splits(c))
+    return _cached('candidate', c, 'tagged_text', lambda: "".join(get_text_splits(c)))
 
 
 def get_text_between(c):
@@ -87,10 +118,9 @@ def get_left_tokens(c, window=3, attrib='words', n_max=1, case_sensitive=False):
     :param window: The number of tokens to the left of the first argument to return
     :param attrib: The token attribute type (e.g. words, lemmas, poses)
     """
-    span = c if isinstance(c, Span) else c[0] 
+    span = c if isinstance(c, TemporarySpan) else c[0] 
     i    = span.get_word_start()
-    f = (lambda w: w) if case_sensitive else (lambda w: w.lower())
-    return [ngram for ngram in tokens_to_ngrams(map(f, span.get_parent()._asdict()[attrib][max(0, i-window):i]), n_max=n_max)]
+    return [ngram for ngram in tokens_to_ngrams(_get_tokens(span.get_parent(), attrib, case_sensitive)[max(0, i-window):i], n_max=n_max)]
 
 
 def get_right_tokens(c, window=3, attrib='words', n_max=1, case_sensitive=False):
@@ -100,10 +130,9 @@ def get_right_tokens(c, window=3, attrib='words', n_max=1, case_sensitive=False)
     :param window: The number of tokens to the right of the last argument to return
     :param attrib: The token attribute type (e.g. words, lemmas, poses)
     """
-    span = c if isinstance(c, Span) else c[-1]
+    span = c if isinstance(c, TemporarySpan) else c[-1]
     i    = span.get_word_end()
-    f = (lambda w: w) if case_sensitive else (lambda w: w.lower())
-    return [ngram for ngram in tokens_to_ngrams(map(f, span.get_parent()._asdict()[attrib][i+1:i+1+window]), n_max=n_max)]
+    return [ngram for ngram in tokens_to_ngrams(_get_tokens(span.get_parent(), attrib, case_sensitive)[i+1:i+1+window], n_max=n_max)]
 
 
 def contains_token(c, tok, attrib='words', case_sensitive=False):
@@ -111,7 +140,7 @@ def contains_token(c, tok, attrib='words', case_sensitive=False):
     Checks if any of the contituent Spans contain a token
     :param attrib: The token attribute type (e.g. words, lemmas, poses)
     """
-    spans = [c] if isinstance(c, Span) else c.get_contexts()
+    spans = [c] if isinstance(c, TemporarySpan) else c.get_contexts()
     f = (lambda w: w) if case_sensitive else (lambda w: w.lower())
     return f(tok) in set(chain.from_iterable(map(f, span.get_attrib_tokens(attrib))
         for span in spans))
@@ -122,9 +151,8 @@ def get_doc_candidate_spans(c):
     Get the Spans in the same document as Candidate c, where these Spans are
     arguments of Candidates.
     """
-    # TODO: Fix this to be more efficient and properly general!!
-    spans = list(chain.from_iterable(s.spans for s in c[0].get_parent().document.sentences))
-    return [s for s in spans if s != c[0]]
+    index = get_document_span_index(c[0].get_parent().document)
+    return [s for s in index.spans if s != c[0]]
 
 
 def get_sent_candidate_spans(c):
@@ -132,8 +160,9 @@ def get_sent_candidate_spans(c):
     Get the Spans in the same Sentence as Candidate c, where these Spans are
     arguments of Candidates.
     """
-    # TODO: Fix this to be more efficient and properly general!!
-    return [s for s in c[0].get_parent().spans if s != c[0]]
+    sentence = c[0].get_parent()
+    index    = get_document_span_index(sentence.document)
+    return [s for s in index.get_sentence_spans(sentence) if s != c[0]]
 
 
 def get_matches(lf, candidate_set, match_values=[1,-1]):
@@ -158,30 +187,137 @@ def rule_text_in_span(candidate, text, span, sign):
 
 
 def rule_regex_search_tagged_text(candidate, pattern, sign):
-    return sign if re.search(pattern, get_tagged_text(candidate), flags=re.I) else 0
+    return sign if _get_regex(pattern).search(get_tagged_text(candidate)) else 0
  
 
 def rule_regex_search_btw_AB(candidate, pattern, sign):
-    return sign if re.search(r'{{A}}' + pattern + r'{{B}}', get_tagged_text(candidate), flags=re.I) else 0
+    return sign if _get_regex(r'{{A}}' + pattern + r'{{B}}').search(get_tagged_text(candidate)) else 0
 
 
 def rule_regex_search_btw_BA(candidate, pattern, sign):
-    return sign if re.search(r'{{B}}' + pattern + r'{{A}}', get_tagged_text(candidate), flags=re.I) else 0
+    return sign if _get_regex(r'{{B}}' + pattern + r'{{A}}').search(get_tagged_text(candidate)) else 0
 
     
 def rule_regex_search_before_A(candidate, pattern, sign):
-    return sign if re.search(pattern + r'{{A}}.*{{B}}', get_tagged_text(candidate), flags=re.I) else 0
+    return sign if _get_regex(pattern + r'{{A}}.*{{B}}').search(get_tagged_text(candidate)) else 0
 
     
 def rule_regex_search_before_B(candidate, pattern, sign):
-    return sign if re.search(pattern + r'{{B}}.*{{A}}', get_tagged_text(candidate), flags=re.I) else 0
+    return sign if _get_regex(pattern + r'{{B}}.*{{A}}').search(get_tagged_text(candidate)) else 0
+
+
+class CandidateBatch(object):
+    """
+    A chunk of Candidates, exposing the views used by LFs (tagged text, text between, token windows, ...)
+    as columns with one entry per Candidate, each computed once per batch.
+    """
+    def __init__(self, candidates):
+        self.candidates = list(candidates)
+        self._columns   = {}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __iter__(self):
+        return iter(self.candidates)
+
+    def column(self, f, *args, **kwargs):
+        """Returns the list [f(c, *args, **kwargs) for c in the batch], computed once per batch"""
+        key = (f, args, tuple(sorted(kwargs.items())))
+        try:
+            return self._columns[key]
+        except KeyError:
+            col = self._columns[key] = [f(c, *args, **kwargs) for c in self.candidates]
+            return col
+
+    @property
+    def tagged_text(self):
+        return self.column(get_tagged_text)
+
+    @property
+    def text_between(self):
+        return self.column(get_text_between)
+
+    def span_text(self, i, case_sensitive=False):
+        return self.column(_get_span_text, i, case_sensitive)
+
+    def left_tokens(self, window=3, attrib='words', n_max=1, case_sensitive=False):
+        return self.column(get_left_tokens, window=window, attrib=attrib, n_max=n_max, case_sensitive=case_sensitive)
+
+    def right_tokens(self, window=3, attrib='words', n_max=1, case_sensitive=False):
+        return self.column(get_right_tokens, window=window, attrib=attrib, n_max=n_max, case_sensitive=case_sensitive)
+
+    def between_tokens(self, attrib='words', n_max=1, case_sensitive=False):
+        return self.column(get_between_tokens, attrib=attrib, n_max=n_max, case_sensitive=case_sensitive)
+
+    def search(self, pattern, texts):
+        """Returns a boolean array of whether pattern (compiled with re.I) matches each of texts"""
+        rgx = _get_regex(pattern)
+        return np.fromiter((rgx.search(t) is not None for t in texts), dtype=bool, count=len(texts))
+
+    def contains_any(self, token_lists, tokens):
+        """Returns a boolean array of whether each of token_lists contains any of tokens"""
+        tokens = frozenset(tokens)
+        return np.fromiter((not tokens.isdisjoint(ts) for ts in token_lists), dtype=bool, count=len(token_lists))
+
+
+def _get_span_text(c, i, case_sensitive):
+    text = c[i].get_span()
+    return text if case_sensitive else text.lower()
+
+
+class BatchLF(object):
+    """
+    An LF which labels a CandidateBatch at once, returning one label per Candidate, e.g.:
+
+    .. code-block:: python
+
+        @batch_lf
+        def LF_causes(batch):
+            return np.where(batch.search(r'{{A}}.*\bcauses?\b.*{{B}}', batch.tagged_text), 1, 0)
+
+    LabelAnnotator labels each chunk of Candidates with it in one call; it can also be called on a single
+    Candidate like any other LF.
+    """
+    def __init__(self, f, name=None):
+        self.f        = f
+        self.__name__ = name if name is not None else f.__name__
+        self._labels  = {}
+
+    def label_batch(self, candidates):
+        """Returns the labels of candidates, as a list of ints"""
+        batch  = candidates if isinstance(candidates, CandidateBatch) else CandidateBatch(candidates)
+        labels = np.asarray(self.f(batch)).tolist()
+        if len(labels) != len(batch):
+            raise ValueError("%s returned %s labels for %s candidates" % (self.__name__, len(labels), len(batch)))
+        return labels
+
+    def prepare(self, candidates):
+        """Labels a batch of candidates ahead of the calls on its members"""
+        candidates   = CandidateBatch(candidates)
+        self._labels = dict(zip(map(id, candidates), zip(candidates, self.label_batch(candidates))))
+
+    def __call__(self, c):
+        try:
+            candidate, label = self._labels[id(c)]
+            if candidate is c:
+                return label
+        except KeyError:
+            pass
+        return self.label_batch([c])[0]
+
+
+def batch_lf(f):
+    """Decorator turning a function of a CandidateBatch into a BatchLF"""
+    return BatchLF(f)
+
 
 def test_LF(session, lf, split, annotator_name):
     """
     Gets the accuracy of a single LF on a split of the candidates, w.r.t. annotator labels,
     and also returns the error buckets of the candidates.
     """
-    test_candidates = session.query(Candidate).filter(Candidate.split == split).all()
+    test_candidates = load_candidates(session, split)
     test_labels     = load_gold_labels(session, annotator_name=annotator_name, split=split)
     scorer          = MentionScorer(test_candidates, test_labels)
     test_marginals  = np.array([0.5 * (lf(c) + 1) for c in test_candidates])
@@ -1,6 +1,8 @@
 import os
 import re
 import warnings
+from bisect import bisect_left, bisect_right
+from .models import TemporarySpan
 # Travis will not import the PorterStemmer
 if 'CI' not in os.environ:
     try:
@@ -19,6 +21,8 @@ class Matcher(object):
         self.children           = children
         self.opts               = opts
         self.longest_match_only = self.opts.get('longest_match_only', True)
+        self.memoize            = self.opts.get('memoize', True)
+        self._memo              = None
         self.init()
         self._check_opts()
 
@@ -38,9 +42,9 @@ class Matcher(object):
         """The internal (non-composed) version of filter function f"""
         return True
 
-    def f(self, c):
+    def _compose(self, c):
         """
-        The recursively composed version of filter function f
+        The recursively composed version of filter function f, without memoization
         By default, returns logical **conjunction** of operator and single child operator
         """
         if len(self.children) == 0:
@@ -50,6 +54,42 @@ class Matcher(object):
         else:
             raise Exception("%s does not support more than one child Matcher" % self.__name__)
 
+    def f(self, c):
+        """
+        The recursively composed version of filter function f
+        While apply() is running, the results of the nodes of a composed Matcher which may be evaluated several
+        times per span (see _memoized_nodes) are memoized per (Matcher, span) for the current context
+        """
+        if self._memo is None:
+            return self._compose(c)
+        key = (self, self._get_span(c))
+        try:
+            return self._memo[key]
+        except KeyError:
+            v = self._memo[key] = self._compose(c)
+            return v
+
+    def _memoized_nodes(self):
+        """
+        Returns the descendants whose results are memoized: the composite ones, which Concat and SlotFillMatch
+        evaluate on the same sub-spans for many candidates, and those with several parents. A leaf evaluated
+        once per span (e.g. a Matcher applied on its own) is cheaper to evaluate again than to memoize.
+        """
+        counts = {}
+        stack  = list(self.children)
+        while len(stack) > 0:
+            node         = stack.pop()
+            counts[node] = counts.get(node, 0) + 1
+            if counts[node] == 1:
+                stack.extend(node.children)
+        return set(node for node, n in counts.items() if n > 1 or len(node.children) > 0)
+
+    def _set_memo(self, memo, nodes):
+        """Sets the memo table shared by those of this Matcher and its descendants which are in nodes"""
+        self._memo = memo if self in nodes else None
+        for child in self.children:
+            child._set_memo(memo, nodes)
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return False
@@ -58,23 +98,87 @@ class Matcher(object):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return c
 
+    def _get_span_index(self):
+        """Returns an empty index of seen spans, used for longest-match filtering"""
+        return SpanSet(self._is_subspan)
+
     def apply(self, candidates):
         """
         Apply the Matcher to a **generator** of candidates
         Optionally only takes the longest match (NOTE: assumes this is the *first* match)
         """
-        seen_spans = set()
-        for c in candidates:
-            if self.f(c) and (not self.longest_match_only or not any([self._is_subspan(c, s) for s in seen_spans])):
-                if self.longest_match_only:
-                    seen_spans.add(self._get_span(c))
-                yield c
+        seen_spans = self._get_span_index()
+        nodes      = self._memoized_nodes() if self.memoize else set()
+        memo       = {} if len(nodes) > 0 else None
+        context    = None
+        self._set_memo(memo, nodes)
+        try:
+            for c in candidates:
+
+                # Memoized results are only valid within a single parent context
+                if memo is not None and getattr(c, 'sentence', None) is not context:
+                    memo.clear()
+                    context = getattr(c, 'sentence', None)
+                if self.f(c) and (not self.longest_match_only or not seen_spans.covers(c)):
+                    if self.longest_match_only:
+                        seen_spans.add(self._get_span(c))
+                    yield c
+        finally:
+            self._set_memo(None, nodes)
+
+
+class SpanSet(object):
+    """Generic index of seen spans: checks candidates for containment against each seen span in turn"""
+    def __init__(self, is_subspan):
+        self.is_subspan = is_subspan
+        self.spans      = set()
+
+    def add(self, span):
+        self.spans.add(span)
+
+    def covers(self, c):
+        """Tests if candidate c is a subspan of any seen span"""
+        return any(self.is_subspan(c, s) for s in self.spans)
+
+
+class IntervalIndex(object):
+    """
+    Index of seen (char_start, char_end) spans, supporting containment queries in log time.
+
+    Only the maximal spans are kept (a span contained in another never changes a query result), sorted by
+    start; as none of them contains another, their ends are then sorted as well, and the only seen span which
+    can contain a candidate is the last one starting at or before it.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends   = []
+
+    def add(self, span):
+        start, end = span
+        i = bisect_right(self.starts, start)
+        if i > 0 and self.ends[i-1] >= end:
+            return
+
+        # Drop the spans contained in the new one, which form a contiguous run starting at j
+        j = bisect_left(self.starts, start)
+        k = bisect_right(self.ends, end, j)
+        self.starts[j:k] = [start]
+        self.ends[j:k]   = [end]
+
+    def covers(self, c):
+        """Tests if candidate c is a subspan of any seen span"""
+        i = bisect_right(self.starts, c.char_start)
+        return i > 0 and self.ends[i-1] >= c.char_end
 
 
 WORDS = 'words'
 
 class NgramMatcher(Matcher):
     """Matcher base class for Ngram objects"""
+    # Per-Sentence precomputed data (see _index_sentence) for the last Sentence seen
+    _sentence       = None
+    _sentence_index = None
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return c.char_start >= span[0] and c.char_end <= span[1]
@@ -83,6 +187,53 @@ class NgramMatcher(Matcher):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return (c.char_start, c.char_end)
 
+    def _get_span_index(self):
+        """Returns an empty index of seen spans, used for longest-match filtering"""
+        return IntervalIndex()
+
+    def _index_sentence(self, sentence):
+        """Precomputes whatever the Matcher needs to check the spans of a Sentence quickly"""
+        raise NotImplementedError()
+
+    def _get_sentence_index(self, sentence):
+        """Returns the output of _index_sentence for sentence, computing it only once per Sentence in a row"""
+        if sentence is not self._sentence:
+            self._sentence_index = self._index_sentence(sentence)
+            self._sentence       = sentence
+        return self._sentence_index
+
+    def _is_token_aligned(self, c):
+        """Tests if candidate c starts and ends on token boundaries"""
+        offsets = c.sentence.char_offsets
+        i, j    = c.get_word_start(), c.get_word_end()
+        return c.char_start == offsets[i] and c.char_end == offsets[j] + len(c.sentence.words[j]) - 1
+
+    def _apply_word_ranges(self, sentence, word_ranges):
+        """
+        Generates the spans of sentence over the given (word start, word end) ranges which match, in the same
+        order and with the same longest-match semantics as apply() over all n-grams of the sentence
+        """
+        words      = sentence.words
+        offsets    = sentence.char_offsets
+        seen_spans = self._get_span_index()
+        for i, j in sorted(word_ranges, key=lambda r: (r[0] - r[1], r[0])):
+            ts = TemporarySpan(sentence=sentence, char_start=offsets[i], char_end=offsets[j] + len(words[j]) - 1)
+            if self.f(ts) and (not self.longest_match_only or not seen_spans.covers(ts)):
+                if self.longest_match_only:
+                    seen_spans.add(self._get_span(ts))
+                yield ts
+
+
+def get_token_offsets(tokens, sep=" "):
+    """Returns the start and end (exclusive) offsets of each token in sep.join(tokens)"""
+    starts, ends = [], []
+    k = 0
+    for t in tokens:
+        starts.append(k)
+        ends.append(k + len(t))
+        k += len(t) + len(sep)
+    return starts, ends
+
 
 class DictionaryMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
@@ -91,17 +242,23 @@ class DictionaryMatch(NgramMatcher):
         self.attrib      = self.opts.get('attrib', WORDS)
         self.reverse     = self.opts.get('reverse', False)
         try:
-            self.d = frozenset(w.lower() if self.ignore_case else w for w in self.opts['d'])
+            d = self.opts['d']
         except KeyError:
             raise Exception("Please supply a dictionary (list of phrases) d as d=d.")
 
         # Optionally use a stemmer, preprocess the dictionary
         # Note that user can provide *an object having a stem() method*
         self.stemmer = self.opts.get('stemmer', None)
+        if self.stemmer == 'porter':
+            self.stemmer = PorterStemmer()
+        self.d = self._build_dictionary(d)
+
+    def _build_dictionary(self, phrases):
+        """Returns the preprocessed dictionary which _f looks spans up in"""
+        d = frozenset(w.lower() if self.ignore_case else w for w in phrases)
         if self.stemmer is not None:
-            if self.stemmer == 'porter':
-                self.stemmer = PorterStemmer()
-            self.d = frozenset(self._stem(w) for w in list(self.d))
+            d = frozenset(self._stem(w) for w in d)
+        return d
 
     def _stem(self, w):
         """Apply stemmer, handling encoding errors"""
@@ -116,6 +273,98 @@ class DictionaryMatch(NgramMatcher):
         p = self._stem(p) if self.stemmer is not None else p
         return (not self.reverse) if p in self.d else self.reverse
 
+
+# Flags of the entries of a TrieDictionaryMatch dictionary
+TRIE_PHRASE = 1
+TRIE_PREFIX = 2
+
+class TrieDictionaryMatch(DictionaryMatch):
+    """
+    Selects candidate Ngrams that match against a given list d, as DictionaryMatch does, but compiles d
+    into a token-level trie and scans each Sentence once for all token-aligned matches, so that checking a
+    candidate is a single set lookup instead of a string construction + dictionary probe.
+
+    The trie is stored flat, as a single dict from each normalized phrase, and from each of its proper token
+    prefixes (its text before each space), to TRIE_PHRASE / TRIE_PREFIX flags: a scan from a start token stops
+    at the first space which does not end a prefix. This takes a small multiple of the memory of DictionaryMatch's
+    set (e.g. 16MB against 10MB for 100k random phrases), rather than a node object per character or token.
+
+    Spans which do not start and end on token boundaries (e.g. from split_tokens) are looked up as a whole.
+    If a stemmer is provided, it is applied to each token separately.
+
+    Use scan(sentence) to directly generate the matching spans of a Sentence, without a CandidateSpace.
+    """
+    def _build_dictionary(self, phrases):
+        d            = {}
+        self.max_len = 0
+        for w in phrases:
+            w            = self._normalize_phrase(w)
+            d[w]         = d.get(w, 0) | TRIE_PHRASE
+            self.max_len = max(self.max_len, len(w))
+            k = w.find(' ')
+            while k >= 0:
+                prefix    = w[:k]
+                d[prefix] = d.get(prefix, 0) | TRIE_PREFIX
+                k = w.find(' ', k + 1)
+        return d
+
+    def _normalize_token(self, t):
+        t = t.lower() if self.ignore_case else t
+        return self._stem(t) if self.stemmer is not None else t
+
+    def _normalize_phrase(self, w):
+        if self.stemmer is not None:
+            return ' '.join(self._normalize_token(t) for t in w.split())
+        return w.lower() if self.ignore_case else w
+
+    def _index_sentence(self, sentence):
+        """Returns the set of (word start, word end) tuples of the token-aligned matches in sentence"""
+        tokens = sentence.__getattribute__(self.attrib)
+
+        # For words, scan the sentence text itself (as get_attrib_span does), else the joined tokens
+        if self.attrib == WORDS and self.stemmer is None:
+            s      = sentence.text.lower() if self.ignore_case else sentence.text
+            starts = sentence.char_offsets
+            ends   = [start + len(t) for start, t in zip(starts, tokens)]
+        else:
+            tokens       = map(self._normalize_token, tokens)
+            s            = ' '.join(tokens)
+            starts, ends = get_token_offsets(tokens)
+
+        # Extend the span from each token start a token at a time, while the text before each space is a prefix
+        matches = set()
+        d       = self.d
+        for i, start in enumerate(starts):
+            for j in range(i, len(starts)):
+                end = ends[j]
+                if end - start > self.max_len:
+                    break
+                k = s.find(' ', start if j == i else ends[j-1], end)
+                while k >= 0 and d.get(s[start:k], 0) & TRIE_PREFIX:
+                    k = s.find(' ', k + 1, end)
+                if k >= 0:
+                    break
+                if d.get(s[start:end], 0) & TRIE_PHRASE:
+                    matches.add((i, j))
+        return matches
+
+    def _f(self, c):
+        if self.attrib == WORDS and not self._is_token_aligned(c):
+            p = self._normalize_phrase(c.get_attrib_span(self.attrib))
+            return (not self.reverse) if self.d.get(p, 0) & TRIE_PHRASE else self.reverse
+        p = (c.get_word_start(), c.get_word_end())
+        return (not self.reverse) if p in self._get_sentence_index(c.sentence) else self.reverse
+
+    def scan(self, sentence):
+        """
+        Generates the TemporarySpans of sentence which match, in the same order and with the same
+        longest-match semantics as apply() over all n-grams of the sentence
+        """
+        if self.reverse:
+            raise ValueError("scan() does not support reverse=True.")
+        return self._apply_word_ranges(sentence, self._get_sentence_index(sentence))
+
+
 class LambdaFunctionMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
     def init(self):
@@ -133,7 +382,7 @@ class LambdaFunctionMatch(NgramMatcher):
 
 class Union(NgramMatcher):
     """Takes the union of candidate sets returned by child operators"""
-    def f(self, c):
+    def _compose(self, c):
        for child in self.children:
            if child.f(c) > 0:
                return True
@@ -152,7 +401,7 @@ class Concat(NgramMatcher):
         self.ignore_sep     = self.opts.get('ignore_sep', True)
         self.sep            = self.opts.get('sep', " ")
 
-    def f(self, c):
+    def _compose(self, c):
         if len(self.children) != 2:
             raise ValueError("Concat takes two child Matcher objects as arguments.")
         if not self.left_required and self.children[1].f(c):
@@ -198,7 +447,7 @@ class SlotFillMatch(NgramMatcher):
             raise ValueError("Number of provided matchers (%s) != number of slots (%s)." \
                     % (len(self.children), len(set(self._ops))))
 
-    def f(self, c):
+    def _compose(self, c):
 
         # First, filter candidates by matching splits pattern
         m = re.match(r'(.+)'.join(self._splits) + r'$', c.get_attrib_span(self.attrib))
@@ -213,15 +462,23 @@ class SlotFillMatch(NgramMatcher):
 
 
 class RegexMatch(NgramMatcher):
-    """Base regex class- does not specify specific semantics of *what* is being matched yet"""
+    """
+    Base regex class- does not specify specific semantics of *what* is being matched yet
+
+    With sentence_scan=True, the attribute string / tokens of each Sentence are built once, so that checking a
+    candidate does not rebuild its span, and the regex is run per start token rather than per span where possible
+    (see RegexMatchSpan and RegexMatchEach); scan(sentence) then generates the matching spans of a Sentence
+    directly, without a CandidateSpace.
+    """
     def init(self):
         try:
             self.rgx = self.opts['rgx']
         except KeyError:
             raise Exception("Please supply a regular expression string r as rgx=r.")
-        self.ignore_case = self.opts.get('ignore_case', True)
-        self.attrib      = self.opts.get('attrib', WORDS)
-        self.sep         = self.opts.get('sep', " ")
+        self.ignore_case   = self.opts.get('ignore_case', True)
+        self.attrib        = self.opts.get('attrib', WORDS)
+        self.sep           = self.opts.get('sep', " ")
+        self.sentence_scan = self.opts.get('sentence_scan', False)
 
         # Compile regex matcher
         # NOTE: Enforce full span matching by ensuring that regex ends with $!
@@ -231,16 +488,152 @@ class RegexMatch(NgramMatcher):
     def _f(self, c):
         raise NotImplementedError()
 
+    def _match_word_range(self, sentence, i, j):
+        """Tests if the span of sentence from word i to word j (inclusive) matches, using the Sentence index"""
+        raise NotImplementedError()
+
+    def _get_word_ranges(self, sentence, n_max):
+        """Returns the (word start, word end) ranges of sentence, of at most n_max words, which may match"""
+        L = len(sentence.words)
+        return [(i, j) for i in range(L) for j in range(i, min(L, i + n_max))]
+
+    def scan(self, sentence, n_max=None):
+        """
+        Generates the TemporarySpans of sentence of at most n_max words which match, in the same order and
+        with the same longest-match semantics as apply() over Ngrams(n_max=n_max, split_tokens=None)
+        """
+        if not self.sentence_scan:
+            raise ValueError("scan() requires sentence_scan=True.")
+        n_max       = n_max if n_max is not None else len(sentence.words)
+        word_ranges = [(i, j) for i, j in self._get_word_ranges(sentence, n_max)
+                       if self._match_word_range(sentence, i, j)]
+        return self._apply_word_ranges(sentence, word_ranges)
+
 
 class RegexMatchSpan(RegexMatch):
-    """Matches regex pattern on **full concatenated span**"""
+    """
+    Matches regex pattern on **full concatenated span**
+
+    With sentence_scan=True, the regex (without its final $) is first matched once, anchored at each start token,
+    against the rest of the sentence: if it matches no prefix there, no span starting at that token can match.
+    Only the word ranges of the remaining start tokens are matched one by one. Regexes which can look past the
+    end of their match (lookaheads, \\b, $) are always matched per word range.
+    """
+    def init(self):
+        super(RegexMatchSpan, self).init()
+        self.r_prefix = None
+        body          = self.rgx[:-1]
+        if not re.search(r'\$|\\[bBZ]|\(\?[=!]', body):
+            try:
+                self.r_prefix = re.compile(body, flags=re.I if self.ignore_case else 0)
+            except re.error:
+                pass
+
+    def _index_sentence(self, sentence):
+        """
+        Returns the attribute string of sentence, its token offsets, and a cache of the text from each start token
+        (None if no span can start there)
+        """
+        if self.attrib == WORDS:
+            s      = sentence.text
+            starts = sentence.char_offsets
+            ends   = [start + len(w) for start, w in zip(starts, sentence.words)]
+        else:
+            tokens       = sentence.__getattribute__(self.attrib)
+            s            = self.sep.join(tokens)
+            starts, ends = get_token_offsets(tokens, self.sep)
+        return s, starts, ends, {}
+
+    def _match_word_range(self, sentence, i, j):
+        s, starts, ends, texts = self._get_sentence_index(sentence)
+        try:
+            t = texts[i]
+        except KeyError:
+            t = texts[i] = s[starts[i]:]
+            if self.r_prefix is not None and self.r_prefix.match(t) is None:
+                t = texts[i] = None
+
+        # Matching up to endpos is matching the span's text, as if the string ended there
+        return t is not None and self.r.match(t, 0, ends[j] - starts[i]) is not None
+
     def _f(self, c):
+        if self.sentence_scan:
+            if self.attrib != WORDS:
+                return self._match_word_range(c.sentence, c.get_word_start(), c.get_word_end())
+
+            # Note: for words, get_attrib_span is the raw text of the span, so it must be token-aligned to be indexed
+            _, starts, ends, _ = self._get_sentence_index(c.sentence)
+            i = bisect_right(starts, c.char_start) - 1
+            j = bisect_right(starts, c.char_end) - 1
+            if c.char_start == starts[i] and c.char_end == ends[j] - 1:
+                return self._match_word_range(c.sentence, i, j)
         return True if self.r.match(c.get_attrib_span(self.attrib, sep=self.sep)) is not None else False
 
 
+class TagRunIndex(object):
+    """
+    The maximal runs of identical tokens of a Sentence attribute (e.g. ner_tags or pos_tags), as
+    [start, end, tag] lists, and the index of the run which each token belongs to
+    """
+    def __init__(self, tokens):
+        self.runs   = []
+        self.run_of = []
+        for i, t in enumerate(tokens):
+            if len(self.runs) == 0 or self.runs[-1][2] != t:
+                self.runs.append([i, i, t])
+            else:
+                self.runs[-1][1] = i
+            self.run_of.append(len(self.runs) - 1)
+
+
 class RegexMatchEach(RegexMatch):
-    """Matches regex pattern on **each token**"""
+    """
+    Matches regex pattern on **each token**
+
+    With sentence_scan=True, the regex is evaluated once per run of identical tokens (see TagRunIndex), and
+    once per distinct token overall for attributes other than words, e.g. tags.
+    """
+    def init(self):
+        super(RegexMatchEach, self).init()
+        self._token_results = {}
+
+    def _match_token(self, t):
+        if self.attrib == WORDS:
+            return self.r.match(t) is not None
+        try:
+            return self._token_results[t]
+        except KeyError:
+            m = self._token_results[t] = self.r.match(t) is not None
+            return m
+
+    def _index_sentence(self, sentence):
+        """Returns the tag run index of the attribute, and the prefix counts of its non-matching runs"""
+        index  = TagRunIndex(sentence.__getattribute__(self.attrib))
+        misses = [0]
+        for _, _, t in index.runs:
+            misses.append(misses[-1] + (0 if self._match_token(t) else 1))
+        return index, misses
+
+    def _match_word_range(self, sentence, i, j):
+        index, misses = self._get_sentence_index(sentence)
+        return j >= i and misses[index.run_of[j]+1] == misses[index.run_of[i]]
+
+    def _get_word_ranges(self, sentence, n_max):
+        # Only ranges within blocks of consecutive matching runs can match
+        index, misses = self._get_sentence_index(sentence)
+        blocks        = []
+        for k, (start, end, _) in enumerate(index.runs):
+            if misses[k+1] == misses[k]:
+                if len(blocks) > 0 and blocks[-1][1] == start - 1:
+                    blocks[-1][1] = end
+                else:
+                    blocks.append([start, end])
+        return [(i, j) for start, end in blocks for i in range(start, end + 1)
+                for j in range(i, min(end + 1, i + n_max))]
+
     def _f(self, c):
+        if self.sentence_scan:
+            return self._match_word_range(c.sentence, c.get_word_start(), c.get_word_end())
         tokens = c.get_attrib_tokens(self.attrib)
         return True if tokens and all([self.r.match(t) is not None for t in tokens]) else False
 
@@ -255,6 +648,7 @@ class PersonMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'PERSON'
+        kwargs.setdefault('sentence_scan', True)
         super(PersonMatcher, self).__init__(*children, **kwargs)
 
 
@@ -268,6 +662,7 @@ class LocationMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'LOCATION'
+        kwargs.setdefault('sentence_scan', True)
         super(LocationMatcher, self).__init__(*children, **kwargs)
 
 
@@ -281,6 +676,7 @@ class OrganizationMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'ORGANIZATION'
+        kwargs.setdefault('sentence_scan', True)
         super(OrganizationMatcher, self).__init__(*children, **kwargs)
 
 
@@ -294,6 +690,7 @@ class DateMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'DATE'
+        kwargs.setdefault('sentence_scan', True)
         super(DateMatcher, self).__init__(*children, **kwargs)
 
 
@@ -307,6 +704,7 @@ class NumberMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'NUMBER'
+        kwargs.setdefault('sentence_scan', True)
         super(NumberMatcher, self).__init__(*children, **kwargs)
 
 
@@ -320,4 +718,5 @@ class MiscMatcher(RegexMatchEach):
     def __init__(self, *children, **kwargs):
         kwargs['attrib'] = 'ner_tags'
         kwargs['rgx'] = 'MISC'
+        kwargs.setdefault('sentence_scan', True)
         super(MiscMatcher, self).__init__(*children, **kwargs)
@@ -1,4 +1,6 @@
-from .meta import SnorkelBase, snorkel_postgres
+from bisect import bisect_right
+from .meta import SnorkelBase, snorkel_postgres, snorkel_packed_arrays
+from .packed import PackedIntArray, PackedStrArray
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship, backref
@@ -75,6 +77,16 @@ class Sentence(Context):
         dep_labels   = Column(postgresql.ARRAY(String))
         entity_cids  = Column(postgresql.ARRAY(String))
         entity_types = Column(postgresql.ARRAY(String))
+    elif snorkel_packed_arrays:
+        words        = Column(PackedStrArray, nullable=False)
+        char_offsets = Column(PackedIntArray, nullable=False)
+        lemmas       = Column(PackedStrArray)
+        pos_tags     = Column(PackedStrArray)
+        ner_tags     = Column(PackedStrArray)
+        dep_parents  = Column(PackedIntArray)
+        dep_labels   = Column(PackedStrArray)
+        entity_cids  = Column(PackedStrArray)
+        entity_types = Column(PackedStrArray)
     else:
         words        = Column(PickleType, nullable=False)
         char_offsets = Column(PickleType, nullable=False)
@@ -135,7 +147,12 @@ class TemporaryContext(object):
 
     A TemporaryContext must have specified equality / set membership semantics, a stable_id for checking
     uniqueness against the database, and a promote() method which returns a corresponding Context object.
+
+    TemporaryContexts are created in large numbers, so they use __slots__ rather than an instance __dict__;
+    the ORM-based subclasses still get a __dict__ from Context.
     """
+    __slots__ = ('id',)
+
     def __init__(self):
         self.id = None
 
@@ -180,9 +197,11 @@ class TemporaryContext(object):
 
 class TemporarySpan(TemporaryContext):
     """The TemporaryContext version of Span"""
+    __slots__ = ('sentence', 'char_start', 'char_end', 'meta', '_word_range')
+
     def __init__(self, sentence, char_start, char_end, meta=None):
         super(TemporarySpan, self).__init__()
-        self.sentence     = sentence  # The sentence Context of the Span
+        self.sentence   = sentence  # The sentence Context of the Span
         self.char_end   = char_end
         self.char_start = char_start
         self.meta       = meta
@@ -225,24 +244,35 @@ class TemporarySpan(TemporaryContext):
                 'char_end'  : self.char_end,
                 'meta'      : self.meta}
 
+    def _get_word_range(self):
+        """Returns the word start and end of the span, cached for as long as its char offsets are unchanged"""
+        try:
+            char_start, char_end, word_start, word_end = self._word_range
+            if char_start == self.char_start and char_end == self.char_end:
+                return word_start, word_end
+        except AttributeError:
+            pass
+        word_start = self.char_to_word_index(self.char_start)
+        word_end   = self.char_to_word_index(self.char_end)
+        self._word_range = (self.char_start, self.char_end, word_start, word_end)
+        return word_start, word_end
+
     def get_word_start(self):
-        return self.char_to_word_index(self.char_start)
+        return self._get_word_range()[0]
 
     def get_word_end(self):
-        return self.char_to_word_index(self.char_end)
+        return self._get_word_range()[1]
 
     def get_n(self):
-        return self.get_word_end() - self.get_word_start() + 1
+        word_start, word_end = self._get_word_range()
+        return word_end - word_start + 1
 
     def char_to_word_index(self, ci):
         """Given a character-level index (offset), return the index of the **word this char is in**"""
-        i = None
-        for i, co in enumerate(self.sentence.char_offsets):
-            if ci == co:
-                return i
-            elif ci < co:
-                return i-1
-        return i
+        char_offsets = self.sentence.char_offsets
+        if len(char_offsets) == 0:
+            return None
+        return bisect_right(char_offsets, ci) - 1
 
     def word_to_char_index(self, wi):
         """Given a word-level index, return the character-level index (offset) of the word's start"""
@@ -250,7 +280,8 @@ class TemporarySpan(TemporaryContext):
 
     def get_attrib_tokens(self, a='words'):
         """Get the tokens of sentence attribute _a_ over the range defined by word_offset, n"""
-        return self.sentence.__getattribute__(a)[self.get_word_start():self.get_word_end() + 1]
+        word_start, word_end = self._get_word_range()
+        return self.sentence.__getattribute__(a)[word_start:word_end + 1]
 
     def get_attrib_span(self, a, sep=" "):
         """Get the span of sentence attribute _a_ over the range defined by word_offset, n"""
@@ -13,6 +13,11 @@ snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and o
 snorkel_postgres = snorkel_conn_string.startswith('postgres')
 
 
+# Sets global variable indicating whether to store Sentence token arrays packed rather than pickled
+# when not using Postgres (which has native array types)
+snorkel_packed_arrays = not snorkel_postgres and os.environ.get('SNORKELPACKED', '') not in ('', '0')
+
+
 # Automatically turns on foreign key enforcement for SQLite
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
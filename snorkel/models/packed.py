@@ -0,0 +1,126 @@
+"""
+Compact binary column types for the token arrays of Sentences, used instead of PickleType on backends
+without native array types (e.g. SQLite) when SNORKELPACKED is set.
+
+Integer arrays (e.g. char_offsets, dep_parents) are stored as length-prefixed int32 arrays; string arrays
+(e.g. words, pos_tags, dep_labels) are dictionary-encoded as a length-prefixed table of the distinct strings
+followed by an array of ids into it. Values which cannot be packed this way, as well as rows written with
+PickleType, are stored / read as pickles, so the types can be switched on for an existing database.
+"""
+import cPickle
+import struct
+import sys
+from array import array
+from sqlalchemy.types import TypeDecorator, LargeBinary
+
+MAGIC     = 'SKPA'
+INT_ARRAY = 'i'
+STR_ARRAY = 's'
+
+_header   = struct.Struct('<4scI')
+_length   = struct.Struct('<i')
+_swap     = sys.byteorder != 'little'
+
+# array typecodes for 16- and 32-bit ints, whichever C types have those sizes on this platform
+_INT32  = [t for t in 'ilh' if array(t).itemsize == 4][0]
+_UINT16 = [t for t in 'HI' if array(t).itemsize == 2][0]
+_UINT32 = [t for t in 'ILH' if array(t).itemsize == 4][0]
+
+
+def _pack_array(a):
+    if _swap:
+        a.byteswap()
+    return a.tostring()
+
+
+def _unpack_array(typecode, data, start, n):
+    a = array(typecode)
+    a.fromstring(data[start:start + n * a.itemsize])
+    if _swap:
+        a.byteswap()
+    return a, start + n * a.itemsize
+
+
+def pack_int_array(values):
+    """Packs a sequence of ints into a length-prefixed int32 array"""
+    return _header.pack(MAGIC, INT_ARRAY, len(values)) + _pack_array(array(_INT32, values))
+
+
+def pack_str_array(values):
+    """Packs a sequence of strings (or None) into a dictionary of distinct strings and an array of ids"""
+    ids   = {}
+    vocab = []
+    for v in values:
+        if v not in ids:
+            ids[v] = len(vocab)
+            vocab.append(v)
+    chunks = [_header.pack(MAGIC, STR_ARRAY, len(vocab))]
+    for v in vocab:
+        if v is None:
+            chunks.append(_length.pack(-1))
+        else:
+            v = v.encode('utf-8')
+            chunks.append(_length.pack(len(v)))
+            chunks.append(v)
+    chunks.append(struct.pack('<I', len(values)))
+    chunks.append(_pack_array(array(_UINT16 if len(vocab) <= 0xFFFF else _UINT32, [ids[v] for v in values])))
+    return ''.join(chunks)
+
+
+def unpack_array(data):
+    """Unpacks the output of pack_int_array or pack_str_array into a list"""
+    data = str(data)
+    _, kind, n = _header.unpack_from(data)
+    k = _header.size
+    if kind == INT_ARRAY:
+        return _unpack_array(_INT32, data, k, n)[0].tolist()
+
+    # Decode the dictionary; each distinct string is then shared by all the tokens referring to it
+    vocab = []
+    for _ in xrange(n):
+        l, = _length.unpack_from(data, k)
+        k += _length.size
+        if l < 0:
+            vocab.append(None)
+        else:
+            vocab.append(data[k:k + l].decode('utf-8'))
+            k += l
+    m, = struct.unpack_from('<I', data, k)
+    ids, _ = _unpack_array(_UINT16 if n <= 0xFFFF else _UINT32, data, k + 4, m)
+    return [vocab[i] for i in ids]
+
+
+class PackedArray(TypeDecorator):
+    """Base type for packed token arrays, falling back to pickles for values which cannot be packed"""
+    impl = LargeBinary
+
+    def _pack(self, value):
+        raise NotImplementedError()
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return self._pack(value)
+        except (TypeError, struct.error, OverflowError, AttributeError, UnicodeError):
+            return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        value = str(value)
+        return unpack_array(value) if value.startswith(MAGIC) else cPickle.loads(value)
+
+
+class PackedIntArray(PackedArray):
+    """A list of ints, stored as an int32 array"""
+    def _pack(self, value):
+        return pack_int_array(value)
+
+
+class PackedStrArray(PackedArray):
+    """A list of strings (or None), stored dictionary-encoded"""
+    def _pack(self, value):
+        if not all(v is None or isinstance(v, basestring) for v in value):
+            raise TypeError("Not a list of strings")
+        return pack_str_array(value)
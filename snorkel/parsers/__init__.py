@@ -1,4 +1,5 @@
 from .parser import *
+from .cache import *
 from .doc_preprocessors import *
 from .corenlp import *
 from .spacy import *
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import cPickle
+import errno
+import hashlib
+import os
+import tempfile
+import zlib
+
+from ..models import construct_stable_id, split_stable_id
+
+
+class ParseCache(object):
+    '''
+    Content-addressed on-disk cache of parses. Entries are keyed by a hash of the document text and of the
+    parser configuration (see Parser.cache_key), and hold the sentence parts of the document, compressed.
+    When the cache grows over max_bytes, the least recently used entries are evicted.
+
+    Example::
+
+        cache = ParseCache('parse_cache', max_bytes=2 * 1024**3)
+        CorpusParser(parser, cache=cache).apply(doc_preprocessor)
+    '''
+    def __init__(self, path, max_bytes=1024**3):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.n_bytes   = None
+        self.hits      = 0
+        self.misses    = 0
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, parser, text):
+        '''
+        Cache key of a text parsed with parser
+        :param parser:
+        :param text:
+        :return:
+        '''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        h = hashlib.sha1(parser.cache_key().encode('utf-8'))
+        h.update('\0')
+        h.update(text)
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        '''
+        Return the cached record for key, or None
+        :param key:
+        :return:
+        '''
+        fpath = self._entry_path(key)
+        try:
+            with open(fpath, 'rb') as f:
+                record = cPickle.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, zlib.error, cPickle.UnpicklingError, EOFError):
+            self.misses += 1
+            return None
+
+        # Mark as recently used, for eviction
+        try:
+            os.utime(fpath, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return record
+
+    def put(self, key, record):
+        '''
+        Store a record, evicting least recently used entries if the cache is over its size bound
+        :param key:
+        :param record:
+        :return:
+        '''
+        data  = zlib.compress(cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL))
+        fpath = self._entry_path(key)
+        fdir  = os.path.dirname(fpath)
+        if not os.path.exists(fdir):
+            try:
+                os.makedirs(fdir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Write to a temporary file and rename it, so that concurrent readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=fdir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, fpath)
+
+        if self.n_bytes is None:
+            self.n_bytes = self._size()
+        else:
+            self.n_bytes += len(data)
+        if self.n_bytes > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for d in os.listdir(self.path):
+            dpath = os.path.join(self.path, d)
+            if os.path.isdir(dpath):
+                for name in os.listdir(dpath):
+                    yield os.path.join(dpath, name)
+
+    def _size(self):
+        n = 0
+        for fpath in self._entries():
+            try:
+                n += os.path.getsize(fpath)
+            except OSError:
+                pass
+        return n
+
+    def evict(self, target=0.9):
+        '''
+        Delete the least recently used entries until the cache is under target * max_bytes
+        :param target:
+        :return:
+        '''
+        entries = []
+        for fpath in self._entries():
+            try:
+                st = os.stat(fpath)
+                entries.append((st.st_mtime, st.st_size, fpath))
+            except OSError:
+                pass
+        entries.sort()
+        self.n_bytes = sum(size for _, size, _ in entries)
+        for _, size, fpath in entries:
+            if self.n_bytes <= target * self.max_bytes:
+                break
+            try:
+                os.remove(fpath)
+                self.n_bytes -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        '''
+        Delete all entries
+        :return:
+        '''
+        for fpath in list(self._entries()):
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+        self.n_bytes = 0
+
+
+def _to_record(document, sentences, meta_keys=('tree', 'abs_sent_offset')):
+    '''
+    Document-independent record of the parts of a document's sentences and of its parse meta data;
+    stable ids are stored as character offsets relative to the document
+    :param document:
+    :param sentences:
+    :param meta_keys:
+    :return:
+    '''
+    doc_start  = split_stable_id(document.stable_id)[2] if document is not None else 0
+    parts_list = []
+    for parts in sentences:
+        parts     = dict(parts)
+        stable_id = parts.pop('stable_id', None)
+        parts.pop('document', None)
+        if stable_id is not None:
+            _, _, start, end = split_stable_id(stable_id)
+            parts['_stable_span'] = (start - doc_start, end - doc_start)
+        else:
+            parts['_stable_span'] = None
+        parts_list.append(parts)
+
+    meta = {}
+    if document is not None and document.meta is not None:
+        positions = [parts['position'] for parts in parts_list]
+        for k in meta_keys:
+            if k in document.meta:
+                meta[k] = dict((i, document.meta[k][i]) for i in positions if i in document.meta[k])
+    return {'sentences': parts_list, 'meta': meta}
+
+
+def _from_record(document, record):
+    '''
+    Sentence parts of a document from a cached record; the document's parse meta data is restored too
+    :param document:
+    :param record:
+    :return:
+    '''
+    if document is not None:
+        if document.meta is None:
+            document.meta = {}
+        for k, values in record['meta'].items():
+            document.meta.setdefault(k, {}).update(values)
+    for parts in record['sentences']:
+        parts = dict(parts)
+        span  = parts.pop('_stable_span')
+        parts['document'] = document
+        if document is not None and span is not None:
+            parts['stable_id'] = construct_stable_id(document, 'sentence', span[0], span[1])
+        yield parts
+
+
+class CachedParserConnection(object):
+    '''
+    Parser connection answering from a ParseCache, and passing the documents not in the cache on
+    to an underlying connection (in one call, so that it can still pipeline or join requests)
+    '''
+    def __init__(self, connection, cache):
+        self.connection = connection
+        self.parser     = connection.parser
+        self.cache      = cache
+
+    def parse(self, document, text):
+        for _, parts in self.parse_docs([(document, text)]):
+            yield parts
+
+    def parse_docs(self, docs):
+        '''
+        Parse a sequence of (document, text) pairs, yielding (document, parts) pairs in document order
+        :param docs:
+        :return:
+        '''
+        docs    = list(docs)
+        keys    = [self.cache.key(self.parser, text) for _, text in docs]
+        records = [self.cache.get(key) for key in keys]
+
+        # Parse all the misses with one call, and cache their sentences
+        misses = [i for i, record in enumerate(records) if record is None]
+        parsed = dict((i, []) for i in misses)
+        if len(misses) > 0:
+            # The connection yields documents in order, skipping those without sentences
+            k = 0
+            for document, parts in self.connection.parse_docs([docs[i] for i in misses]):
+                while docs[misses[k]][0] is not document:
+                    k += 1
+                parsed[misses[k]].append(parts)
+            for i in misses:
+                self.cache.put(keys[i], _to_record(docs[i][0], parsed[i]))
+
+        for i, (document, _) in enumerate(docs):
+            sentences = parsed[i] if i in parsed else _from_record(document, records[i])
+            for parts in sentences:
+                yield document, parts
+
+    def close(self):
+        if hasattr(self.connection, 'close'):
+            self.connection.close()
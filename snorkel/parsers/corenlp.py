@@ -1,18 +1,39 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import sys
 import json
 import signal
+import threading
+import time
 import warnings
+import requests
 
 from subprocess import Popen,PIPE
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from multiprocessing import Array
 
-from .parser import Parser, URLParserConnection
+from .parser import Parser, URLParserConnection, AsyncURLParserConnection
 from ..models import Candidate, Context, Document, Sentence, construct_stable_id
 from ..utils import sort_X_on_Y
 
 
+class DocumentChunk(object):
+    '''
+    Chunk of a long document starting at character offset start; the chunks of a document share state,
+    which holds the position of the next sentence
+    '''
+    def __init__(self, document, start, state):
+        self.document = document
+        self.start    = start
+        self.state    = state
+
+    @property
+    def name(self):
+        return self.document.name if self.document else "?"
+
+
 class StanfordCoreNLPServer(Parser):
     '''
     Stanford CoreNLP Server
@@ -44,12 +65,30 @@ class StanfordCoreNLPServer(Parser):
     # Penn TreeBank normalized tokens
     PTB = {'-RRB-': ')', '-LRB-': '(', '-RCB-': '}', '-LCB-': '{', '-RSB-': ']', '-LSB-': '['}
 
+    # Separator between documents joined in one request; blank lines are sentence breaks by default
+    DOC_SEPARATOR = u'\n\n'
+
+    # Characters outside the Basic Multilingual Plane, which CoreNLP's character offsets (Java UTF-16 code units)
+    # count as two characters; narrow Python builds count them as two characters too
+    ASTRAL = re.compile(u'[\U00010000-\U0010FFFF]') if sys.maxunicode > 0xFFFF else None
+
+    # Request properties of each supported output format
+    OUTPUT_FORMATS = {"json": '"outputFormat": "json"',
+                      "serialized": '"outputFormat": "serialized", '
+                                    '"serializer": "edu.stanford.nlp.pipeline.ProtobufAnnotationSerializer"'}
+
+    # Chunk boundaries of long documents, by order of preference: paragraphs, sentence ends, whitespace
+    CHUNK_BOUNDARIES = [re.compile(r'\n[ \t\r\f\v]*\n\s*'),
+                        re.compile(r'[.!?]["\')\]]*\s+'),
+                        re.compile(r'\s+')]
+
     # CoreNLP changed some JSON element names across versions
     BLOCK_DEFS = {"3.6.0":"basic-dependencies", "3.7.0":"basicDependencies"}
 
     def __init__(self, annotators=['tokenize', 'ssplit', 'pos', 'lemma', 'depparse', 'ner'],
                  annotator_opts={}, tokenize_whitespace=False, split_newline=False,
-                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0'):
+                 java_xmx='4g', port=12345, num_threads=1, verbose=False, version='3.6.0', parse_window=None,
+                 docs_per_request=1, batch_chars=50000, output_format='json', chunk_chars=100000):
         '''
         Create CoreNLP server instance.
         :param annotators:
@@ -61,6 +100,14 @@ class StanfordCoreNLPServer(Parser):
         :param num_threads:
         :param verbose:
         :param version:
+        :param parse_window: number of concurrent requests per connection, defaults to num_threads
+        :param docs_per_request: number of (short) documents joined into one request
+        :param batch_chars: maximum number of characters of a request joining several documents
+        :param output_format: 'json', or 'serialized' for CoreNLP's binary protobuf output (requires the
+                              corenlp_protobuf package)
+        :param chunk_chars: documents longer than this are split into chunks of at most chunk_chars characters,
+                            parsed in separate requests; defaults to CoreNLP's limit of 100K characters per
+                            request, so that only documents the server would reject are split
         '''
         super(StanfordCoreNLPServer,self).__init__(name="CoreNLP")
 
@@ -75,10 +122,17 @@ class StanfordCoreNLPServer(Parser):
         self.num_threads = num_threads
         self.verbose = verbose
         self.version = version
+        self.parse_window = parse_window if parse_window is not None else num_threads
+        self.docs_per_request = docs_per_request
+        self.batch_chars = batch_chars
+        self.output_format = output_format
+        self.chunk_chars = chunk_chars
+        if output_format not in StanfordCoreNLPServer.OUTPUT_FORMATS:
+            raise ValueError("Unknown output format {}".format(output_format))
 
         # configure connection request options
-        opts = self._conn_opts(annotators, annotator_opts, tokenize_whitespace, split_newline)
-        self.endpoint = 'http://127.0.0.1:%d/?%s' % (self.port, opts)
+        self.opts = self._conn_opts(annotators, annotator_opts, tokenize_whitespace, split_newline)
+        self.endpoint = 'http://127.0.0.1:%d/?%s' % (self.port, self.opts)
 
         self._start_server()
 
@@ -91,19 +145,34 @@ class StanfordCoreNLPServer(Parser):
         :param force_load:  Force server to pre-load models vs. on-demand
         :return:
         '''
+        self.process_group = self._launch(self.port)
+
+        if force_load:
+            conn = self.connect()
+            text = "This forces the server to preload all models."
+            parts = list(conn.parse(None, text))
+
+    def _launch(self, port):
+        '''
+        Launch a CoreNLP server process listening on port
+        :param port:
+        :return: the Popen object of the server's process group
+        '''
         loc = os.path.join(os.environ['SNORKELHOME'], 'parser')
         cmd = 'java -Xmx%s -cp "%s/*" edu.stanford.nlp.pipeline.StanfordCoreNLPServer --port %d --timeout %d --threads %d > /dev/null'
-        cmd = [cmd % (self.java_xmx, loc, self.port, self.timeout, self.num_threads)]
+        cmd = [cmd % (self.java_xmx, loc, port, self.timeout, self.num_threads)]
 
         # Setting shell=True returns only the pid of the screen, not any spawned child processes
         # Killing child processes correctly requires using a process group
         # http://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-        self.process_group = Popen(cmd, stdout=PIPE, shell=True, preexec_fn=os.setsid)
+        return Popen(cmd, stdout=PIPE, shell=True, preexec_fn=os.setsid)
 
-        if force_load:
-            conn = self.connect()
-            text = "This forces the server to preload all models."
-            parts = list(conn.parse(None, text))
+    def cache_key(self):
+        '''
+        The parser version, request options and chunking of long documents determine a parse
+        :return:
+        '''
+        return "%s:%s:%s:%d" % (self.name, self.version, self.opts, self.chunk_chars)
 
     def _conn_opts(self, annotators, annotator_opts, tokenize_whitespace, split_newline):
         '''
@@ -144,7 +213,7 @@ class StanfordCoreNLPServer(Parser):
 
         props = []
         props += ['"annotators": {}'.format('"{}"'.format(",".join(annotators)))]
-        props += ['"outputFormat": "json"']
+        props += [StanfordCoreNLPServer.OUTPUT_FORMATS[self.output_format]]
         props += [",".join(opts)] if opts else []
         return ",".join(props)
 
@@ -167,15 +236,12 @@ class StanfordCoreNLPServer(Parser):
         print "port:", self.port
         print "timeout:", self.timeout
         print "threads:", self.num_threads
+        print "parse window:", self.parse_window
+        print "docs per request:", self.docs_per_request
+        print "output format:", self.output_format
+        print "chunk chars:", self.chunk_chars
         print "------------------------------------"
 
-    def connect(self):
-        '''
-        Return URL connection object for this server
-        :return:
-        '''
-        return URLParserConnection(self)
-
     def close(self):
         '''
         Kill the process group linked with this server.
@@ -189,6 +255,16 @@ class StanfordCoreNLPServer(Parser):
             except Exception as e:
                 sys.stderr.write('Could not kill CoreNLP server [{}] {}\n'.format(self.process_group.pid,e))
 
+    def connect(self):
+        '''
+        Return URL connection object for this server; with a parse window > 1, the connection
+        keeps that many requests in flight when parsing several documents
+        :return:
+        '''
+        if self.parse_window > 1:
+            return AsyncURLParserConnection(self, window=self.parse_window)
+        return URLParserConnection(self)
+
     def parse(self, document, text, conn):
         '''
         Parse CoreNLP JSON results. Requires an external connection/request object to remain threadsafe
@@ -198,26 +274,291 @@ class StanfordCoreNLPServer(Parser):
         :param conn: server URL+properties string
         :return:
         '''
-        if len(text.strip()) == 0:
-            print>> sys.stderr, "Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?")
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8')
+        if len(text) > self.chunk_chars:
+            return self._parse_chunked(document, text, conn)
+        return self.parse_response(document, text, self.request(document, text, conn))
+
+    def _parse_chunked(self, document, text, conn):
+        for group in self.group_docs([(document, text)]):
+            for _, parts in self.parse_docs_response(group, self.request_docs(group, conn)):
+                yield parts
+
+    def split_text(self, text):
+        '''
+        Split a long text into chunks of at most chunk_chars characters, at the last paragraph break of
+        each chunk, or else at its last sentence end, or else at its last whitespace
+        :param text:
+        :return: start offsets of the chunks
+        '''
+        starts = [0]
+        while len(text) - starts[-1] > self.chunk_chars:
+            start  = starts[-1]
+            window = text[start:start + self.chunk_chars]
+            cut    = self.chunk_chars
+            for boundary in StanfordCoreNLPServer.CHUNK_BOUNDARIES:
+                ends = [m.end() for m in boundary.finditer(window, self.chunk_chars / 4)]
+                if len(ends) > 0:
+                    cut = ends[-1]
+                    break
+            starts.append(start + cut)
+        return starts
+
+    def group_docs(self, docs):
+        '''
+        Group a sequence of (document, text) pairs into the lists of documents sent in one request each:
+        up to docs_per_request documents, and up to batch_chars characters unless a single document is longer
+        :param docs:
+        :return:
+        '''
+        group, n_chars = [], 0
+        for document, text in docs:
+            if not isinstance(text, unicode):
+                text = text.decode('utf-8')
+            # Long documents are split into chunks, each sent in its own request
+            if len(text) > self.chunk_chars:
+                if len(group) > 0:
+                    yield group
+                    group, n_chars = [], 0
+                starts = self.split_text(text)
+                state  = {'position': 0}
+                for start, end in zip(starts, starts[1:] + [len(text)]):
+                    yield [(DocumentChunk(document, start, state), text[start:end])]
+                continue
+            if len(group) > 0 and (len(group) >= self.docs_per_request or n_chars + len(text) > self.batch_chars):
+                yield group
+                group, n_chars = [], 0
+            group.append((document, text))
+            n_chars += len(text) + len(StanfordCoreNLPServer.DOC_SEPARATOR)
+        if len(group) > 0:
+            yield group
+
+    def request_docs(self, docs, conn):
+        '''
+        Send a group of documents to the server in one request, joined by DOC_SEPARATOR;
+        returns the raw response content (or None if all documents are empty)
+        :param docs: list of (document, text) pairs
+        :param conn:
+        :return:
+        '''
+        if len(docs) == 1:
+            return self.request(docs[0][0], docs[0][1], conn)
+        texts = [text for _, text in docs if len(text.strip()) > 0]
+        if len(texts) == 0:
+            return None
+        texts = [text if isinstance(text, unicode) else text.decode('utf-8') for text in texts]
+        return self.request(None, StanfordCoreNLPServer.DOC_SEPARATOR.join(texts), conn)
+
+    def parse_docs_response(self, docs, content):
+        '''
+        Split the response to request_docs back into the sentence dicts of each document, yielding
+        (document, parts) pairs in document order
+        :param docs: list of (document, text) pairs
+        :param content:
+        :return:
+        '''
+        if len(docs) == 1 and isinstance(docs[0][0], DocumentChunk):
+            chunk, text = docs[0]
+            if content is None:
+                return
+            for parts in self.parse_response(chunk.document, text, content, offset=-chunk.start,
+                                             position=chunk.state['position']):
+                chunk.state['position'] += 1
+                yield chunk.document, parts
+            return
+        if len(docs) == 1:
+            for parts in self.parse_response(docs[0][0], docs[0][1], content):
+                yield docs[0][0], parts
             return
 
+        # Character offset of each non-empty document in the joined text
+        starts, packed, texts = [], [], []
+        offset = 0
+        for document, text in docs:
+            if len(text.strip()) == 0:
+                print>> sys.stderr, "Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?")
+                continue
+            if not isinstance(text, unicode):
+                text = text.decode('utf-8')
+            starts.append(offset)
+            packed.append(document)
+            texts.append(text)
+            offset += len(text) + len(StanfordCoreNLPServer.DOC_SEPARATOR)
+        if len(packed) == 0:
+            return
+
+        StanfordCoreNLPServer.validate_response(content)
+        try:
+            blocks = self.load_blocks(content)
+        except:
+            warnings.warn("CoreNLP skipped a malformed batch of {} documents.".format(len(packed)), RuntimeWarning)
+            return
+
+        blocks     = self.text_offsets(blocks, StanfordCoreNLPServer.DOC_SEPARATOR.join(texts))
+        doc_blocks = self._split_blocks(blocks, starts)
+        for document, start, blocks in zip(packed, starts, doc_blocks):
+            for parts in self.parse_blocks(document, blocks, offset=start):
+                yield document, parts
+
+    def text_offsets(self, blocks, text):
+        '''
+        Convert the token character offsets of sentence blocks, which CoreNLP counts in UTF-16 code units
+        (Java characters), into indices of the unicode text sent to the server
+        :param blocks:
+        :param text:
+        :return:
+        '''
+        if StanfordCoreNLPServer.ASTRAL is None:
+            return blocks
+        # UTF-16 offset of each astral character, which is one code unit further for each one before it
+        units = [m.start() + k for k, m in enumerate(StanfordCoreNLPServer.ASTRAL.finditer(text))]
+        if len(units) == 0:
+            return blocks
+        for block in blocks:
+            for tok in block['tokens']:
+                tok['characterOffsetBegin'] -= bisect_left(units, tok['characterOffsetBegin'])
+                if 'characterOffsetEnd' in tok:
+                    tok['characterOffsetEnd'] -= bisect_left(units, tok['characterOffsetEnd'])
+        return blocks
+
+    def _split_blocks(self, blocks, starts):
+        '''
+        Assign the sentence blocks of a joined request to documents by the offsets of their tokens.
+        A sentence spanning documents (e.g. if blank lines are not sentence breaks) is cut at the document
+        boundaries, and dependencies across the cut are made roots.
+        :param blocks:
+        :param starts:
+        :return:
+        '''
+        dep_key    = StanfordCoreNLPServer.BLOCK_DEFS[self.version]
+        doc_blocks = [[] for _ in starts]
+        for block in blocks:
+            groups = defaultdict(list)
+            for tok in block['tokens']:
+                groups[bisect_right(starts, tok['characterOffsetBegin']) - 1].append(tok)
+            if len(groups) == 1:
+                doc_blocks[groups.keys()[0]].append(block)
+                continue
+            deps = dict((d['dependent'], d) for d in block[dep_key])
+            for k in sorted(groups):
+                index    = dict((t['index'], i + 1) for i, t in enumerate(groups[k]))
+                sub_deps = []
+                for t in groups[k]:
+                    d = deps[t['index']]
+                    sub_deps.append({'dep': d['dep'] if d['governor'] in index else 'ROOT',
+                                     'governor': index.get(d['governor'], 0), 'dependent': index[t['index']]})
+                tokens = [dict(t, index=index[t['index']]) for t in groups[k]]
+                doc_blocks[k].append({'tokens': tokens, dep_key: sub_deps})
+        return doc_blocks
+
+    def request(self, document, text, conn):
+        '''
+        Send text to the server, returning the raw response content (or None for empty documents).
+        Does not touch the document, so it can run in a separate thread
+
+        :param document:
+        :param text:
+        :param conn: server URL+properties string
+        :return:
+        '''
+        if len(text.strip()) == 0:
+            return None
         if isinstance(text, unicode):
             text = text.encode('utf-8', 'error')
         resp = conn.post(self.endpoint, data=text, allow_redirects=True)
-        text = text.decode('utf-8')
-        content = resp.content.strip()
+        # Serialized responses are binary
+        return resp.content.strip() if self.output_format == 'json' else resp.content
+
+    def parse_response(self, document, text, content, offset=0, position=0):
+        '''
+        Parse the CoreNLP JSON response content for the text of a document into sentence dicts
+
+        :param document:
+        :param text:
+        :param content: response content returned by request()
+        :param offset: see parse_blocks
+        :param position: see parse_blocks
+        :return:
+        '''
+        if content is None:
+            print>> sys.stderr, "Warning, empty document {0} passed to CoreNLP".format(document.name if document else "?")
+            return
+
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8')
 
         # check for parsing error messages
         StanfordCoreNLPServer.validate_response(content)
 
         try:
-            blocks = json.loads(content, strict=False)['sentences']
+            blocks = self.load_blocks(content)
         except:
             warnings.warn("CoreNLP skipped a malformed sentence.\n{}".format(text), RuntimeWarning)
             return
 
-        position = 0
+        blocks = self.text_offsets(blocks, text)
+        for parts in self.parse_blocks(document, blocks, offset=offset, position=position):
+            yield parts
+
+    def load_blocks(self, content):
+        '''
+        Decode the sentence blocks of a response, in the JSON output format
+        :param content:
+        :return:
+        '''
+        if self.output_format == 'json':
+            return json.loads(content, strict=False)['sentences']
+        return self._protobuf_blocks(content)
+
+    def _protobuf_blocks(self, content):
+        '''
+        Decode a serialized (protobuf) response into sentence blocks holding only the fields
+        used by parse_blocks, in the JSON output format
+        :param content:
+        :return:
+        '''
+        from corenlp_protobuf import Document as ProtobufDocument, parseFromDelimitedString
+        doc = ProtobufDocument()
+        parseFromDelimitedString(doc, content)
+
+        dep_key = StanfordCoreNLPServer.BLOCK_DEFS[self.version]
+        blocks  = []
+        for sent in doc.sentence:
+            tokens = [{'index': i + 1, 'word': tok.word, 'lemma': tok.lemma, 'pos': tok.pos, 'ner': tok.ner,
+                       'originalText': tok.originalText, 'characterOffsetBegin': tok.beginChar}
+                      for i, tok in enumerate(sent.token)]
+            graph = sent.basicDependencies
+            deps  = [{'dep': 'ROOT', 'governor': 0, 'dependent': r} for r in graph.root]
+            deps += [{'dep': e.dep, 'governor': e.source, 'dependent': e.target} for e in graph.edge]
+            block = {'tokens': tokens, dep_key: deps}
+            if sent.HasField('parseTree'):
+                block['parse'] = StanfordCoreNLPServer._tree_string(sent.parseTree)
+            blocks.append(block)
+        return blocks
+
+    @staticmethod
+    def _tree_string(tree):
+        '''
+        Bracketed string of a protobuf parse tree
+        :param tree:
+        :return:
+        '''
+        if len(tree.child) == 0:
+            return tree.value
+        return "(%s %s)" % (tree.value, " ".join(StanfordCoreNLPServer._tree_string(c) for c in tree.child))
+
+    def parse_blocks(self, document, blocks, offset=0, position=0):
+        '''
+        Convert the CoreNLP JSON sentence blocks of a document into sentence dicts
+
+        :param document:
+        :param blocks:
+        :param offset: character offset of the document in the text sent to the server (negative for a chunk
+                       of the document); token offsets must be indices of that text (see text_offsets)
+        :param position: position of the first sentence
+        :return:
+        '''
         for block in blocks:
             parts = defaultdict(list)
             dep_order, dep_par, dep_lab = [], [], []
@@ -227,7 +568,7 @@ class StanfordCoreNLPServer(Parser):
                 parts['lemmas'].append(StanfordCoreNLPServer.PTB.get(tok['lemma'], tok['lemma']))
                 parts['pos_tags'].append(tok['pos'])
                 parts['ner_tags'].append(tok['ner'])
-                parts['char_offsets'].append(tok['characterOffsetBegin'])
+                parts['char_offsets'].append(tok['characterOffsetBegin'] - offset)
                 dep_par.append(deps['governor'])
                 dep_lab.append(deps['dep'])
                 dep_order.append(deps['dependent'])
@@ -289,4 +630,231 @@ class StanfordCoreNLPServer(Parser):
         if content.startswith("Request is too long"):
             raise ValueError("File too long. Max character count is 100K.")
         if content.startswith("CoreNLP request timed out"):
-            raise ValueError("CoreNLP request timed out on file.")
\ No newline at end of file
+            raise ValueError("CoreNLP request timed out on file.")
+
+class StanfordCoreNLPServerPool(StanfordCoreNLPServer):
+    '''
+    Pool of Stanford CoreNLP servers on consecutive ports, starting at port
+
+    Requests go to the server with the fewest outstanding requests, counted across all the processes
+    (e.g. CorpusParser UDFs) forked from the one creating the pool. A monitor thread health-checks the
+    servers every health_interval seconds. Servers which do not respond are avoided until they do again
+    (CoreNLP answers health checks from the same threads as parse requests, so a busy server can be slow
+    to respond), and are restarted in the background if they died, or if they still do not respond after
+    max_failures checks without outstanding requests.
+
+    Example::
+
+        parser = StanfordCoreNLPServerPool(num_servers=8, num_threads=4)
+        CorpusParser(parser).apply(doc_preprocessor, parallelism=16)
+    '''
+    def __init__(self, num_servers=2, port=12345, ready_timeout=600, health_interval=30, max_failures=3,
+                 **kwargs):
+        '''
+        :param num_servers: number of server processes
+        :param port: port of the first server
+        :param ready_timeout: seconds to wait for servers to respond after (re)starting them
+        :param health_interval: seconds between health checks
+        :param max_failures: consecutive failed health checks, without outstanding requests, before a server
+                             which is still running is restarted
+        :param kwargs: StanfordCoreNLPServer parameters, shared by all the servers
+        '''
+        self.num_servers     = num_servers
+        self.ports           = [port + i for i in range(num_servers)]
+        self.ready_timeout   = ready_timeout
+        self.health_interval = health_interval
+        self.max_failures    = max_failures
+        self.process_groups  = [None] * num_servers
+        self.failures        = [0] * num_servers
+        self.restarts        = [None] * num_servers
+        self.monitor         = None
+        self.monitor_stop    = threading.Event()
+
+        # Shared with forked processes: outstanding requests and health of each server
+        self.outstanding = Array('i', num_servers)
+        self.healthy     = Array('b', num_servers)
+
+        # Keep enough requests in flight to occupy every server
+        if kwargs.get('parse_window') is None:
+            kwargs['parse_window'] = kwargs.get('num_threads', 1) * num_servers
+        super(StanfordCoreNLPServerPool, self).__init__(port=port, **kwargs)
+
+    def _start_server(self, force_load=False):
+        '''
+        Launch all the servers, wait until they respond and start the health-check monitor
+        :param force_load:
+        :return:
+        '''
+        self.endpoints = ['http://127.0.0.1:%d/?%s' % (p, self.opts) for p in self.ports]
+        for i, port in enumerate(self.ports):
+            self.process_groups[i] = self._launch(port)
+        self.process_group = self.process_groups[0]
+        for i in range(self.num_servers):
+            self.healthy[i] = self.wait_ready(i)
+
+        self.monitor = threading.Thread(target=self._monitor)
+        self.monitor.daemon = True
+        self.monitor.start()
+
+        if force_load:
+            text = "This forces the server to preload all models."
+            for endpoint in self.endpoints:
+                requests.post(endpoint, data=text)
+
+    def is_alive(self, i, timeout=5):
+        '''
+        Check that server i is running and answers HTTP requests
+        :param i:
+        :param timeout:
+        :return:
+        '''
+        if self.process_groups[i] is None or self.process_groups[i].poll() is not None:
+            return False
+        try:
+            requests.get('http://127.0.0.1:%d/' % self.ports[i], timeout=timeout)
+            return True
+        except requests.exceptions.RequestException:
+            return False
+
+    def wait_ready(self, i):
+        '''
+        Wait up to ready_timeout seconds for server i to respond
+        :param i:
+        :return: whether the server is ready
+        '''
+        t = time.time()
+        while time.time() - t < self.ready_timeout and not self.monitor_stop.is_set():
+            if self.process_groups[i].poll() is not None:
+                break
+            if self.is_alive(i, timeout=1):
+                return True
+            time.sleep(0.5)
+        if not self.monitor_stop.is_set():
+            sys.stderr.write('CoreNLP server on port {} is not ready\n'.format(self.ports[i]))
+        return False
+
+    def restart(self, i):
+        '''
+        Kill and relaunch server i
+        :param i:
+        :return:
+        '''
+        self.healthy[i] = False
+        if self.monitor_stop.is_set():
+            return
+        if self.verbose:
+            print "Restarting CoreNLP server on port {}...".format(self.ports[i])
+        if self.process_groups[i] is not None and self.process_groups[i].poll() is None:
+            self._kill(self.process_groups[i])
+        self.process_groups[i] = self._launch(self.ports[i])
+        if i == 0:
+            self.process_group = self.process_groups[0]
+        self.failures[i] = 0
+        self.healthy[i]  = self.wait_ready(i)
+
+    def check(self, i):
+        '''
+        Health-check server i: a server which does not respond is marked unhealthy, so that requests avoid it,
+        and is restarted (in a background thread) only if its process exited, or if it failed max_failures
+        checks in a row without outstanding requests
+        :param i:
+        :return:
+        '''
+        if self.restarts[i] is not None and self.restarts[i].is_alive():
+            return
+        if self.is_alive(i):
+            self.failures[i] = 0
+            self.healthy[i]  = True
+            return
+        self.healthy[i]   = False
+        self.failures[i] += 1
+        exited = self.process_groups[i] is None or self.process_groups[i].poll() is not None
+        if exited or (self.failures[i] >= self.max_failures and self.outstanding[i] == 0):
+            self.restarts[i] = threading.Thread(target=self.restart, args=(i,))
+            self.restarts[i].daemon = True
+            self.restarts[i].start()
+
+    def _monitor(self):
+        while not self.monitor_stop.wait(self.health_interval):
+            for i in range(self.num_servers):
+                if self.monitor_stop.is_set():
+                    return
+                self.check(i)
+
+    def _acquire(self, exclude=()):
+        '''
+        Pick the healthy server with the fewest outstanding requests (any server if none is healthy)
+        :param exclude: servers not to pick
+        :return:
+        '''
+        with self.outstanding.get_lock():
+            servers = [i for i in range(self.num_servers) if i not in exclude]
+            healthy = [i for i in servers if self.healthy[i]]
+            i = min(healthy or servers, key=lambda j: self.outstanding[j])
+            self.outstanding[i] += 1
+        return i
+
+    def _release(self, i):
+        with self.outstanding.get_lock():
+            self.outstanding[i] -= 1
+
+    def request(self, document, text, conn):
+        '''
+        Send text to the least busy server, failing over to the others if it cannot be reached
+        :param document:
+        :param text:
+        :param conn:
+        :return:
+        '''
+        if len(text.strip()) == 0:
+            return None
+        if isinstance(text, unicode):
+            text = text.encode('utf-8', 'error')
+        tried = set()
+        while True:
+            i = self._acquire(exclude=tried)
+            try:
+                resp = conn.post(self.endpoints[i], data=text, allow_redirects=True)
+                return resp.content.strip() if self.output_format == 'json' else resp.content
+            except requests.exceptions.ConnectionError:
+                tried.add(i)
+                if len(tried) == self.num_servers:
+                    raise
+            finally:
+                self._release(i)
+
+    def _kill(self, process_group):
+        if process_group is None:
+            return
+        try:
+            os.killpg(os.getpgid(process_group.pid), signal.SIGTERM)
+        except Exception as e:
+            sys.stderr.write('Could not kill CoreNLP server [{}] {}\n'.format(process_group.pid, e))
+
+    def summary(self):
+        '''
+        Print pool parameters
+        :return:
+        '''
+        super(StanfordCoreNLPServerPool, self).summary()
+        print "servers:", self.num_servers
+        print "ports:", ", ".join(str(p) for p in self.ports)
+        print "shell pids:", ", ".join(str(p.pid) for p in self.process_groups if p is not None)
+        print "------------------------------------"
+
+    def close(self):
+        '''
+        Stop the monitor and kill all the servers
+        :return:
+        '''
+        self.monitor_stop.set()
+        self.monitor = None
+        for restart in self.restarts:
+            if restart is not None:
+                restart.join()
+        for i, process_group in enumerate(self.process_groups):
+            if self.verbose and process_group is not None:
+                print "Killing CoreNLP server [{}]...".format(process_group.pid)
+            self._kill(process_group)
+            self.process_groups[i] = None
+        self.process_group = None
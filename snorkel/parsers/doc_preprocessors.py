@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import atexit
+import bz2
 import codecs
 import glob
+import gzip
+import io
 import json
 import os
 import re
 import signal
 import sys
+import tarfile
 import warnings
 import requests
 import lxml.etree as et
@@ -17,18 +21,67 @@ except:
     print>>sys.stderr,"Warning, unable to load 'spaCy' module"
 
 from bs4 import BeautifulSoup
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from .cache import CachedParserConnection
 from .corenlp import StanfordCoreNLPServer
 from ..models import Candidate, Context, Document, Sentence, construct_stable_id
 from ..udf import UDF, UDFRunner
+from ..utils import ProgressBar
 
 
 class CorpusParser(UDFRunner):
 
-    def __init__(self, parser=None, fn=None):
+    def __init__(self, parser=None, fn=None, batch_size=None, cache=None):
+        '''
+        :param parser:
+        :param fn: function applied to the parts of each sentence
+        :param batch_size: number of documents per batch passed to a connection
+        :param cache: ParseCache of previously parsed documents
+        '''
         self.parser = StanfordCoreNLPServer() if not parser else parser
+        # Documents are passed to the UDFs in batches, so that a connection can pipeline requests
+        # (or a parser such as spaCy process documents in batches) within a batch
+        if batch_size is None:
+            batch_size = getattr(self.parser, 'batch_size', None) or 4 * getattr(self.parser, 'parse_window', 1)
+        self.batch_size = batch_size
+        self.cache = cache
         super(CorpusParser, self).__init__(CorpusParserUDF,
                                            parser=self.parser,
-                                           fn=fn)
+                                           fn=fn,
+                                           cache=cache)
+
+    def apply(self, xs, count=None, parallelism=None, progress_bar=True, **kwargs):
+        if count is None and hasattr(xs, '__len__'):
+            count = len(xs)
+
+        # Streaming parsers are passed the whole corpus as a single batch, with the progress bar counting documents
+        if self.parser.stream_docs and self.cache is None and (parallelism is None or parallelism < 2):
+            if progress_bar and count is not None:
+                xs = self._progress(xs, count)
+            super(CorpusParser, self).apply([xs], count=1, parallelism=parallelism, progress_bar=False, **kwargs)
+            return
+        count = (count + self.batch_size - 1) / self.batch_size if count is not None else None
+        super(CorpusParser, self).apply(self._batches(xs), count=count, parallelism=parallelism,
+                                        progress_bar=progress_bar, **kwargs)
+
+    def _progress(self, xs, count):
+        pb = ProgressBar(count)
+        for i, x in enumerate(xs):
+            pb.bar(i)
+            yield x
+        pb.close()
+
+    def _batches(self, xs):
+        batch = []
+        for x in xs:
+            batch.append(x)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
     def clear(self, session, **kwargs):
         session.query(Context).delete()
         # We cannot cascade up from child contexts to parent Candidates, so we delete all Candidates too
@@ -37,16 +90,17 @@ class CorpusParser(UDFRunner):
 
 class CorpusParserUDF(UDF):
 
-    def __init__(self, parser, fn, **kwargs):
+    def __init__(self, parser, fn, cache=None, **kwargs):
         super(CorpusParserUDF, self).__init__(**kwargs)
         self.parser = parser
         self.req_handler = parser.connect()
+        if cache is not None:
+            self.req_handler = CachedParserConnection(self.req_handler, cache)
         self.fn = fn
 
     def apply(self, x, **kwargs):
-        """Given a Document object and its raw text, parse into processed Sentences"""
-        doc, text = x
-        for parts in self.req_handler.parse(doc, text):
+        """Given a batch of Document objects and their raw text, parse into processed Sentences"""
+        for doc, parts in self.req_handler.parse_docs(x):
             parts = self.fn(parts) if self.fn is not None else parts
             yield Sentence(**parts)
 
@@ -55,16 +109,29 @@ class DocPreprocessor(object):
     """
     Processes a file or directory of files into a set of Document objects.
 
+    Files compressed with gzip (.gz) or bzip2 (.bz2) are decompressed transparently, and the files
+    in tar archives (.tar, .tar.gz, .tgz, .tar.bz2, .tbz2) are processed as if they were in a directory.
+
+    With parallelism > 1, files are read and parsed in a pool of threads (or processes, with
+    executor='process'), with up to 2 * parallelism files in flight; Documents are still yielded
+    in file order.
+
     :param encoding: file encoding to use, default='utf-8'
     :param path: filesystem path to file or directory to parse
     :param max_docs: the maximum number of Documents to produce, default=float('inf')
+    :param parallelism: number of files read and parsed concurrently, default=1
+    :param executor: 'thread' or 'process' pool, default='thread'
 
     """
+    COMPRESSED = ('.gz', '.bz2')
+    ARCHIVES   = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
 
-    def __init__(self, path, encoding="utf-8", max_docs=float('inf')):
+    def __init__(self, path, encoding="utf-8", max_docs=float('inf'), parallelism=1, executor='thread'):
         self.path = path
         self.encoding = encoding
         self.max_docs = max_docs
+        self.parallelism = parallelism
+        self.executor = executor
 
     def generate(self):
         """
@@ -72,14 +139,12 @@ class DocPreprocessor(object):
 
         """
         doc_count = 0
-        for fp in self._get_files(self.path):
-            file_name = os.path.basename(fp)
-            if self._can_read(file_name):
-                for doc, text in self.parse_file(fp, file_name):
-                    yield doc, text
-                    doc_count += 1
-                    if doc_count >= self.max_docs:
-                        return
+        for docs in self._parse_files():
+            for doc, text in docs:
+                yield doc, text
+                doc_count += 1
+                if doc_count >= self.max_docs:
+                    return
 
     def __iter__(self):
         return self.generate()
@@ -105,12 +170,102 @@ class DocPreprocessor(object):
         else:
             raise IOError("File or directory not found: %s" % (path,))
 
+    def _files(self):
+        """Yields the (fp, file_name) pairs of the files to parse, expanding tar archives"""
+        for fp in self._get_files(self.path):
+            if fp.endswith(DocPreprocessor.ARCHIVES):
+                for member in self._archive_files(fp):
+                    yield member
+                continue
+            file_name = self._file_name(fp)
+            if self._can_read(file_name):
+                yield fp, file_name
+
+    def _archive_files(self, fp):
+        """Reads the files of a tar archive in one sequential pass, as ArchiveMembers"""
+        with tarfile.open(fp, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                file_name = self._file_name(member.name)
+                if self._can_read(file_name):
+                    yield ArchiveMember(fp, member.name, tar.extractfile(member).read()), file_name
+
+    def _file_name(self, fp):
+        """Base name of a file, without compression extension"""
+        file_name = os.path.basename(fp.name if isinstance(fp, ArchiveMember) else fp)
+        for ext in DocPreprocessor.COMPRESSED:
+            if file_name.endswith(ext):
+                return file_name[:-len(ext)]
+        return file_name
+
+    def _open(self, fp):
+        """Opens a file (or ArchiveMember) for binary reading, decompressing it if needed"""
+        name = fp.name if isinstance(fp, ArchiveMember) else fp
+        if isinstance(fp, ArchiveMember):
+            f = io.BytesIO(fp.data)
+            if name.endswith('.gz'):
+                return gzip.GzipFile(fileobj=f)
+            if name.endswith('.bz2'):
+                return io.BytesIO(bz2.decompress(f.read()))
+            return f
+        if name.endswith('.gz'):
+            return gzip.open(fp, 'rb')
+        if name.endswith('.bz2'):
+            return bz2.BZ2File(fp, 'rb')
+        return open(fp, 'rb')
+
+    def _open_text(self, fp):
+        """Opens a file (or ArchiveMember) for reading text with the preprocessor's encoding"""
+        return codecs.getreader(self.encoding)(self._open(fp))
+
+    def _parse_files(self):
+        """Yields the (Document, text) pairs of each file, in file order"""
+        if self.parallelism is None or self.parallelism < 2:
+            for fp, file_name in self._files():
+                yield self.parse_file(fp, file_name)
+            return
+
+        Executor = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        executor = Executor(max_workers=self.parallelism)
+        pending  = deque()
+        files    = self._files()
+        try:
+            while True:
+                for fp, file_name in files:
+                    pending.append(executor.submit(_parse_file, self, fp, file_name))
+                    if len(pending) >= 2 * self.parallelism:
+                        break
+                if len(pending) == 0:
+                    return
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+class ArchiveMember(object):
+    """A file read from a tar archive"""
+    def __init__(self, archive, name, data):
+        self.archive = archive
+        self.name = name
+        self.data = data
+
+    def __str__(self):
+        return "%s:%s" % (self.archive, self.name)
+
+
+def _parse_file(preprocessor, fp, file_name):
+    """Parses a file in a pool worker (module-level, so that it can be pickled for process pools)"""
+    return list(preprocessor.parse_file(fp, file_name))
+
 
 class TSVDocPreprocessor(DocPreprocessor):
     """Simple parsing of TSV file with one (doc_name <tab> doc_text) per line"""
 
     def parse_file(self, fp, file_name):
-        with codecs.open(fp, encoding=self.encoding) as tsv:
+        with self._open_text(fp) as tsv:
             for line in tsv:
                 (doc_name, doc_text) = line.split('\t')
                 stable_id = self.get_stable_id(doc_name)
@@ -121,8 +276,8 @@ class TextDocPreprocessor(DocPreprocessor):
     """Simple parsing of raw text files, assuming one document per file"""
 
     def parse_file(self, fp, file_name):
-        with codecs.open(fp, encoding=self.encoding) as f:
-            name = os.path.basename(fp).rsplit('.', 1)[0]
+        with self._open_text(fp) as f:
+            name = file_name.rsplit('.', 1)[0]
             stable_id = self.get_stable_id(name)
             yield Document(name=name, stable_id=stable_id, meta={'file_name': file_name}), f.read()
 
@@ -190,9 +345,13 @@ class TikaPreprocessor(DocPreprocessor):
     parser = tk_parser
 
     def parse_file(self, fp, file_name):
-        parsed = type(self).parser.from_file(fp)
+        if isinstance(fp, ArchiveMember) or fp.endswith(DocPreprocessor.COMPRESSED):
+            with self._open(fp) as f:
+                parsed = type(self).parser.from_buffer(f.read())
+        else:
+            parsed = type(self).parser.from_file(fp)
         txt = parsed['content']
-        name = os.path.basename(fp).rsplit('.', 1)[0]
+        name = file_name.rsplit('.', 1)[0]
         stable_id = self.get_stable_id(name)
         yield Document(name=name, stable_id=stable_id, meta={'file_name': file_name}), txt
 
@@ -201,11 +360,11 @@ class HTMLDocPreprocessor(DocPreprocessor):
     """Simple parsing of raw HTML files, assuming one document per file"""
 
     def parse_file(self, fp, file_name):
-        with open(fp, 'rb') as f:
+        with self._open(fp) as f:
             html = BeautifulSoup(f, 'lxml')
             txt = filter(self._cleaner, html.findAll(text=True))
             txt = ' '.join(self._strip_special(s) for s in txt if s != '\n')
-            name = os.path.basename(fp).rsplit('.', 1)[0]
+            name = file_name.rsplit('.', 1)[0]
             stable_id = self.get_stable_id(name)
             yield Document(name=name, stable_id=stable_id, meta={'file_name': file_name}), txt
 
@@ -230,19 +389,33 @@ class XMLMultiDocPreprocessor(DocPreprocessor):
     Use XPath queries to specify a _document_ object, and then for each document,
     a set of _text_ sections and an _id_.
 
+    With stream=True, the file is parsed incrementally: each document is yielded as soon as its element
+    is closed, and freed afterwards, so large files (e.g. PubMed dumps) are processed in constant memory.
+    Documents are then the elements with tag doc_tag, by default the tag of a simple doc query such as
+    './/document'.
+
     **Note: Include the full document XML etree in the attribs dict with keep_xml_tree=True**
+
+    Other keyword arguments (encoding, max_docs, parallelism, executor) are passed to DocPreprocessor.
     """
 
     def __init__(self, path, doc='.//document', text='./text/text()', id='./id/text()',
-                 keep_xml_tree=False):
-        DocPreprocessor.__init__(self, path)
+                 keep_xml_tree=False, stream=False, doc_tag=None, **kwargs):
+        DocPreprocessor.__init__(self, path, **kwargs)
         self.doc = doc
         self.text = text
         self.id = id
         self.keep_xml_tree = keep_xml_tree
+        self.stream = stream
+        self.doc_tag = doc_tag
+        if stream and doc_tag is None:
+            m = re.match(r'^(?:\.?//?)?([\w.-]+)$', doc)
+            if m is None:
+                raise ValueError("Cannot stream documents matching {}, please set doc_tag".format(doc))
+            self.doc_tag = m.group(1)
 
     def parse_file(self, f, file_name):
-        for i, doc in enumerate(et.parse(f).xpath(self.doc)):
+        for doc in self._iter_docs(f):
             doc_id = str(doc.xpath(self.id)[0])
             text = '\n'.join(filter(lambda t: t is not None, doc.xpath(self.text)))
             meta = {'file_name': str(file_name)}
@@ -251,5 +424,19 @@ class XMLMultiDocPreprocessor(DocPreprocessor):
             stable_id = self.get_stable_id(doc_id)
             yield Document(name=doc_id, stable_id=stable_id, meta=meta), text
 
+    def _iter_docs(self, f):
+        if not self.stream:
+            with self._open(f) as xml:
+                for doc in et.parse(xml).xpath(self.doc):
+                    yield doc
+            return
+        with self._open(f) as xml:
+            for _, doc in et.iterparse(xml, events=('end',), tag=self.doc_tag, huge_tree=True):
+                yield doc
+                # Free the document, and the references to the documents before it held by their parents
+                doc.clear()
+                while doc.getprevious() is not None:
+                    del doc.getparent()[0]
+
     def _can_read(self, fpath):
-        return fpath.endswith('.xml')
\ No newline at end of file
+        return fpath.endswith('.xml')
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 import sys
+import threading
 import requests
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 
 class Parser(object):
 
+    # Whether CorpusParser passes a single-threaded parse to one connection as a single stream of documents,
+    # rather than in batches (e.g. so that spaCy starts its worker processes once)
+    stream_docs = False
+
     def __init__(self,name):
         self.name = name
 
@@ -15,6 +23,14 @@ class Parser(object):
         '''
         raise NotImplemented
 
+    def cache_key(self):
+        '''
+        String identifying the parser configuration, i.e. everything besides the text which determines
+        a parse (see ParseCache)
+        :return:
+        '''
+        return self.name
+
     def close(self):
         '''
         Kill this parser
@@ -36,6 +52,16 @@ class ParserConnection(object):
     def parse(self, document, text):
         yield self.parser.parse(document, text)
 
+    def parse_docs(self, docs):
+        '''
+        Parse a sequence of (document, text) pairs, yielding (document, parts) pairs in document order
+        :param docs:
+        :return:
+        '''
+        for document, text in docs:
+            for parts in self.parse(document, text):
+                yield document, parts
+
 
 class URLParserConnection(ParserConnection):
     '''
@@ -81,7 +107,73 @@ class URLParserConnection(ParserConnection):
         '''
         return self.parser.parse(document, text, self.request)
 
+    def parse_docs(self, docs):
+        '''
+        Parse a sequence of (document, text) pairs, yielding (document, parts) pairs in document order.
+        Parsers which can join several documents in one request (group_docs) are sent a request per group.
+        :param docs:
+        :return:
+        '''
+        if not hasattr(self.parser, 'group_docs'):
+            for document, parts in super(URLParserConnection, self).parse_docs(docs):
+                yield document, parts
+            return
+        for group in self.parser.group_docs(docs):
+            content = self.parser.request_docs(group, self.request)
+            for document, parts in self.parser.parse_docs_response(group, content):
+                yield document, parts
 
 
+class AsyncURLParserConnection(URLParserConnection):
+    '''
+    URL parser connection which keeps a window of concurrent requests open against the server
+    when parsing several documents. Responses are parsed in the calling thread, in document order.
+
+    The parser must split its requests into group_docs / request_docs / parse_docs_response
+    (see StanfordCoreNLPServer).
+    '''
+    def __init__(self, parser, window=8, retries=20):
+        super(AsyncURLParserConnection, self).__init__(parser, retries=retries)
+        self.window   = window
+        self.executor = None
+        self.local    = threading.local()
+
+    def _thread_connection(self):
+        '''
+        requests sessions are not threadsafe, so each request thread gets its own
+        :return:
+        '''
+        if not hasattr(self.local, 'request'):
+            self.local.request = self._connection()
+        return self.local.request
+
+    def _request(self, group):
+        return self.parser.request_docs(group, self._thread_connection())
 
+    def parse_docs(self, docs):
+        '''
+        Parse a sequence of (document, text) pairs, yielding (document, parts) pairs in document order
+        as responses complete, with up to window requests in flight
+        :param docs:
+        :return:
+        '''
+        # The executor is created lazily, so that it belongs to the process (e.g. UDF) using the connection
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.window)
+        pending = deque()
+        groups  = self.parser.group_docs(docs)
+        while True:
+            for group in groups:
+                pending.append((group, self.executor.submit(self._request, group)))
+                if len(pending) >= self.window:
+                    break
+            if len(pending) == 0:
+                return
+            group, future = pending.popleft()
+            for document, parts in self.parser.parse_docs_response(group, future.result()):
+                yield document, parts
 
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
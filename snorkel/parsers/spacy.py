@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import re
 import sys
+import warnings
 
 try:
     import spacy
 except:
     print>>sys.stderr,"Warning, unable to load 'spaCy' module"
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from multiprocessing import current_process
 from ..parsers import Parser, ParserConnection
 from ..models import Candidate, Context, Document, Sentence, construct_stable_id
 
@@ -16,19 +20,61 @@ class SpaCy(Parser):
     spaCy
     https://spacy.io/
 
-    Minimal (buggy) implementation to show how alternate parsers can be added to Snorkel.
+    Documents are streamed through the model's pipe() in batches of batch_size, with n_workers threads
+    (processes from spaCy 2.2.2, except within a parallel UDF, whose daemonic processes cannot have
+    children of their own). Sentences are converted to CoreNLP's format, with dep_parents holding the
+    (1-based) index of each token's head in the sentence, or 0 for the root.
+
+    A single-threaded CorpusParser streams the whole corpus through one pipe() call, as each call starts
+    the worker processes again, pickling the model to each. With a ParseCache, or within a parallel UDF,
+    documents are parsed in batches of the CorpusParser's batch_size, one call each.
+
     Models for each target language needs to be downloaded using the following command:
 
     python -m spacy download en
 
+    Example::
+
+        CorpusParser(SpaCy(batch_size=1000, n_workers=4)).apply(doc_preprocessor)
     '''
-    def __init__(self,lang='en'):
+    stream_docs = True
+
+    def __init__(self, lang='en', batch_size=1000, n_workers=1):
 
         super(SpaCy, self).__init__(name="spaCy")
-        self.model = spacy.load('en')
+        self.model = spacy.load(lang)
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+
+    def cache_key(self):
+        return "%s:%s:%s" % (self.name, spacy.about.__version__, self.model.lang)
 
     def connect(self):
-        return ParserConnection(self)
+        return SpaCyConnection(self)
+
+    def pipe(self, texts):
+        '''
+        Stream texts through the model, in order
+        :param texts:
+        :return:
+        '''
+        # spaCy takes n_process from 2.2.2 on, and n_threads before
+        version = tuple(int(v) for v in re.findall(r'\d+', spacy.about.__version__)[:3])
+        if version < (2, 2, 2):
+            workers = {'n_threads': self.n_workers}
+        elif self.n_workers > 1 and current_process().daemon:
+            warnings.warn("spaCy cannot start {} processes within a daemonic process (e.g. of a parallel UDF); "
+                          "parsing with n_workers=1. Use parallelism=1 to parse with n_workers processes."
+                          .format(self.n_workers), RuntimeWarning)
+            workers = {'n_process': 1}
+        else:
+            workers = {'n_process': self.n_workers}
+        return self.model.pipe((self._unicode(text) for text in texts), batch_size=self.batch_size, **workers)
+
+    def _unicode(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8', 'error')
+        return text.decode('utf-8')
 
     def parse(self, document, text):
         '''
@@ -37,27 +83,31 @@ class SpaCy(Parser):
         :param text:
         :return:
         '''
-        if isinstance(text, unicode):
-            text = text.encode('utf-8', 'error')
-        text = text.decode('utf-8')
+        return self.parse_doc(document, self.model(self._unicode(text)))
 
-        doc = self.model(text)
+    def parse_doc(self, document, doc):
+        '''
+        Transform a spaCy Doc into CoreNLP-style sentence parts
+        :param document:
+        :param doc:
+        :return:
+        '''
         assert doc.is_parsed
 
         position = 0
         for sent in doc.sents:
             parts = defaultdict(list)
-            dep_order, dep_par, dep_lab = [], [], []
+            dep_par, dep_lab = [], []
             for token in sent:
                 parts['words'].append(unicode(token))
                 parts['lemmas'].append(token.lemma_)
                 parts['pos_tags'].append(token.tag_)
-                parts['ner_tags'].append(token.ent_type_)
+                parts['ner_tags'].append(token.ent_type_ or 'O')
                 parts['char_offsets'].append(token.idx)
 
-                dep_par.append(token.head)
+                # Heads as 1-based indexes in the sentence, 0 for the root (whose head is itself)
+                dep_par.append(0 if token.head.i == token.i else token.head.i - sent.start + 1)
                 dep_lab.append(token.dep_)
-                #dep_order.append(deps['dependent'])
 
             # Add null entity array (matching null for CoreNLP)
             parts['entity_cids'] = ['O' for _ in parts['words']]
@@ -70,15 +120,51 @@ class SpaCy(Parser):
             # make char_offsets relative to start of sentence
             abs_sent_offset = parts['char_offsets'][0]
             parts['char_offsets'] = [p - abs_sent_offset for p in parts['char_offsets']]
-            parts['dep_parents'] = dep_par #sort_X_on_Y(dep_par, dep_order)
-            parts['dep_labels'] = dep_lab #sort_X_on_Y(dep_lab, dep_order)
+            parts['dep_parents'] = dep_par
+            parts['dep_labels'] = dep_lab
             parts['position'] = position
 
             # Add full dependency tree parse to document meta
             # TODO
 
+            # store absolute sentence offsets
+            if document:
+                if document.meta is None:
+                    document.meta = {}
+                if 'abs_sent_offset' not in document.meta:
+                    document.meta['abs_sent_offset'] = {}
+                document.meta['abs_sent_offset'][position] = abs_sent_offset
+
             # Assign the stable id as document's stable id plus absolute character offset
             abs_sent_offset_end = abs_sent_offset + parts['char_offsets'][-1] + len(parts['words'][-1])
-            parts['stable_id'] = construct_stable_id(document, 'sentence', abs_sent_offset, abs_sent_offset_end)
+            if document:
+                parts['stable_id'] = construct_stable_id(document, 'sentence', abs_sent_offset, abs_sent_offset_end)
             position += 1
-            yield parts
\ No newline at end of file
+            yield parts
+
+
+class SpaCyConnection(ParserConnection):
+    '''
+    Connection streaming documents through the spaCy model in batches
+    '''
+    def parse(self, document, text):
+        return self.parser.parse(document, text)
+
+    def parse_docs(self, docs):
+        '''
+        Parse a sequence of (document, text) pairs, yielding (document, parts) pairs in document order
+        :param docs:
+        :return:
+        '''
+        # pipe() reads texts ahead of its output; documents are queued as their texts are read
+        pending = deque()
+
+        def texts():
+            for document, text in docs:
+                pending.append(document)
+                yield text
+
+        for doc in self.parser.pipe(texts()):
+            document = pending.popleft()
+            for parts in self.parser.parse_doc(document, doc):
+                yield document, parts
@@ -0,0 +1,490 @@
+"""
+Read-only, memory-mapped columnar snapshots of a split of Candidates, with their argument Spans and their
+parent Sentences and Documents, for running labeling functions and feature generators without any ORM or
+database traffic.
+
+Example::
+
+    export_snapshot(session, Spouse, 'snapshots/train', split=0)
+    snapshot = CorpusSnapshot('snapshots/train')
+    X, lf_names = snapshot.annotate(LFs)
+
+The view objects of a snapshot expose the same accessors as the ORM objects they stand for (e.g.
+get_word_start, get_attrib_tokens, get_parent), so most LFs and feature generators run on them unchanged.
+"""
+import json
+import os
+import numpy as np
+import scipy.sparse as sparse
+from collections import OrderedDict
+from sqlalchemy.sql import and_, select, union
+
+from .annotations import _to_annotation_generator
+from .db_helpers import span_index_scope
+from .models import Candidate, Context, Document, Sentence, Span, TemporarySpan
+
+SNAPSHOT_VERSION = 1
+
+INT_ATTRIBS = ['char_offsets', 'dep_parents']
+STR_ATTRIBS = ['words', 'lemmas', 'pos_tags', 'ner_tags', 'dep_labels', 'entity_cids', 'entity_types']
+
+# Number of SentenceViews kept decoded at a time
+SENTENCE_CACHE_SIZE = 10000
+
+# Number of Candidates labeled at a time by batch LFs, and sharing span indexes, in CorpusSnapshot.annotate
+ANNOTATE_BATCH_SIZE = 1000
+
+
+def _save(path, name, a):
+    np.save(os.path.join(path, name + '.npy'), a)
+
+
+def _save_strings(path, name, strings):
+    """Saves a list of strings as a blob of their utf-8 encodings and an array of offsets into it"""
+    data    = [s.encode('utf-8') if s is not None else '' for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in data], out=offsets[1:])
+    _save(path, name + '_data', np.frombuffer(''.join(data), dtype=np.uint8) if offsets[-1] > 0
+          else np.zeros(0, dtype=np.uint8))
+    _save(path, name + '_offsets', offsets)
+
+
+class _StringColumn(object):
+    """A read-only list of strings saved by _save_strings"""
+    def __init__(self, path, name):
+        self.data    = np.load(os.path.join(path, name + '_data.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, name + '_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tostring().decode('utf-8')
+
+
+def export_snapshot(session, candidate_class, path, split=0):
+    """
+    Writes the Candidates of candidate_class in a split, their argument Spans, and the parent Sentences and
+    Documents of these, to a snapshot directory which can then be opened with CorpusSnapshot.
+
+    Reads the tables with a handful of Core queries, bypassing the ORM identity map and relationship loading.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    argnames = candidate_class.__argnames__
+    ct       = candidate_class.__table__
+
+    # Candidates, ordered by id (as the rows of annotation matrices are)
+    in_split = and_(ct.c.id == Candidate.__table__.c.id, Candidate.__table__.c.split == split)
+    q = select([ct.c.id] + [ct.c[arg + '_id'] for arg in argnames] + [ct.c[arg + '_cid'] for arg in argnames])
+    cand_rows = session.execute(q.where(in_split).order_by(ct.c.id)).fetchall()
+    arity     = len(argnames)
+
+    # Argument Spans, with their stable ids
+    st       = Span.__table__
+    arg_ids  = union(*[select([ct.c[arg + '_id'].label('id')]).where(in_split) for arg in argnames]).alias()
+    q        = select([st.c.id, st.c.sentence_id, st.c.char_start, st.c.char_end, Context.__table__.c.stable_id])
+    q        = q.where(st.c.id == Context.__table__.c.id).where(st.c.id.in_(select([arg_ids.c.id])))
+    span_rows  = session.execute(q.order_by(st.c.id)).fetchall()
+    span_index = dict((r[0], i) for i, r in enumerate(span_rows))
+
+    # Parent Sentences, ordered by document and position
+    sentence_ids = select([st.c.sentence_id]).where(st.c.id.in_(select([arg_ids.c.id])))
+    sent_t       = Sentence.__table__
+    cols         = [sent_t.c.id, sent_t.c.document_id, sent_t.c.position, sent_t.c.text,
+                    Context.__table__.c.stable_id] + [sent_t.c[a] for a in INT_ATTRIBS + STR_ATTRIBS]
+    q            = select(cols).where(sent_t.c.id == Context.__table__.c.id).where(sent_t.c.id.in_(sentence_ids))
+    sent_rows    = session.execute(q.order_by(sent_t.c.document_id, sent_t.c.position)).fetchall()
+    sent_index   = dict((r[0], i) for i, r in enumerate(sent_rows))
+
+    # Parent Documents
+    document_ids = select([sent_t.c.document_id]).where(sent_t.c.id.in_(sentence_ids))
+    dt           = Document.__table__
+    q            = select([dt.c.id, dt.c.name, Context.__table__.c.stable_id]).where(dt.c.id == Context.__table__.c.id)
+    doc_rows     = session.execute(q.where(dt.c.id.in_(document_ids)).order_by(dt.c.id)).fetchall()
+    doc_index    = dict((r[0], i) for i, r in enumerate(doc_rows))
+
+    # Write candidates
+    _save(path, 'candidate_id', np.array([r[0] for r in cand_rows], dtype=np.int64))
+    _save(path, 'candidate_args', np.array([[span_index[r[1 + i]] for i in range(arity)] for r in cand_rows],
+                                           dtype=np.int32).reshape(len(cand_rows), arity))
+    cids = [[r[1 + arity + i] for i in range(arity)] for r in cand_rows]
+    _save(path, 'candidate_cids_null', np.array([[c is None for c in row] for row in cids],
+                                                dtype=np.bool_).reshape(len(cand_rows), arity))
+
+    # CIDs are integers, unless some are strings (e.g. the MeSH ids of PretaggedCandidateExtractor, which SQLite
+    # keeps as text in the Integer cid columns): then all are saved as strings, flagging those which were integers
+    cid_type = 'int' if all(c is None or isinstance(c, (int, long)) for row in cids for c in row) else 'str'
+    if cid_type == 'int':
+        _save(path, 'candidate_cids', np.array([[c if c is not None else 0 for c in row] for row in cids],
+                                               dtype=np.int64).reshape(len(cand_rows), arity))
+    else:
+        _save_strings(path, 'candidate_cids', [unicode(c) if c is not None else None for row in cids for c in row])
+        _save(path, 'candidate_cids_int', np.array([[isinstance(c, (int, long)) for c in row] for row in cids],
+                                                   dtype=np.bool_).reshape(len(cand_rows), arity))
+
+    # Write spans
+    _save(path, 'span_id', np.array([r[0] for r in span_rows], dtype=np.int64))
+    _save(path, 'span_sentence', np.array([sent_index[r[1]] for r in span_rows], dtype=np.int32))
+    _save(path, 'span_char_start', np.array([r[2] for r in span_rows], dtype=np.int32))
+    _save(path, 'span_char_end', np.array([r[3] for r in span_rows], dtype=np.int32))
+    _save_strings(path, 'span_stable_id', [r[4] for r in span_rows])
+
+    # Write sentences; token attributes are flattened over all sentences, with string tokens mapped to ids
+    # into a single vocabulary, where id 0 is reserved for None
+    _save(path, 'sentence_id', np.array([r[0] for r in sent_rows], dtype=np.int64))
+    _save(path, 'sentence_document', np.array([doc_index[r[1]] for r in sent_rows], dtype=np.int32))
+    _save(path, 'sentence_position', np.array([r[2] for r in sent_rows], dtype=np.int32))
+    _save_strings(path, 'sentence_text', [r[3] for r in sent_rows])
+    _save_strings(path, 'sentence_stable_id', [r[4] for r in sent_rows])
+    token_offsets = np.zeros(len(sent_rows) + 1, dtype=np.int64)
+    np.cumsum([len(r[5]) for r in sent_rows], out=token_offsets[1:])
+    _save(path, 'sentence_token_offsets', token_offsets)
+    vocab    = [None]
+    vocab_id = {None: 0}
+    for k, a in enumerate(INT_ATTRIBS + STR_ATTRIBS):
+        values = [r[5 + k] for r in sent_rows]
+        _save(path, 'sentence_%s_null' % a, np.array([v is None for v in values], dtype=np.bool_))
+        tokens = []
+        for v, r in zip(values, sent_rows):
+            tokens.extend(v if v is not None else [None] * len(r[5]))
+        if a in STR_ATTRIBS:
+            for i, t in enumerate(tokens):
+                if t not in vocab_id:
+                    vocab_id[t] = len(vocab)
+                    vocab.append(t)
+                tokens[i] = vocab_id[t]
+        _save(path, 'sentence_' + a, np.array([t if t is not None else -1 for t in tokens], dtype=np.int32))
+    _save_strings(path, 'vocab', vocab)
+
+    # Write documents
+    _save(path, 'document_id', np.array([r[0] for r in doc_rows], dtype=np.int64))
+    _save_strings(path, 'document_name', [r[1] for r in doc_rows])
+    _save_strings(path, 'document_stable_id', [r[2] for r in doc_rows])
+
+    with open(os.path.join(path, 'snapshot.json'), 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'candidate_class': candidate_class.__name__,
+                   'argnames': list(argnames), 'split': split, 'cid_type': cid_type}, f)
+    print "Exported %s candidates, %s spans, %s sentences, %s documents" \
+        % (len(cand_rows), len(span_rows), len(sent_rows), len(doc_rows))
+
+
+class CorpusSnapshot(object):
+    """
+    A snapshot written by export_snapshot, memory-mapped and exposed as lightweight read-only views:
+    candidates is a list of CandidateViews, in order of Candidate id.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'snapshot.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version: %s" % self.meta['version'])
+        self.argnames = tuple(str(a) for a in self.meta['argnames'])
+        self.split    = self.meta['split']
+
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.candidate_id        = load('candidate_id')
+        self.candidate_args      = load('candidate_args')
+        self.candidate_cids_null = load('candidate_cids_null')
+        if self.meta.get('cid_type', 'int') == 'int':
+            self.candidate_cids     = load('candidate_cids')
+            self.candidate_cids_int = None
+        else:
+            self.candidate_cids     = _StringColumn(path, 'candidate_cids')
+            self.candidate_cids_int = load('candidate_cids_int')
+        self.span_id             = load('span_id')
+        self.span_sentence       = load('span_sentence')
+        self.span_char_start     = load('span_char_start')
+        self.span_char_end       = load('span_char_end')
+        self.span_stable_id      = _StringColumn(path, 'span_stable_id')
+        self.sentence_id         = load('sentence_id')
+        self.sentence_document   = load('sentence_document')
+        self.sentence_position   = load('sentence_position')
+        self.sentence_text       = _StringColumn(path, 'sentence_text')
+        self.sentence_stable_id  = _StringColumn(path, 'sentence_stable_id')
+        self.token_offsets       = load('sentence_token_offsets')
+        self.tokens              = dict((a, load('sentence_' + a)) for a in INT_ATTRIBS + STR_ATTRIBS)
+        self.tokens_null         = dict((a, load('sentence_%s_null' % a)) for a in INT_ATTRIBS + STR_ATTRIBS)
+        self.document_id         = load('document_id')
+        self.document_name       = _StringColumn(path, 'document_name')
+        self.document_stable_id  = _StringColumn(path, 'document_stable_id')
+
+        vocab      = _StringColumn(path, 'vocab')
+        self.vocab = [None] + [vocab[i] for i in xrange(1, len(vocab))]
+
+        # Index of the Sentences of each Document, and of the Spans of each Sentence
+        self.document_sentences = [[] for _ in xrange(len(self.document_id))]
+        for i, d in enumerate(self.sentence_document):
+            self.document_sentences[d].append(i)
+        self.sentence_spans = [[] for _ in xrange(len(self.sentence_id))]
+        for i, s in enumerate(self.span_sentence):
+            self.sentence_spans[s].append(i)
+
+        self._sentences = OrderedDict()
+        self.candidates = [CandidateView(self, i) for i in xrange(len(self.candidate_id))]
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __iter__(self):
+        return iter(self.candidates)
+
+    def get_tokens(self, i, attrib):
+        """Returns the tokens of attribute attrib of Sentence i as a list"""
+        if self.tokens_null[attrib][i]:
+            return None
+        tokens = self.tokens[attrib][self.token_offsets[i]:self.token_offsets[i+1]].tolist()
+        if attrib in STR_ATTRIBS:
+            vocab  = self.vocab
+            tokens = [vocab[t] for t in tokens]
+        return tokens
+
+    def get_sentence(self, i):
+        """Returns the SentenceView of Sentence i; recently used views are cached so that they are shared"""
+        try:
+            sentence = self._sentences.pop(i)
+        except KeyError:
+            sentence = SentenceView(self, i)
+            if len(self._sentences) >= SENTENCE_CACHE_SIZE:
+                self._sentences.popitem(last=False)
+        self._sentences[i] = sentence
+        return sentence
+
+    def get_span(self, i):
+        return SpanView(self, i)
+
+    def get_document(self, i):
+        return DocumentView(self, i)
+
+    def annotate(self, f):
+        """
+        Applies f, either a list of functions of a Candidate (e.g. LFs, including BatchLFs) or a generator function
+        of a Candidate yielding key name, value pairs (e.g. a feature generator), to every Candidate of the snapshot.
+        Returns an N x M scipy.sparse.csr_matrix, with rows in order of self.candidates, and the M key names.
+        """
+        anno_generator = _to_annotation_generator(f) if hasattr(f, '__iter__') else f
+        batch_fns      = [g for g in f if hasattr(g, 'prepare')] if hasattr(f, '__iter__') else []
+        key_index      = OrderedDict()
+        rows, cols, vals = [], [], []
+        for start in xrange(0, len(self.candidates), ANNOTATE_BATCH_SIZE):
+            batch = self.candidates[start:start + ANNOTATE_BATCH_SIZE]
+
+            # Batch LFs label each chunk of Candidates in one call
+            for g in batch_fns:
+                g.prepare(batch)
+
+            # Span indexes used by LF helpers are shared within the chunk
+            with span_index_scope():
+                for i, c in enumerate(batch, start):
+                    seen = set()
+                    for key_name, value in anno_generator(c):
+                        if key_name in seen or value == 0:
+                            continue
+                        seen.add(key_name)
+                        j = key_index.setdefault(key_name, len(key_index))
+                        rows.append(i)
+                        cols.append(j)
+                        vals.append(value)
+        X = sparse.csr_matrix((vals, (rows, cols)), shape=(len(self.candidates), len(key_index)))
+        return X, list(key_index.keys())
+
+
+class DocumentView(object):
+    """Read-only view of a Document in a CorpusSnapshot"""
+    __slots__ = ('snapshot', 'index')
+
+    def __init__(self, snapshot, index):
+        self.snapshot = snapshot
+        self.index    = index
+
+    @property
+    def id(self):
+        return int(self.snapshot.document_id[self.index])
+
+    @property
+    def name(self):
+        return self.snapshot.document_name[self.index]
+
+    @property
+    def stable_id(self):
+        return self.snapshot.document_stable_id[self.index]
+
+    @property
+    def sentences(self):
+        """The Sentences of the Document which are in the snapshot"""
+        return [self.snapshot.get_sentence(i) for i in self.snapshot.document_sentences[self.index]]
+
+    def get_parent(self):
+        return None
+
+    def get_children(self):
+        return self.sentences
+
+    def get_sentence_generator(self):
+        for sentence in self.sentences:
+            yield sentence
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentView) and other.snapshot is self.snapshot and other.index == self.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "Document " + str(self.name)
+
+
+class SentenceView(object):
+    """Read-only view of a Sentence in a CorpusSnapshot; token attributes are decoded on first access"""
+    def __init__(self, snapshot, index):
+        self.snapshot  = snapshot
+        self.index     = index
+        self.id        = int(snapshot.sentence_id[index])
+        self.position  = int(snapshot.sentence_position[index])
+        self.text      = snapshot.sentence_text[index]
+        self.stable_id = snapshot.sentence_stable_id[index]
+        self._tokens   = {}
+
+    def _get_tokens(self, attrib):
+        try:
+            return self._tokens[attrib]
+        except KeyError:
+            tokens = self._tokens[attrib] = self.snapshot.get_tokens(self.index, attrib)
+            return tokens
+
+    @property
+    def document(self):
+        return self.snapshot.get_document(self.snapshot.sentence_document[self.index])
+
+    @property
+    def spans(self):
+        """The Spans of the Sentence which are in the snapshot"""
+        return [self.snapshot.get_span(i) for i in self.snapshot.sentence_spans[self.index]]
+
+    def get_parent(self):
+        return self.document
+
+    def get_children(self):
+        return self.spans
+
+    def get_sentence_generator(self):
+        yield self
+
+    def _asdict(self):
+        d = dict((a, getattr(self, a)) for a in INT_ATTRIBS + STR_ATTRIBS)
+        d.update({'id': self.id, 'document': self.document, 'position': self.position, 'text': self.text})
+        return d
+
+    def __eq__(self, other):
+        return isinstance(other, SentenceView) and other.snapshot is self.snapshot and other.index == self.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "Sentence(%s,%s,%s)" % (self.document, self.position, self.text.encode('utf-8'))
+
+
+for _attrib in INT_ATTRIBS + STR_ATTRIBS:
+    setattr(SentenceView, _attrib, property(lambda self, attrib=_attrib: self._get_tokens(attrib)))
+
+
+class SpanView(TemporarySpan):
+    """Read-only view of a Span in a CorpusSnapshot"""
+    __slots__ = ('snapshot', 'index')
+
+    def __init__(self, snapshot, index):
+        super(SpanView, self).__init__(sentence=snapshot.get_sentence(snapshot.span_sentence[index]),
+                                       char_start=int(snapshot.span_char_start[index]),
+                                       char_end=int(snapshot.span_char_end[index]))
+        self.snapshot = snapshot
+        self.index    = index
+        self.id       = int(snapshot.span_id[index])
+
+    @property
+    def stable_id(self):
+        return self.snapshot.span_stable_id[self.index]
+
+    def get_stable_id(self):
+        return self.stable_id
+
+    def get_parent(self):
+        return self.sentence
+
+    def get_children(self):
+        return None
+
+    def load_id_or_insert(self, session):
+        raise NotImplementedError("Snapshot views are read-only.")
+
+    def _get_instance(self, **kwargs):
+        return TemporarySpan(**kwargs)
+
+
+class CandidateView(object):
+    """Read-only view of a Candidate in a CorpusSnapshot"""
+    __slots__ = ('snapshot', 'index')
+
+    def __init__(self, snapshot, index):
+        self.snapshot = snapshot
+        self.index    = index
+
+    @property
+    def id(self):
+        return int(self.snapshot.candidate_id[self.index])
+
+    @property
+    def split(self):
+        return self.snapshot.split
+
+    @property
+    def __argnames__(self):
+        return self.snapshot.argnames
+
+    def get_contexts(self):
+        """Get a tuple of the consituent contexts making up this candidate"""
+        return tuple(self.snapshot.get_span(i) for i in self.snapshot.candidate_args[self.index])
+
+    def get_parent(self):
+        # Fails if both contexts don't have same parent
+        p = [c.get_parent() for c in self.get_contexts()]
+        if p.count(p[0]) == len(p):
+            return p[0]
+        else:
+            raise Exception("Contexts do not all have same parent")
+
+    def get_cids(self):
+        """Get a tuple of the canonical IDs (CIDs) of the contexts making up this candidate"""
+        snapshot = self.snapshot
+        nulls    = snapshot.candidate_cids_null[self.index]
+        if snapshot.candidate_cids_int is None:
+            return tuple(None if null else int(cid) for cid, null in zip(snapshot.candidate_cids[self.index], nulls))
+        arity = len(snapshot.argnames)
+        cids  = [snapshot.candidate_cids[self.index * arity + k] for k in range(arity)]
+        return tuple(None if null else (int(cid) if is_int else cid) for cid, null, is_int in
+                     zip(cids, nulls, snapshot.candidate_cids_int[self.index]))
+
+    def __len__(self):
+        return len(self.snapshot.argnames)
+
+    def __getitem__(self, key):
+        return self.get_contexts()[key]
+
+    def __eq__(self, other):
+        return isinstance(other, CandidateView) and other.snapshot is self.snapshot and other.index == self.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.snapshot.meta['candidate_class'], ", ".join(map(str, self.get_contexts())))
@@ -50,7 +50,7 @@ class UDFRunner(object):
 
         # Set up ProgressBar if possible
         pb = None
-        if progress_bar and hasattr(xs, '__len__') or count is not None:
+        if progress_bar and (hasattr(xs, '__len__') or count is not None):
             n = count if count is not None else len(xs)
             pb = ProgressBar(n)
         
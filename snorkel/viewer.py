@@ -1,4 +1,5 @@
 from __future__ import print_function
+from .db_helpers import CandidateFetchPlan
 from .models import GoldLabel, StableLabel, GoldLabelKey
 try:
     from IPython.core.display import display, Javascript
@@ -25,6 +26,16 @@ PAGE_HTML = u"""
 </div>
 """
 
+EMPTY_PAGE_HTML = u"""
+<div class="viewer-page viewer-page-pending" id="viewer-page-{pid}"></div>
+"""
+
+# Number of pages rendered when the Viewer is opened; the others are rendered on demand
+N_PAGES_PRERENDERED = 2
+
+# Number of candidates per query when loading existing labels
+LABEL_BATCH_SIZE = 500
+
 
 class Viewer(widgets.DOMWidget):
     """
@@ -71,7 +82,11 @@ class Viewer(widgets.DOMWidget):
         # Hence, we index by their position in this list
         # We get the sorted candidates and all contexts required, either from unary or binary candidates
         self.gold       = list(gold)
-        self.candidates = sorted(list(candidates), key=lambda c : c[0].char_start)
+        self.candidates = list(candidates)
+
+        # Load the Spans and Sentences of all the candidates up front, rather than one by one
+        CandidateFetchPlan().prefetch(self.session, self.candidates + self.gold)
+        self.candidates = sorted(self.candidates, key=lambda c : c[0].char_start)
         self.contexts   = list(set(c[0].get_parent() for c in self.candidates + self.gold))
         
         # If committed, sort contexts by id
@@ -80,17 +95,44 @@ class Viewer(widgets.DOMWidget):
         except:
             pass
 
-        # Loads existing annotations
+        # Index the candidates and gold by position, and by context
+        # Note: candidates are indexed by identity, as uncommitted candidates have no ids
+        self.candidate_index  = dict((id(c), i) for i, c in enumerate(self.candidates))
+        self.gold_index       = dict((id(g), i) for i, g in enumerate(self.gold))
+        self.context_cids     = dict((context, []) for context in self.contexts)
+        for i, c in enumerate(self.candidates):
+            self.context_cids[c[0].get_parent()].append(i)
+        self.context_gold     = None
+        self.pages            = {}
+
+        # Loads existing annotations, with one query per batch of candidates
         self.annotations        = [None] * len(self.candidates)
         self.annotations_stable = [None] * len(self.candidates)
         init_labels_serialized  = []
+        existing_annotations    = {}
+        cids = [c.id for c in self.candidates if c.id is not None]
+        for k in range(0, len(cids), LABEL_BATCH_SIZE):
+            for label in self.session.query(GoldLabel).filter(GoldLabel.key == self.annotator) \
+                                                      .filter(GoldLabel.candidate_id.in_(cids[k:k+LABEL_BATCH_SIZE])):
+                existing_annotations[label.candidate_id] = label
+
+        # ...and their stable versions
+        stable_ids = {}
+        for i, candidate in enumerate(self.candidates):
+            if candidate.id in existing_annotations:
+                stable_ids[i] = '~~'.join([c.stable_id for c in candidate.get_contexts()])
+        existing_stable = {}
+        created_stable  = False
+        keys            = list(set(stable_ids.values()))
+        for k in range(0, len(keys), LABEL_BATCH_SIZE):
+            for label in self.session.query(StableLabel).filter(StableLabel.annotator_name == name) \
+                                                        .filter(StableLabel.context_stable_ids.in_(keys[k:k+LABEL_BATCH_SIZE])):
+                existing_stable[label.context_stable_ids] = label
+
         for i, candidate in enumerate(self.candidates):
 
             # First look for the annotation in the primary annotations table
-            existing_annotation = self.session.query(GoldLabel) \
-                .filter(GoldLabel.key == self.annotator) \
-                .filter(GoldLabel.candidate == candidate) \
-                .first()
+            existing_annotation = existing_annotations.get(candidate.id) if candidate.id is not None else None
             if existing_annotation is not None:
                 self.annotations[i] = existing_annotation
                 if existing_annotation.value == 1:
@@ -103,23 +145,23 @@ class Viewer(widgets.DOMWidget):
                 init_labels_serialized.append(str(i) + '~~' + value_string)
 
                 # If the annotator label is in the main table, also get its stable version
-                context_stable_ids = '~~'.join([c.stable_id for c in candidate.get_contexts()])
-                existing_annotation_stable = self.session.query(StableLabel) \
-                                                 .filter(StableLabel.context_stable_ids == context_stable_ids)\
-                                                 .filter(StableLabel.annotator_name == name).one_or_none()
+                context_stable_ids         = stable_ids[i]
+                existing_annotation_stable = existing_stable.get(context_stable_ids)
 
                 # If stable version is not available, create it here
                 # NOTE: This is for versioning issues, should be removed?
                 if existing_annotation_stable is None:
-                    context_stable_ids         = '~~'.join([c.stable_id for c in candidate.get_contexts()])
                     existing_annotation_stable = StableLabel(context_stable_ids=context_stable_ids,\
                                                              annotator_name=self.annotator.name,\
                                                              split=candidate.split,\
                                                              value=existing_annotation.value)
                     self.session.add(existing_annotation_stable)
-                    self.session.commit()
+                    existing_stable[context_stable_ids] = existing_annotation_stable
+                    created_stable = True
 
                 self.annotations_stable[i] = existing_annotation_stable
+        if created_stable:
+            self.session.commit()
 
         self._labels_serialized = ','.join(init_labels_serialized)
 
@@ -144,33 +186,52 @@ class Viewer(widgets.DOMWidget):
         """Given the raw context, tag the spans using the generic _tag_span method"""
         raise NotImplementedError()
 
-    def render(self):
-        """Renders viewer pane"""
-        cids = []
+    def _get_context_gold(self, context):
+        """Returns the gold annotations in a context, indexing them all on first use"""
+        if self.context_gold is None:
+            self.context_gold = {}
+            for g in self.gold:
+                self.context_gold.setdefault(g.context_id, []).append(g)
+        return self.context_gold.get(context.id, [])
 
-        # Iterate over pages of contexts
-        pid   = 0
-        pages = []
-        N     = len(self.contexts)
-        for i in range(0, N, self.n_per_page):
-            page_cids = []
-            lis       = []
-            for j in range(i, min(N, i + self.n_per_page)):
-                context = self.contexts[j]
+    def get_cid(self, candidate):
+        """Returns the position of a candidate in the Viewer"""
+        return self.candidate_index[id(candidate)]
+
+    def get_gold_id(self, gold):
+        """Returns the position of a gold annotation in the Viewer"""
+        return self.gold_index[id(gold)]
+
+    def render_page(self, pid):
+        """Renders the html of page pid, caching it"""
+        if pid not in self.pages:
+            lis = []
+            for context in self.contexts[pid * self.n_per_page:(pid + 1) * self.n_per_page]:
 
                 # Get the candidates in this context
-                candidates = [c for c in self.candidates if c[0].get_parent() == context]
-                gold = [g for g in self.gold if g.context_id == context.id]
+                candidates = [self.candidates[i] for i in self.context_cids[context]]
+                gold       = self._get_context_gold(context) if len(self.gold) > 0 else []
 
                 # Construct the <li> and page view elements
                 li_data = self._tag_context(context, candidates, gold)
                 lis.append(LI_HTML.format(data=li_data, context_id=context.id))
-                page_cids.append([self.candidates.index(c) for c in candidates])
+            self.pages[pid] = PAGE_HTML.format(pid=pid, data=''.join(lis))
+        return self.pages[pid]
 
-            # Assemble the page...
-            pages.append(PAGE_HTML.format(pid=pid, data=''.join(lis)))
-            cids.append(page_cids)
-            pid += 1
+    def render(self):
+        """
+        Renders viewer pane; only the first pages are rendered up front, the others are rendered when
+        the widget navigates to them
+        """
+        cids  = []
+        pages = []
+        N     = len(self.contexts)
+        for pid, i in enumerate(range(0, N, self.n_per_page)):
+            cids.append([self.context_cids[context] for context in self.contexts[i:i + self.n_per_page]])
+            if pid < N_PAGES_PRERENDERED:
+                pages.append(self.render_page(pid))
+            else:
+                pages.append(EMPTY_PAGE_HTML.format(pid=pid))
 
         # Render in primary Viewer template
         self.cids = cids
@@ -190,7 +251,11 @@ class Viewer(widgets.DOMWidget):
         """
         Handles label event by persisting new label
         """
-        if content.get('event', '') == 'set_label':
+        if content.get('event', '') == 'render_page':
+            pid = content.get('pid', None)
+            self.send({'event': 'page', 'pid': pid, 'html': self.render_page(pid)})
+
+        elif content.get('event', '') == 'set_label':
             cid = content.get('cid', None)
             value = content.get('value', None)
             if value is True:
@@ -266,18 +331,18 @@ class SentenceNgramViewer(Viewer):
             # Handle both unary and binary candidates
             try:
                 # For binary candidates, add classes for both the candidate ID and unary span identifiers
-                cids0  = [self.candidates.index(c) for c in candidates if self._is_subspan(start, end, c[0])]
+                cids0  = [self.get_cid(c) for c in candidates if self._is_subspan(start, end, c[0])]
                 cids0 += ['%s-0' % cid for cid in cids0]
-                cids1  = [self.candidates.index(c) for c in candidates if self._is_subspan(start, end, c[1])]
+                cids1  = [self.get_cid(c) for c in candidates if self._is_subspan(start, end, c[1])]
                 cids1 += ['%s-1' % cid for cid in cids1]
                 cids   = cids0 + cids1
 
                 # Handle gold...
-                gcids = [self.gold.index(g) for g in gold if
+                gcids = [self.get_gold_id(g) for g in gold if
                          self._is_subspan(start, end, g[0]) or self._is_subspan(start, end, g[1])]
             except:
-                cids  = [self.candidates.index(c) for c in candidates if self._is_subspan(start, end, c[0])]
-                gcids = [self.gold.index(g) for g in gold if self._is_subspan(start, end, g[0])]
+                cids  = [self.get_cid(c) for c in candidates if self._is_subspan(start, end, c[0])]
+                gcids = [self.get_gold_id(g) for g in gold if self._is_subspan(start, end, g[0])]
 
             html += self._tag_span(s[start:end+1], cids, gold=len(gcids) > 0)
         return html
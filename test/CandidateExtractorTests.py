@@ -0,0 +1,103 @@
+import os, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import make_document, make_sentence
+from collections import Counter
+from StringIO import StringIO
+from snorkel.models import Sentence, Span, SnorkelSession, candidate_subclass
+from snorkel.candidates import CandidateExtractor, PretaggedCandidateExtractor, Ngrams
+from snorkel.matchers import DictionaryMatch
+
+ChemicalDisease = candidate_subclass('ChemicalDisease', ['chemical', 'disease'])
+ChemicalPair    = candidate_subclass('ChemicalPair', ['chemical1', 'chemical2'])
+
+CHEMICALS = ['aspirin', 'lithium', 'lithium carbonate', 'caffeine']
+DISEASES  = ['ulcers', 'gastric ulcers', 'tremor', 'nausea']
+
+# Sentences of each document, with the entity type of each word
+TEXTS = [[("Aspirin induced gastric ulcers in rats .", "C O D D O O O"),
+          ("Lithium carbonate and caffeine cause tremor and nausea .", "C C O C O D O D O")],
+         [("Caffeine was not linked to nausea .", "C O O O O D O"),
+          ("No entities here .", "O O O O")]]
+TYPES = {'C': 'Chemical', 'D': 'Disease', 'O': 'O'}
+
+
+class TestCandidateExtractorDryRun(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        for i, texts in enumerate(TEXTS):
+            document   = make_document('doc%d' % i)
+            char_start = 0
+            for position, (text, tags) in enumerate(texts):
+                cls.session.add(make_sentence(document, position, text, char_start, entity_cids=tags.split(' '),
+                                              entity_types=[TYPES[t] for t in tags.split(' ')]))
+                char_start += len(text) + 1
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def sentences(self):
+        return self.session.query(Sentence).order_by(Sentence.document_id, Sentence.position).all()
+
+    def assertDryRunMatches(self, extractor, candidate_class, split):
+        """A dry run inserts nothing, and counts the candidates that apply then inserts"""
+        n_spans = self.session.query(Span).count()
+        stats   = extractor.dry_run(self.sentences(), split=split, progress_bar=False)
+        self.session.expire_all()
+        self.assertEqual(self.session.query(Span).count(), n_spans)
+        self.assertEqual(self.session.query(candidate_class).filter(candidate_class.split == split).count(), 0)
+        self.assertEqual(stats.n_contexts, 4)
+
+        extractor.apply(self.sentences(), split=split, progress_bar=False)
+        self.session.expire_all()
+        candidates = self.session.query(candidate_class).filter(candidate_class.split == split).all()
+        self.assertGreater(len(candidates), 0)
+        self.assertEqual(stats.n_candidates, len(candidates))
+        self.assertEqual(stats.split_counts, Counter({split: len(candidates)}))
+        self.assertEqual(dict((k, n) for k, n in stats.document_counts.items() if n > 0),
+                         Counter(c.get_parent().document_id for c in candidates))
+
+        # Candidates of different splits cannot share arguments
+        extractor.clear(self.session, split=split)
+        self.session.commit()
+        return stats
+
+    def test_candidate_extractor(self):
+        extractor = CandidateExtractor(ChemicalDisease, [Ngrams(n_max=2), Ngrams(n_max=2)],
+                                       [DictionaryMatch(d=CHEMICALS), DictionaryMatch(d=DISEASES)])
+        stats = self.assertDryRunMatches(extractor, ChemicalDisease, split=0)
+        self.assertEqual(stats.n_candidates, 1 + 2 * 2 + 1)
+        self.assertEqual([sorted(c.items()) for c in stats.arg_set_sizes],
+                         [[(0, 1), (1, 2), (2, 1)], [(0, 1), (1, 2), (2, 1)]])
+
+    def test_self_relations(self):
+        """Self, nested and symmetric relations are filtered out in dry runs as in extraction"""
+        extractor = CandidateExtractor(ChemicalPair, [Ngrams(n_max=2), Ngrams(n_max=2)],
+                                       [DictionaryMatch(d=CHEMICALS, longest_match_only=False)] * 2,
+                                       symmetric_relations=False)
+        stats = self.assertDryRunMatches(extractor, ChemicalPair, split=1)
+        self.assertEqual(stats.n_candidates, 2)
+
+    def test_pretagged_extractor(self):
+        extractor = PretaggedCandidateExtractor(ChemicalDisease, ['Chemical', 'Disease'])
+        stats = self.assertDryRunMatches(extractor, ChemicalDisease, split=2)
+        self.assertEqual(stats.n_candidates, 1 + 2 * 2 + 1)
+
+    def test_progress_bar(self):
+        """progress_bar=False hides the progress bar, even when the number of contexts is known"""
+        extractor = PretaggedCandidateExtractor(ChemicalDisease, ['Chemical', 'Disease'])
+        for progress_bar in [False, True]:
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                extractor.dry_run(iter(self.sentences()), progress_bar=progress_bar, count=4)
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertEqual('100%' in output, progress_bar)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json, os, re, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.models import Document
+from snorkel.parsers import StanfordCoreNLPServer
+
+
+class OfflineCoreNLPServer(StanfordCoreNLPServer):
+    """A StanfordCoreNLPServer which never launches the server, for parsing synthesized responses"""
+    def _start_server(self, force_load=False):
+        self.process_group = None
+
+
+def corenlp_response(text, sentence_lengths):
+    """
+    A CoreNLP JSON response for text, tokenized on whitespace and split into sentences of the given numbers
+    of tokens; character offsets are in UTF-16 code units, as CoreNLP counts them
+    """
+    tokens = [(m.group(), len(text[:m.start()].encode('utf-16-le')) / 2) for m in re.finditer(r'\S+', text, re.U)]
+    assert len(tokens) == sum(sentence_lengths)
+    blocks, i = [], 0
+    for n in sentence_lengths:
+        toks = [{'index': k + 1, 'word': w, 'originalText': w, 'lemma': w.lower(), 'pos': 'NN', 'ner': 'O',
+                 'characterOffsetBegin': b, 'characterOffsetEnd': b + len(w.encode('utf-16-le')) / 2}
+                for k, (w, b) in enumerate(tokens[i:i + n])]
+        deps = [{'dep': 'ROOT' if k == 0 else 'dep', 'governor': k, 'dependent': k + 1} for k in range(n)]
+        blocks.append({'index': len(blocks), 'tokens': toks, 'basic-dependencies': deps})
+        i += n
+    return json.dumps({'sentences': blocks})
+
+
+def sentence_lengths(text):
+    """Numbers of tokens of the sentences of text, which end at '.' tokens"""
+    lengths, n = [], 0
+    for w in text.split():
+        n += 1
+        if w == '.':
+            lengths.append(n)
+            n = 0
+    return lengths + [n] if n > 0 else lengths
+
+
+def make_doc(name):
+    return Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+
+
+class CoreNLPTestCase(unittest.TestCase):
+
+    def assertAligned(self, text, parts, document):
+        """The words of each sentence are found at their offsets in the document text"""
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8')
+        for p in parts:
+            start = document.meta['abs_sent_offset'][p['position']]
+            for w, o in zip(p['words'], p['char_offsets']):
+                self.assertEqual(text[start + o:start + o + len(w)], w)
+            self.assertEqual(p['stable_id'], '%s::sentence:%d:%d' % (document.name, start, start + len(p['text'])))
+
+
+class TestCoreNLPResponses(CoreNLPTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.parser = OfflineCoreNLPServer(docs_per_request=10)
+
+    def test_joined_response_offsets(self):
+        """Documents parsed in one request have the same sentences as when parsed alone"""
+        texts = [(u"Great \U0001F600 day \U0001F389 !", [5]),
+                 ("Caf\xc3\xa9 ol\xc3\xa9 \xf0\x9f\x98\x80 .", [4]),
+                 (u"No sentence end", [3]),
+                 (u"here \U0001F600 \U0001F600 ok .", [5])]
+        # The third and fourth documents share a sentence, which is cut at the document boundary
+        joined = StanfordCoreNLPServer.DOC_SEPARATOR.join(t if isinstance(t, unicode) else t.decode('utf-8')
+                                                          for t, _ in texts)
+        content = corenlp_response(joined, [5, 4, 8])
+
+        docs   = [(make_doc('doc%d' % i), t) for i, (t, _) in enumerate(texts)]
+        joined = list(self.parser.parse_docs_response(docs, content))
+        self.assertEqual([d.name for d, _ in joined], ['doc0', 'doc1', 'doc2', 'doc3'])
+        for (document, text), (_, lengths) in zip(docs, texts):
+            parts = [p for d, p in joined if d is document]
+            self.assertAligned(text, parts, document)
+
+            alone = make_doc(document.name)
+            u     = text if isinstance(text, unicode) else text.decode('utf-8')
+            alone_parts = list(self.parser.parse_response(alone, text, corenlp_response(u, lengths)))
+            for p in parts + alone_parts:
+                del p['document']
+            self.assertEqual(parts, alone_parts)
+            self.assertEqual(document.meta, alone.meta)
+
+    def test_split_blocks(self):
+        """Tokens are assigned to documents by their offsets, once converted to indices of the joined text"""
+        joined = u"\U0001F600\U0001F600 a\n\nb c"
+        blocks = json.loads(corenlp_response(joined, [4]))['sentences']
+        blocks = self.parser.text_offsets(blocks, joined)
+        doc_blocks = self.parser._split_blocks(blocks, [0, 6])
+        self.assertEqual([[t['word'] for b in bs for t in b['tokens']] for bs in doc_blocks],
+                         [[u"\U0001F600\U0001F600", u"a"], [u"b", u"c"]])
+        self.assertEqual([t['characterOffsetBegin'] for t in doc_blocks[1][0]['tokens']], [6, 8])
+        self.assertEqual([d['governor'] for d in doc_blocks[1][0]['basic-dependencies']], [0, 1])
+
+
+class TestCoreNLPChunks(CoreNLPTestCase):
+
+    PARAGRAPHS = [u"Aspirin causes ulcers .\n\n",
+                  u"Great \U0001F600 day \U0001F389 today .\n\n",
+                  u"Lithium causes tremor . It is bad .\n\n",
+                  u"Caf\xe9ine was fine ."]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.parser = OfflineCoreNLPServer(docs_per_request=10, chunk_chars=40)
+
+    def parse(self, docs):
+        """Parse (document, text) pairs with synthesized responses to the requests of group_docs"""
+        groups, parsed = list(self.parser.group_docs(docs)), []
+        for group in groups:
+            text = StanfordCoreNLPServer.DOC_SEPARATOR.join(t for _, t in group)
+            parsed.extend(self.parser.parse_docs_response(group, corenlp_response(text, sentence_lengths(text))))
+        return groups, parsed
+
+    def test_split_text(self):
+        """Chunks are cut at the last paragraph break, else sentence end, else whitespace of each window"""
+        self.assertEqual(self.parser.split_text(u''.join(self.PARAGRAPHS)), [0, 25, 48, 85])
+        self.assertEqual(self.parser.split_text(u"One two . Three four five six . Seven eight nine ten ."),
+                         [0, 32])
+        self.assertEqual(self.parser.split_text(u"one two three four five six seven eight nine ten"),
+                         [0, 40])
+        self.assertEqual(self.parser.split_text(u"x" * 100), [0, 40, 80])
+        self.assertEqual(self.parser.split_text(u"x" * 40), [0])
+
+    def test_default_chunk_chars(self):
+        """By default, only documents over CoreNLP's limit of 100K characters are split"""
+        parser = OfflineCoreNLPServer()
+        text   = u"Aspirin causes ulcers .\n\n" * 4000
+        self.assertEqual(len(list(parser.group_docs([(make_doc('doc'), text[:-1])]))), 1)
+        groups = list(parser.group_docs([(make_doc('doc'), text + text[:-1])]))
+        self.assertEqual([len(t) for g in groups for _, t in g], [100000, len(text) - 1])
+
+    def test_chunked_document(self):
+        """A document parsed in chunks has the same sentences as when parsed in one request"""
+        text = u''.join(self.PARAGRAPHS)
+        docs = [(make_doc('short0'), u"Before ."), (make_doc('long'), text), (make_doc('short1'), u"After .")]
+        groups, parsed = self.parse(docs)
+        self.assertEqual([[d.name for d, _ in g] for g in groups],
+                         [['short0'], ['long'], ['long'], ['long'], ['long'], ['short1']])
+        self.assertEqual([c.start for (c, _), in groups[1:5]], [0, 25, 48, 85])
+
+        document = docs[1][0]
+        parts    = [p for d, p in parsed if d is document]
+        self.assertEqual([p['position'] for p in parts], range(5))
+        self.assertAligned(text, parts, document)
+
+        whole       = make_doc('long')
+        whole_parts = list(self.parser.parse_response(whole, text, corenlp_response(text, sentence_lengths(text))))
+        for p in parts + whole_parts:
+            del p['document']
+        self.assertEqual(parts, whole_parts)
+        self.assertEqual(document.meta, whole.meta)
+
+        # Short documents around the long one are parsed as usual
+        self.assertEqual([(d.name, p['stable_id']) for d, p in parsed if d is not document],
+                         [('short0', 'short0::sentence:0:8'), ('short1', 'short1::sentence:0:7')])
+
+    def test_chunk_offsets_after_astral(self):
+        """Chunk offsets are indices of the document text, past astral characters in earlier chunks"""
+        text     = u"\U0001F600 " * 15 + u". Aspirin causes ulcers ."
+        document = make_doc('astral')
+        _, parsed = self.parse([(document, text)])
+        parts = [p for _, p in parsed]
+        self.assertEqual([p['position'] for p in parts], [0, 1])
+        self.assertAligned(text, parts, document)
+        self.assertEqual(parts[1]['words'], [u"Aspirin", u"causes", u"ulcers", u"."])
+
+
+if __name__ == '__main__':
+    unittest.main()
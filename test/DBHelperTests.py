@@ -0,0 +1,207 @@
+import os, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import make_document, make_sentence, make_sentences, make_span
+from sqlalchemy import event
+from snorkel import db_helpers
+from snorkel.annotations import LabelAnnotator
+from snorkel.models import (Candidate, GoldLabel, GoldLabelKey, Label, LabelKey, SnorkelSession, StableLabel,
+                            candidate_subclass)
+from snorkel.db_helpers import CandidateFetchPlan, load_candidates, reload_annotator_labels
+from snorkel.lf_helpers import get_left_tokens, get_text_between
+
+Pair     = candidate_subclass('Pair', ['left', 'right'])
+Relation = candidate_subclass('Relation', ['subject', 'object'])
+
+# One-letter words, so that each word is its own Span
+WORDS = [chr(ord('a') + i) for i in range(26)]
+
+
+def label_value(i, j):
+    return 1 if (i + j) % 2 else -1
+
+
+class TestReloadAnnotatorLabels(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        sentence    = make_sentence(make_document('pairs'), 0, ' '.join(WORDS))
+        cls.spans   = [make_span(sentence, w) for w in WORDS]
+
+        # A Candidate for each ordered pair of distinct words: more than a RELOAD_BATCH_SIZE of them
+        cls.pairs = [(i, j) for i in range(len(WORDS)) for j in range(len(WORDS)) if i != j]
+        cls.session.add_all(Pair(left=cls.spans[i], right=cls.spans[j], split=0) for i, j in cls.pairs)
+
+        # Labels of the pairs of the first word are in split 1; a label of a pair without a Candidate, and of
+        # a Span which does not exist, cannot be resolved
+        for i, j in cls.pairs:
+            cls.session.add(StableLabel(context_stable_ids=cls.stable_ids(i, j), annotator_name='gold',
+                                        split=1 if i == 0 else 0, value=label_value(i, j)))
+        cls.session.add(StableLabel(context_stable_ids=cls.stable_ids(3, 3), annotator_name='gold', value=1))
+        cls.session.add(StableLabel(context_stable_ids='pairs::span:999:999~~' + cls.spans[0].stable_id,
+                                    annotator_name='gold', value=1))
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    @classmethod
+    def stable_ids(cls, i, j):
+        return cls.spans[i].stable_id + '~~' + cls.spans[j].stable_id
+
+    def setUp(self):
+        self.session.query(GoldLabel).delete()
+        self.session.query(GoldLabelKey).delete()
+        for c in self.session.query(Pair).filter(Pair.left_id == Pair.right_id):
+            self.session.delete(c)
+        self.session.commit()
+
+    def tearDown(self):
+        db_helpers.RELOAD_BATCH_SIZE = 500
+
+    def gold_labels(self):
+        """The GoldLabels of the annotator, by the word indexes of their Candidate's arguments"""
+        index = dict((s.id, i) for i, s in enumerate(self.spans))
+        q     = self.session.query(Pair.left_id, Pair.right_id, GoldLabel.value)
+        q     = q.join(GoldLabel, GoldLabel.candidate_id == Pair.id).join(GoldLabelKey)
+        return dict(((index[l], index[r]), value) for l, r, value in q.filter(GoldLabelKey.name == 'gold'))
+
+    def assertReloads(self):
+        # An existing GoldLabel is kept, and not labeled again
+        key = GoldLabelKey(name='gold')
+        self.session.add(GoldLabel(candidate=self.session.query(Pair).filter(Pair.left_id == self.spans[1].id)
+                                   .filter(Pair.right_id == self.spans[2].id).one(), key=key, value=-1))
+        self.session.commit()
+
+        reload_annotator_labels(self.session, Pair, 'gold', split=0)
+        expected = dict(((i, j), label_value(i, j)) for i, j in self.pairs if i != 0)
+        expected[1, 2] = -1
+        self.assertEqual(len(expected), 625)
+        self.assertEqual(self.gold_labels(), expected)
+
+        # Reloading skips the labeled Candidates
+        reload_annotator_labels(self.session, Pair, 'gold', split=0)
+        self.assertEqual(self.gold_labels(), expected)
+
+        # Labels of any split; the pair without a Candidate is skipped, unless it is created
+        reload_annotator_labels(self.session, Pair, 'gold', split=0, filter_label_split=False)
+        expected.update(((0, j), label_value(0, j)) for j in range(1, len(WORDS)))
+        self.assertEqual(self.gold_labels(), expected)
+
+        reload_annotator_labels(self.session, Pair, 'gold', split=0, filter_label_split=False,
+                                create_missing_cands=True)
+        expected[3, 3] = 1
+        self.assertEqual(self.gold_labels(), expected)
+        self.assertEqual(self.session.query(Pair).filter(Pair.split == 0).count(), len(self.pairs) + 1)
+
+    def test_reload(self):
+        self.assertReloads()
+
+    def test_reload_batches(self):
+        """Stable ids are resolved, and GoldLabels inserted, across batch boundaries"""
+        db_helpers.RELOAD_BATCH_SIZE = 7
+        self.assertReloads()
+
+
+class QueryCounter(object):
+    """Counts the statements executed on an engine within the block"""
+    def __init__(self, engine):
+        self.engine = engine
+        self.n      = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.n += 1
+
+
+def LF_causes(c):
+    return 1 if 'causes' in get_text_between(c) else -1
+
+
+def LF_document(c):
+    return 1 if c[0].get_parent().document.name == 'relations1' else -1
+
+
+def LF_left(c):
+    return 1 if 'aspirin' in get_left_tokens(c[1], window=2) else -1
+
+
+class TestCandidateFetchPlan(unittest.TestCase):
+
+    SPLIT = 2
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        for i in range(3):
+            for sentence in make_sentences(make_document('relations%d' % i),
+                                           ["Aspirin causes ulcers .", "Lithium prevents tremor ."]):
+                words = sentence.words
+                cls.session.add(Relation(subject=make_span(sentence, words[0]), object=make_span(sentence, words[2]),
+                                         split=cls.SPLIT))
+        cls.session.commit()
+        cls.cids = [cid for cid, in cls.session.query(Relation.id).order_by(Relation.id)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def test_batches(self):
+        """Candidates are fetched in the order of their ids, in batches, skipping missing ids"""
+        plan = CandidateFetchPlan(batch_size=4)
+        self.assertEqual(list(plan.batches(range(10))), [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        self.assertEqual(list(plan.batches([])), [])
+
+        cids = self.cids[::-1] + [max(self.cids) + 100] + self.cids[:1]
+        self.assertEqual([c.id for c in plan.fetch(SnorkelSession(), cids)], self.cids[::-1] + self.cids[:1])
+        candidates = load_candidates(SnorkelSession(), self.SPLIT, candidate_class=Relation, fetch_plan=plan)
+        self.assertEqual([c.id for c in candidates], self.cids)
+        self.assertTrue(all(isinstance(c, Relation) for c in candidates))
+
+    def test_prefetch(self):
+        """The argument Spans, Sentences and optionally Documents are loaded with a query per batch of ids each"""
+        # Batches of 4 and 2 Candidates, with 8 + 4 Spans of 4 + 2 Sentences of 2 + 1 Documents
+        for documents, n_queries in [(False, 2 + 3 + 2), (True, 2 + 3 + 2 + 2)]:
+            session = SnorkelSession()
+            plan    = CandidateFetchPlan(batch_size=4, documents=documents)
+            with QueryCounter(session.bind) as counter:
+                candidates = list(plan.fetch(session, self.cids))
+            self.assertEqual(counter.n, n_queries)
+
+            with QueryCounter(session.bind) as counter:
+                for c in candidates:
+                    sentence = c.subject.get_parent()
+                    self.assertIs(c.object.get_parent(), sentence)
+                    self.assertEqual(c.object.get_span(), sentence.words[2])
+            self.assertEqual(counter.n, 0)
+
+            with QueryCounter(session.bind) as counter:
+                names = [c[0].get_parent().document.name for c in candidates]
+            self.assertEqual(names, ['relations%d' % (i / 2) for i in range(6)])
+            self.assertEqual(counter.n, 0 if documents else 3)
+
+    def test_annotator(self):
+        """An Annotator fetching Candidates in batches labels them as when each is loaded on its own"""
+        lfs      = [LF_causes, LF_document, LF_left]
+        session  = SnorkelSession()
+        expected = {}
+        for cid in self.cids:
+            c = session.query(Candidate).filter(Candidate.id == cid).one()
+            expected.update(((cid, lf.__name__), lf(c)) for lf in lfs)
+        self.assertEqual(set(expected.values()), set([-1, 1]))
+
+        for plan in [None, CandidateFetchPlan(batch_size=4, documents=True), CandidateFetchPlan(spans=False)]:
+            LabelAnnotator(lfs, fetch_plan=plan).apply(split=self.SPLIT, progress_bar=False)
+            q = self.session.query(Label.candidate_id, LabelKey.name, Label.value).join(LabelKey)
+            self.assertEqual(dict(((cid, name), value) for cid, name, value in q), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import bz2, gzip, io, os, shutil, sys, tarfile, tempfile, time, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.parsers import TextDocPreprocessor, TSVDocPreprocessor, XMLMultiDocPreprocessor
+
+XML = u"""<?xml version="1.0" encoding="UTF-8"?>
+<documents>
+  <document><id>%s1</id><text>First document.</text></document>
+  <document><id>%s2</id><text>Caf\xe9 document.</text><text>Second section.</text></document>
+</documents>
+"""
+
+
+def write(path, data):
+    """Write bytes to path, compressed according to its extension"""
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'wb')
+    elif path.endswith('.bz2'):
+        f = bz2.BZ2File(path, 'wb')
+    else:
+        f = open(path, 'wb')
+    with f:
+        f.write(data)
+
+
+def gzip_bytes(data):
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+def write_tar(path, members, mode='w'):
+    """Write a tar archive of (name, bytes) members, with a directory entry"""
+    with tarfile.open(path, mode) as tar:
+        info = tarfile.TarInfo('docs')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        for name, data in members:
+            info = tarfile.TarInfo('docs/' + name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+class SlowTextDocPreprocessor(TextDocPreprocessor):
+    """Takes longer over earlier files, so that a pool finishes them out of order"""
+    def parse_file(self, fp, file_name):
+        time.sleep(0.02 * (10 - int(file_name.split('.')[0][3:]) % 10))
+        return list(super(SlowTextDocPreprocessor, self).parse_file(fp, file_name))
+
+
+class TestDocPreprocessors(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def docs(self, preprocessor):
+        return [(doc.name, doc.stable_id, doc.meta['file_name'], text) for doc, text in preprocessor]
+
+    def test_compressed_files(self):
+        """Compressed files are read as their uncompressed contents, named without the compression extension"""
+        write(os.path.join(self.path, 'plain.txt'), "Plain text.")
+        write(os.path.join(self.path, 'gzipped.txt.gz'), "Gzipped text.")
+        write(os.path.join(self.path, 'bzipped.txt.bz2'), u"Bzipped caf\xe9.".encode('utf-8'))
+        docs = sorted(self.docs(TextDocPreprocessor(self.path)))
+        self.assertEqual(docs, [('bzipped', 'bzipped::document:0:0', 'bzipped.txt', u"Bzipped caf\xe9."),
+                                ('gzipped', 'gzipped::document:0:0', 'gzipped.txt', u"Gzipped text."),
+                                ('plain', 'plain::document:0:0', 'plain.txt', u"Plain text.")])
+
+    def test_archive_members(self):
+        """The files of tar archives are read in archive order, including compressed members"""
+        members = [('b.txt', "Member b."), ('a.txt.gz', gzip_bytes("Member a.")),
+                   ('c.txt.bz2', bz2.compress(u"Member caf\xe9.".encode('utf-8')))]
+        for name, mode in [('docs.tar', 'w'), ('docs.tar.gz', 'w:gz'), ('docs.tbz2', 'w:bz2')]:
+            path = os.path.join(self.path, name)
+            write_tar(path, members, mode)
+            self.assertEqual(self.docs(TextDocPreprocessor(path)),
+                             [('b', 'b::document:0:0', 'b.txt', u"Member b."),
+                              ('a', 'a::document:0:0', 'a.txt', u"Member a."),
+                              ('c', 'c::document:0:0', 'c.txt', u"Member caf\xe9.")])
+
+    def test_tsv_encoding(self):
+        """Files are decoded with the preprocessor's encoding"""
+        path = os.path.join(self.path, 'docs.tsv.gz')
+        write(path, u"d1\tCaf\xe9 one.\nd2\tTwo.\n".encode('latin-1'))
+        self.assertEqual([(name, text) for name, _, _, text in self.docs(TSVDocPreprocessor(path, encoding='latin-1'))],
+                         [('d1', u"Caf\xe9 one.\n"), ('d2', u"Two.\n")])
+
+    def test_xml_kwargs(self):
+        """XMLMultiDocPreprocessor passes DocPreprocessor's options on, in archives and streamed"""
+        path = os.path.join(self.path, 'docs.tar.gz')
+        write_tar(path, [('a.xml.bz2', bz2.compress((XML % ('a', 'a')).encode('utf-8'))),
+                         ('skipped.txt', "Not XML."),
+                         ('b.xml', (XML % ('b', 'b')).encode('latin-1').replace('UTF-8', 'ISO-8859-1'))],
+                  'w:gz')
+        expected = [('a1', u"First document."), ('a2', u"Caf\xe9 document.\nSecond section."),
+                    ('b1', u"First document."), ('b2', u"Caf\xe9 document.\nSecond section.")]
+        for stream in [False, True]:
+            for parallelism, executor in [(1, 'thread'), (2, 'thread'), (2, 'process')]:
+                preprocessor = XMLMultiDocPreprocessor(path, stream=stream, parallelism=parallelism,
+                                                       executor=executor, max_docs=3)
+                self.assertEqual((preprocessor.parallelism, preprocessor.executor, preprocessor.max_docs),
+                                 (parallelism, executor, 3))
+                self.assertEqual([(name, text) for name, _, _, text in self.docs(preprocessor)], expected[:3])
+
+    def test_pool_order(self):
+        """Files parsed in a pool are yielded in file order"""
+        for i in range(12):
+            write(os.path.join(self.path, 'doc%d.txt' % i), "Document %d." % i)
+        serial = self.docs(SlowTextDocPreprocessor(self.path))
+        self.assertEqual(sorted(serial), sorted(self.docs(TextDocPreprocessor(self.path))))
+        for executor in ['thread', 'process']:
+            self.assertEqual(self.docs(SlowTextDocPreprocessor(self.path, parallelism=4, executor=executor)), serial)
+        self.assertEqual(self.docs(SlowTextDocPreprocessor(self.path, parallelism=4, max_docs=5)), serial[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
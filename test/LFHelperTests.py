@@ -0,0 +1,127 @@
+import os, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import make_document, make_sentences
+from snorkel.models import Document, Sentence, SnorkelSession, candidate_subclass
+from snorkel.candidates import CandidateExtractor, Ngrams
+from snorkel.matchers import DictionaryMatch
+from snorkel.db_helpers import get_document_span_index, span_index_scope
+from snorkel.lf_helpers import *
+
+ChemicalDisease = candidate_subclass('ChemicalDisease', ['chemical', 'disease'])
+
+TEXTS = ["Aspirin induced gastric ulcers in rats .", "Lithium causes tremor and nausea ."]
+
+
+def extract(sentences, chemicals, diseases):
+    extractor = CandidateExtractor(ChemicalDisease, [Ngrams(n_max=1), Ngrams(n_max=1)],
+                                   [DictionaryMatch(d=chemicals), DictionaryMatch(d=diseases)])
+    extractor.apply(sentences, split=0, progress_bar=False)
+
+
+class TestCandidateSpans(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        cls.session.add_all(make_sentences(make_document('doc0'), TEXTS))
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def get_candidate(self, chemical):
+        for c in self.session.query(ChemicalDisease).all():
+            if c.chemical.get_span() == chemical:
+                return c
+
+    def test_spans_after_reextraction(self):
+        """Spans of a new extraction are visible to the helpers in the same session"""
+        sentences = self.session.query(Sentence).order_by(Sentence.position).all()
+        extract(sentences, ['aspirin', 'lithium'], ['ulcers', 'tremor'])
+        c = self.get_candidate('Aspirin')
+        self.assertEqual([s.get_span() for s in get_sent_candidate_spans(c)], ['ulcers'])
+        self.assertEqual([s.get_span() for s in get_doc_candidate_spans(c)], ['ulcers', 'Lithium', 'tremor'])
+
+        extract(sentences, ['aspirin', 'lithium'], ['ulcers', 'tremor', 'nausea', 'rats'])
+        c = self.get_candidate('Aspirin')
+        self.assertEqual([s.get_span() for s in get_sent_candidate_spans(c)], ['ulcers', 'rats'])
+        self.assertEqual([s.get_span() for s in get_doc_candidate_spans(c)],
+                         ['ulcers', 'rats', 'Lithium', 'tremor', 'nausea'])
+
+    def test_span_index_scope(self):
+        """Span indexes are shared within a span_index_scope only"""
+        document = self.session.query(Document).one()
+        self.assertIsNot(get_document_span_index(document), get_document_span_index(document))
+        with span_index_scope():
+            self.assertIs(get_document_span_index(document), get_document_span_index(document))
+
+
+class TestHelperCaches(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        extract(cls.session.query(Sentence).order_by(Sentence.position).all(), ['aspirin', 'lithium'],
+                ['ulcers', 'tremor', 'nausea', 'rats'])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def get_candidate(self, chemical, disease):
+        for c in self.session.query(ChemicalDisease).all():
+            if (c.chemical.get_span(), c.disease.get_span()) == (chemical, disease):
+                return c
+
+    def assertHelperValues(self, c, d):
+        self.assertEqual(get_tagged_text(c), "{{A}} induced gastric {{B}} in rats .")
+        self.assertEqual(get_text_between(c), " induced gastric ")
+        self.assertEqual(get_left_tokens(c[1], window=2), ['induced', 'gastric'])
+        self.assertEqual(get_right_tokens(c, window=2, n_max=2), ['in', 'in rats', 'rats'])
+        self.assertEqual(get_between_tokens(c, case_sensitive=True), ['induced', 'gastric'])
+        self.assertEqual(get_tagged_text(d), "{{A}} induced gastric ulcers in {{B}} .")
+        self.assertEqual(get_left_tokens(d[1], window=1), ['in'])
+        self.assertEqual(rule_text_btw(c, 'gastric', 1), 1)
+        self.assertEqual(rule_text_btw(d, 'gastric', 1), 1)
+        self.assertEqual(rule_regex_search_btw_AB(c, r'.*GASTRIC\s*', 1), 1)
+        self.assertEqual(rule_regex_search_btw_AB(d, r'\s*in\s*', -1), 0)
+        self.assertEqual(rule_regex_search_btw_BA(c, r'.*', 1), 0)
+        self.assertEqual(rule_regex_search_tagged_text(d, r'ulcers in {{B}}', -1), -1)
+        self.assertEqual(rule_regex_search_before_A(c, r'^', 1), 1)
+        self.assertEqual(rule_regex_search_before_B(d, r'^', 1), 0)
+
+    def test_helpers(self):
+        """The helpers return the same values with their caches on, within a span_index_scope, as without"""
+        c = self.get_candidate('Aspirin', 'ulcers')
+        d = self.get_candidate('Aspirin', 'rats')
+        self.assertHelperValues(c, d)
+        with span_index_scope():
+            for _ in range(2):
+                self.assertHelperValues(c, d)
+            self.assertIs(get_tagged_text(c), get_tagged_text(c))
+
+        # Applied in turn to each Candidate, as by an Annotator
+        with span_index_scope():
+            for x in [c, c, d, d, c]:
+                self.assertEqual(get_tagged_text(x), "".join(get_text_splits(x)))
+                self.assertEqual(get_left_tokens(x[1], window=1), [x[1].get_parent().words[x[1].get_word_start() - 1].lower()])
+
+    def test_modified_sentence(self):
+        """Outside of a span_index_scope, e.g. in a notebook, the helpers see modified and reloaded objects"""
+        c        = self.get_candidate('Aspirin', 'ulcers')
+        sentence = c[0].get_parent()
+        words    = sentence.words
+        self.assertEqual(get_right_tokens(c[0], window=1), ['induced'])
+        try:
+            sentence.words = [words[0], 'Provoked'] + words[2:]
+            self.assertEqual(get_right_tokens(c[0], window=1), ['provoked'])
+            with span_index_scope():
+                self.assertEqual(get_right_tokens(c[0], window=1), ['provoked'])
+        finally:
+            self.session.rollback()
+        self.assertEqual(get_right_tokens(c[0], window=1), ['induced'])
+
+
+if __name__ == '__main__':
+    unittest.main()
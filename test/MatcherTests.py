@@ -1,30 +1,96 @@
-import os, requests, sys, unittest, cPickle
-from time import sleep
+import os, random, re, sys, unittest
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from collections import Counter
 from snorkel.matchers import *
-from snorkel.parser import SentenceParser
+from snorkel.models import Document, Sentence
 from snorkel.candidates import Ngrams
 
-DATA_PATH = os.environ['SNORKELHOME'] + '/test/data/'
+
+def parse_sentence(text):
+    """A Sentence of text, tokenized on whitespace and punctuation, except inside words (e.g. and/or, X-123)"""
+    tokens = list(re.finditer(r'[\w/-]+|[^\w\s]', text, re.U))
+    words  = [m.group() for m in tokens]
+    n      = len(words)
+    return Sentence(document=Document(name='doc', stable_id='doc::document:0:0'), position=0, text=text,
+                    words=words, char_offsets=[m.start() for m in tokens], lemmas=[w.lower() for w in words],
+                    pos_tags=['NN'] * n, ner_tags=['O'] * n, dep_parents=[0] * n, dep_labels=['dep'] * n,
+                    entity_cids=['O'] * n, entity_types=['O'] * n, stable_id='doc::sentence:0:%d' % len(text))
+
+
+class PluralStemmer(object):
+    """Strips a final s, e.g. tacos -> taco"""
+    def stem(self, w):
+        return w[:-1] if w.endswith('s') else w
+
+
+class CountingMatch(NgramMatcher):
+    """Matches the phrases of d, counting its evaluations of each span"""
+    def init(self):
+        self.d      = frozenset(self.opts['d'])
+        self.counts = Counter()
+
+    def _f(self, c):
+        self.counts[self._get_span(c)] += 1
+        return c.get_span().lower() in self.d
+
 
 class TestMatchers(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        with open(DATA_PATH + 'CDR_TestSet_sents.pkl', 'rb') as f:
-            cls.CDR_sents = cPickle.load(f)
-        cls.sp     = SentenceParser()
         cls.ngrams = Ngrams()
 
-    @classmethod
-    def tearDownClass(cls):
-        sleep(1)  # TODO: Fix sentence parser so that this hack not necessary!
-        cls.sp._kill_pserver()
-    
     def test_dictionary_match(self):
         # TODO
         pass
 
+    def test_trie_dictionary_match(self):
+        d         = ['gas', 'Burritos', 'tacos causes', 'causes gas', 'or']
+        dm        = DictionaryMatch(d=d)
+        tm        = TrieDictionaryMatch(d=d)
+        test_sent = "Burritos and/or tacos causes gas."
+        sent      = parse_sentence(test_sent)
+        matches   = list(tm.apply(self.ngrams.apply(sent)))
+        self.assertEqual(matches, list(dm.apply(self.ngrams.apply(sent))))
+        self.assertEqual(sorted(m.get_span() for m in tm.scan(sent)), ["Burritos", "causes gas", "tacos causes"])
+
+        # Spans split from a token (or, of and/or) are not token-aligned, and fall back to DictionaryMatch
+        self.assertIn("or", [m.get_span() for m in matches])
+
+        # Case-sensitive matching
+        tm = TrieDictionaryMatch(d=d, ignore_case=False)
+        dm = DictionaryMatch(d=d, ignore_case=False)
+        sent = parse_sentence("burritos and Tacos causes GAS .")
+        self.assertEqual(list(tm.apply(self.ngrams.apply(sent))), list(dm.apply(self.ngrams.apply(sent))))
+        self.assertEqual([m.get_span() for m in tm.scan(sent)], [])
+
+    def test_trie_dictionary_match_stemmer(self):
+        # The stemmer is applied to each token of the phrases and of the sentence
+        tm   = TrieDictionaryMatch(d=['taco cause', 'burrito'], stemmer=PluralStemmer())
+        sent = parse_sentence("Burritos and tacos causes gas.")
+        self.assertEqual([m.get_span() for m in tm.apply(self.ngrams.apply(sent))], ["tacos causes", "Burritos"])
+        self.assertEqual(sorted(m.get_span() for m in tm.scan(sent)), ["Burritos", "tacos causes"])
+
+    def test_trie_dictionary_match_scale(self):
+        """A large dictionary matches as DictionaryMatch does, in a single structure of comparable size"""
+        rand    = random.Random(0)
+        vocab   = [''.join(rand.choice('abcdefgh') for _ in range(rand.randint(1, 4))) for _ in range(500)]
+        phrases = [' '.join(rand.choice(vocab) for _ in range(rand.randint(1, 4))) for _ in range(20000)]
+        phrases += ['U.S.', 'U.S. aid', 'a/b']
+        dm = DictionaryMatch(d=phrases)
+        tm = TrieDictionaryMatch(d=phrases)
+        self.assertFalse(any(isinstance(v, (set, frozenset)) for v in vars(tm).values()))
+        size = lambda d: sys.getsizeof(d) + sum(sys.getsizeof(w) for w in d)
+        self.assertLess(size(tm.d), 4 * size(dm.d))
+
+        for _ in range(50):
+            words = [rand.choice(vocab + ['U.S.', 'aid', 'a/b', ',']) for _ in range(rand.randint(1, 30))]
+            sent  = parse_sentence(' '.join(words))
+            self.assertEqual(list(tm.apply(self.ngrams.apply(sent))), list(dm.apply(self.ngrams.apply(sent))))
+            self.assertEqual(sorted(m.get_span() for m in tm.scan(sent)),
+                             sorted(m.get_span() for m in dm.apply(self.ngrams.apply(sent))
+                                    if tm._is_token_aligned(m)))
+
     def test_union(self):
         # TODO
         pass
@@ -37,6 +103,68 @@ class TestMatchers(unittest.TestCase):
         # TODO
         pass
 
+    def test_regex_sentence_scan(self):
+        test_sent = "Burritos and tacos cause gas in 123 of 456 cases."
+        sent      = parse_sentence(test_sent)
+        for rm, rm_scan in [
+            (RegexMatchSpan(rgx=r'\d+( of \d+)?'), RegexMatchSpan(rgx=r'\d+( of \d+)?', sentence_scan=True)),
+            (RegexMatchEach(rgx=r'[a-z]+'), RegexMatchEach(rgx=r'[a-z]+', sentence_scan=True)),
+            # Regexes which look past the end of the span are matched per word range
+            (RegexMatchSpan(rgx=r'\d+(?! of)'), RegexMatchSpan(rgx=r'\d+(?! of)', sentence_scan=True)),
+            (RegexMatchSpan(rgx=r'[a-z]+\b.*'), RegexMatchSpan(rgx=r'[a-z]+\b.*', sentence_scan=True)),
+            (RegexMatchSpan(rgx=r'[a-z]+ (and|in) .+', longest_match_only=False),
+             RegexMatchSpan(rgx=r'[a-z]+ (and|in) .+', longest_match_only=False, sentence_scan=True))
+        ]:
+            matches = list(rm.apply(self.ngrams.apply(sent)))
+            self.assertEqual(matches, list(rm_scan.apply(self.ngrams.apply(sent))))
+            self.assertEqual(matches, list(rm_scan.scan(sent, n_max=self.ngrams.n_max)))
+
+    def test_entity_matchers(self):
+        """The entity-type matchers match the same spans over tag runs as RegexMatchEach does per token"""
+        sents = [("John Smith of Acme Corp. visited New York on May 5 , 2017 with 3 Germans and Jane .",
+                  "PERSON PERSON O ORGANIZATION ORGANIZATION O O LOCATION LOCATION O DATE DATE DATE DATE O NUMBER MISC "
+                  "O PERSON O"),
+                 ("Smith-Jones met Smith/Acme in Paris-Berlin .",
+                  "PERSON O PERSON LOCATION LOCATION O"),
+                 ("Alone", "PERSON")]
+        for matcher_class in [PersonMatcher, LocationMatcher, OrganizationMatcher, DateMatcher, NumberMatcher,
+                              MiscMatcher]:
+            for longest_match_only in [True, False]:
+                m      = matcher_class(longest_match_only=longest_match_only, sentence_scan=False)
+                m_scan = matcher_class(longest_match_only=longest_match_only)
+                self.assertTrue(m_scan.sentence_scan)
+                for text, tags in sents * 2:
+                    sent = parse_sentence(text)
+                    sent.ner_tags = tags.split(' ')
+                    self.assertEqual(len(sent.ner_tags), len(sent.words))
+                    matches = list(m.apply(self.ngrams.apply(sent)))
+                    self.assertEqual(list(m_scan.apply(self.ngrams.apply(sent))), matches)
+                    self.assertEqual(list(m_scan.scan(sent, n_max=self.ngrams.n_max)),
+                                     [c for c in matches if m._is_token_aligned(c)] if longest_match_only else
+                                     list(m.apply(Ngrams(split_tokens=None).apply(sent))))
+
+    def test_memoize(self):
+        """A child shared within a composed Matcher is evaluated once per span"""
+        sent = parse_sentence("Burritos and/or tacos cause gas , and tacos burritos cause pain .")
+        def composed(memoize):
+            a = CountingMatch(d=['burritos', 'tacos'])
+            b = CountingMatch(d=['cause gas', 'cause pain', 'gas', 'pain'])
+            return a, [Union(a, Concat(a, b), memoize=memoize), Concat(a, a, permutations=True, memoize=memoize),
+                       Union(a, SlotFillMatch(a, b, pattern="{0} cause {1}"), memoize=memoize)]
+        for k in range(3):
+            a, ms = composed(False)
+            matches = list(ms[k].apply(self.ngrams.apply(sent)))
+            self.assertGreater(max(a.counts.values()), 1)
+            a, ms = composed(True)
+            self.assertEqual(list(ms[k].apply(self.ngrams.apply(sent))), matches)
+            self.assertEqual(max(a.counts.values()), 1)
+            self.assertGreater(len(matches), 0)
+
+        # Leaves evaluated once per span, e.g. a Matcher applied on its own, are not memoized
+        a, b = CountingMatch(d=['tacos']), CountingMatch(d=['gas'])
+        self.assertEqual(a._memoized_nodes(), set())
+        self.assertEqual(Union(a, b)._memoized_nodes(), set())
+
     def test_slot_fill_match(self):
         
         # Test 1
@@ -44,7 +172,7 @@ class TestMatchers(unittest.TestCase):
         rm        = RegexMatchSpan(rgx=r'\d{3}')
         sf        = SlotFillMatch(dm, rm, pattern="{0}-{1}")
         test_sent = "X-123 causes gas."
-        sent      = list(self.sp.parse(test_sent))[0]
+        sent      = parse_sentence(test_sent)
         matches   = list(sf.apply(self.ngrams.apply(sent)))
         self.assertEqual(len(matches), 1)
         self.assertEqual(matches[0].get_span(), "X-123")
@@ -53,7 +181,7 @@ class TestMatchers(unittest.TestCase):
         dm        = DictionaryMatch(d=['Burritos', 'Tacos'], ignore_case=True)
         sf        = SlotFillMatch(dm, pattern="{0} and/or {0}")
         test_sent = "Burritos and/or tacos causes gas."
-        sent      = list(self.sp.parse(test_sent))[0]
+        sent      = parse_sentence(test_sent)
         matches   = list(sf.apply(self.ngrams.apply(sent)))
         self.assertEqual(len(matches), 1)
         self.assertEqual(matches[0].get_span(), "Burritos and/or tacos")
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os, struct, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+# The tests write to a scratch SQLite database, with packed token arrays
+os.environ['SNORKELPACKED'] = '1'
+from db_fixtures import make_document, make_sentence
+
+from sqlalchemy import PickleType
+from sqlalchemy.sql import text
+from snorkel.models import Sentence, SnorkelSession
+from snorkel.models.meta import snorkel_packed_arrays
+from snorkel.models.packed import MAGIC, PackedIntArray, PackedStrArray, pack_int_array, pack_str_array, unpack_array
+
+TOKEN_ARRAYS = ['words', 'char_offsets', 'lemmas', 'pos_tags', 'ner_tags', 'dep_parents', 'dep_labels',
+                'entity_cids', 'entity_types']
+
+
+class TestPackedArrays(unittest.TestCase):
+
+    def round_trip(self, column_type, value):
+        data = column_type.process_bind_param(value, None)
+        return data, column_type.process_result_value(buffer(data), None)
+
+    def test_int_array_format(self):
+        data = pack_int_array([0, -1, 2**31 - 1, 7])
+        self.assertEqual(data, 'SKPAi' + struct.pack('<I4i', 4, 0, -1, 2**31 - 1, 7))
+        self.assertEqual(unpack_array(data), [0, -1, 2**31 - 1, 7])
+        self.assertEqual(unpack_array(pack_int_array([])), [])
+
+    def test_str_array_format(self):
+        """Strings are stored once each, as UTF-8, with None as length -1, followed by 16-bit ids"""
+        data = pack_str_array([u'the', None, u'caf\xe9', u'the', 'ascii'])
+        self.assertEqual(data, 'SKPAs' + struct.pack('<I', 4) +
+                         struct.pack('<i', 3) + 'the' + struct.pack('<i', -1) + struct.pack('<i', 5) + 'caf\xc3\xa9' +
+                         struct.pack('<i', 5) + 'ascii' + struct.pack('<I5H', 5, 0, 1, 2, 0, 3))
+        values = unpack_array(data)
+        self.assertEqual(values, [u'the', None, u'caf\xe9', u'the', u'ascii'])
+        self.assertIs(values[0], values[3])
+
+    def test_large_vocabulary(self):
+        """Over 0xFFFF distinct strings, ids are 32-bit"""
+        values = [unicode(i) for i in range(0x10000)] + [u'0']
+        data   = pack_str_array(values)
+        self.assertEqual(data[-4 * len(values):], struct.pack('<%dI' % len(values), *(range(0x10000) + [0])))
+        self.assertEqual(unpack_array(data), values)
+
+    def test_pickle_fallback(self):
+        """Values which cannot be packed are pickled, and read back unchanged"""
+        for column_type, value in [(PackedIntArray(), [1, 2**31]), (PackedIntArray(), [1, None]),
+                                   (PackedIntArray(), [1.5]), (PackedStrArray(), ['caf\xc3\xa9', 'ascii']),
+                                   (PackedStrArray(), [u'a', 1])]:
+            data, result = self.round_trip(column_type, value)
+            self.assertFalse(data.startswith(MAGIC))
+            self.assertEqual(result, value)
+            self.assertEqual([type(v) for v in result], [type(v) for v in value])
+
+        for column_type, value in [(PackedIntArray(), [3, 1, 2]), (PackedStrArray(), [u'a', None, 'b'])]:
+            data, result = self.round_trip(column_type, value)
+            self.assertTrue(data.startswith(MAGIC))
+            self.assertEqual(result, value)
+        self.assertEqual(self.round_trip(PackedStrArray(), [])[1], [])
+        self.assertIsNone(PackedStrArray().process_bind_param(None, None))
+        self.assertIsNone(PackedStrArray().process_result_value(None, None))
+
+
+@unittest.skipUnless(snorkel_packed_arrays, "Sentences were loaded without SNORKELPACKED")
+class TestPackedSentences(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def make_sentence(self, name, words):
+        return make_sentence(make_document(name), 0, u' '.join(words), dep_parents=range(len(words)),
+                             entity_cids=None, entity_types=['O'] * (len(words) - 1) + [None])
+
+    def raw_columns(self, sentence_id):
+        row = self.session.execute(text("SELECT %s FROM sentence WHERE id = :id" % ', '.join(TOKEN_ARRAYS)),
+                                   {'id': sentence_id}).first()
+        return dict((a, str(v) if v is not None else None) for a, v in zip(TOKEN_ARRAYS, row))
+
+    def test_pickled_rows(self):
+        """Rows written with PickleType, before SNORKELPACKED was set, are still read"""
+        packed   = self.make_sentence('packed', [u'Caf\xe9', u'is', u'open', u'.'])
+        pickled  = self.make_sentence('pickled', [u'Aspirin', u'causes', u'ulcers', u'.'])
+        self.session.add_all([packed, pickled])
+        self.session.commit()
+        expected = dict((s.id, dict((a, getattr(s, a)) for a in TOKEN_ARRAYS)) for s in [packed, pickled])
+
+        # Overwrite the arrays of one row as PickleType wrote them
+        bind = PickleType().bind_processor(self.session.bind.dialect)
+        self.session.execute(text("UPDATE sentence SET %s WHERE id = :id" % ', '.join('%s = :%s' % (a, a)
+                                                                                        for a in TOKEN_ARRAYS)),
+                             dict([('id', pickled.id)] + [(a, bind(expected[pickled.id][a])) for a in TOKEN_ARRAYS]))
+        self.session.commit()
+        self.assertTrue(all(v is None or v.startswith(MAGIC) for v in self.raw_columns(packed.id).values()))
+        self.assertFalse(any(v is not None and v.startswith(MAGIC) for v in self.raw_columns(pickled.id).values()))
+
+        self.session.expire_all()
+        for sentence in self.session.query(Sentence).all():
+            self.assertEqual(dict((a, getattr(sentence, a)) for a in TOKEN_ARRAYS), expected[sentence.id])
+
+        # Rewriting an old row packs it
+        pickled = self.session.query(Sentence).get(pickled.id)
+        pickled.words = pickled.words + [u'!']
+        self.session.commit()
+        self.assertTrue(self.raw_columns(pickled.id)['words'].startswith(MAGIC))
+        self.session.expire_all()
+        self.assertEqual(self.session.query(Sentence).get(pickled.id).words[-2:], [u'.', u'!'])
+
+
+if __name__ == '__main__':
+    unittest.main()
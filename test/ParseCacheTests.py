@@ -0,0 +1,127 @@
+import os, shutil, sys, tempfile, time, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.models import Document, construct_stable_id
+from snorkel.parsers import Parser, ParserConnection, ParseCache, CachedParserConnection
+from snorkel.parsers.cache import _to_record, _from_record
+from CoreNLPTests import OfflineCoreNLPServer
+
+
+class SentenceParser(Parser):
+    """Splits texts into sentences at ' . '"""
+    def __init__(self):
+        super(SentenceParser, self).__init__(name='sentences')
+
+    def parse(self, document, text):
+        start = 0
+        for position, sentence in enumerate(s for s in text.split(' . ') if len(s) > 0):
+            start = text.index(sentence, start)
+            document.meta.setdefault('abs_sent_offset', {})[position] = start
+            yield {'document': document, 'position': position, 'text': sentence, 'words': sentence.split(),
+                   'stable_id': construct_stable_id(document, 'sentence', start, start + len(sentence))}
+            start += len(sentence)
+
+
+class CountingConnection(ParserConnection):
+    """Parses documents one at a time, recording the documents of each parse_docs call"""
+    def __init__(self, parser):
+        super(CountingConnection, self).__init__(parser)
+        self.calls = []
+
+    def parse(self, document, text):
+        return self.parser.parse(document, text)
+
+    def parse_docs(self, docs):
+        docs = list(docs)
+        self.calls.append([document.name for document, _ in docs])
+        return super(CountingConnection, self).parse_docs(docs)
+
+
+def make_doc(name, start=0, end=0):
+    return Document(name=name, stable_id='%s::document:%d:%d' % (name, start, end), meta={})
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path  = tempfile.mkdtemp()
+        self.cache = ParseCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def parse(self, connection, docs):
+        parsed = list(CachedParserConnection(connection, self.cache).parse_docs(docs))
+        return [(d.name, p['position'], p['text'], p['stable_id']) for d, p in parsed]
+
+    def test_record_round_trip(self):
+        """Records are relative to their document, and restore its parse meta data"""
+        document = make_doc('a', 10, 40)
+        document.meta = {'tree': {0: '(ROOT a)', 1: '(ROOT b)'}, 'abs_sent_offset': {0: 0, 1: 8}, 'title': 'A'}
+        sentences = [{'document': document, 'position': 0, 'text': 'One two', 'stable_id': 'a::sentence:10:17'},
+                     {'document': document, 'position': 1, 'text': 'Three', 'stable_id': 'a::sentence:18:23'}]
+        self.cache.put('k', _to_record(document, sentences))
+        record = self.cache.get('k')
+
+        restored = make_doc('b')
+        parts    = list(_from_record(restored, record))
+        self.assertEqual([p['stable_id'] for p in parts], ['b::sentence:0:7', 'b::sentence:8:13'])
+        self.assertEqual([p['text'] for p in parts], ['One two', 'Three'])
+        self.assertTrue(all(p['document'] is restored for p in parts))
+        self.assertEqual(restored.meta, {'tree': {0: '(ROOT a)', 1: '(ROOT b)'}, 'abs_sent_offset': {0: 0, 1: 8}})
+
+        # A document without meta data, or ids of its own, gets the cached sentences only
+        restored = Document(name='c', stable_id='c::document:0:0')
+        self.assertEqual([p['stable_id'] for p in _from_record(restored, record)],
+                         ['c::sentence:0:7', 'c::sentence:8:13'])
+        self.assertEqual(restored.meta['abs_sent_offset'], {0: 0, 1: 8})
+        self.assertEqual([p.get('stable_id') for p in _from_record(None, record)], [None, None])
+
+    def test_cached_connection(self):
+        """Misses are parsed in one call and attributed by position, including documents without sentences"""
+        texts      = ["A b . C", "", "D . E f . G", "A b . C"]
+        connection = CountingConnection(SentenceParser())
+        docs       = [(make_doc('doc%d' % i), t) for i, t in enumerate(texts)]
+        parsed     = self.parse(connection, docs)
+        self.assertEqual(connection.calls, [['doc0', 'doc1', 'doc2', 'doc3']])
+        self.assertEqual(parsed, [('doc0', 0, 'A b', 'doc0::sentence:0:3'), ('doc0', 1, 'C', 'doc0::sentence:6:7'),
+                                  ('doc2', 0, 'D', 'doc2::sentence:0:1'), ('doc2', 1, 'E f', 'doc2::sentence:4:7'),
+                                  ('doc2', 2, 'G', 'doc2::sentence:10:11'),
+                                  ('doc3', 0, 'A b', 'doc3::sentence:0:3'), ('doc3', 1, 'C', 'doc3::sentence:6:7')])
+
+        # Cached documents are not parsed again, and the others are still parsed in one call
+        docs   = [(make_doc('new%d' % i), t) for i, t in enumerate(["D . E f . G", "H", "A b . C", "I . J"])]
+        parsed = self.parse(connection, docs)
+        self.assertEqual(connection.calls[1:], [['new1', 'new3']])
+        self.assertEqual(parsed, [('new0', 0, 'D', 'new0::sentence:0:1'), ('new0', 1, 'E f', 'new0::sentence:4:7'),
+                                  ('new0', 2, 'G', 'new0::sentence:10:11'), ('new1', 0, 'H', 'new1::sentence:0:1'),
+                                  ('new2', 0, 'A b', 'new2::sentence:0:3'), ('new2', 1, 'C', 'new2::sentence:6:7'),
+                                  ('new3', 0, 'I', 'new3::sentence:0:1'), ('new3', 1, 'J', 'new3::sentence:4:5')])
+        self.assertEqual(docs[0][0].meta, {'abs_sent_offset': {0: 0, 1: 4, 2: 10}})
+
+    def test_eviction(self):
+        """Over max_bytes, the least recently used entries are evicted"""
+        keys = ['%02d' % i for i in range(4)]
+        self.cache.put(keys[0], {'sentences': [], 'meta': {}})
+        size = self.cache._size()
+        self.cache = ParseCache(self.path, max_bytes=3.5 * size)
+        for key in keys[1:3]:
+            self.cache.put(key, {'sentences': [], 'meta': {}})
+
+        # Reading an entry marks it as recently used
+        now = time.time()
+        for i, key in enumerate(keys[:3]):
+            os.utime(self.cache._entry_path(key), (now - 100 + i, now - 100 + i))
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.put(keys[3], {'sentences': [], 'meta': {}})
+        self.assertEqual([key for key in keys if self.cache.get(key) is not None], ['00', '02', '03'])
+        self.assertLessEqual(self.cache.n_bytes, 3.5 * size)
+
+    def test_cache_key(self):
+        """Parsers chunking long documents differently do not share entries"""
+        keys = [self.cache.key(OfflineCoreNLPServer(chunk_chars=n), u"text") for n in [100, 100, 200]]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,379 @@
+"""
+Offline throughput benchmark of the parsing stage (CorpusParser / CorpusParserUDF).
+
+A local stand-in for the CoreNLP server, running in its own process, replays recorded CoreNLP JSON responses
+after a configurable latency, so that no JVM is needed. Responses for requests without a recording are synthesized
+in CoreNLP's format before the benchmark starts.
+The benchmark parses the CDR test set into a scratch SQLite database, and reports documents and sentences
+per second, and the time spent in each phase: HTTP requests, response decoding, conversion to sentence parts,
+ORM construction and insertion.
+
+Usage::
+
+    # Benchmark against the stand-in server
+    python test/ParserBenchmark.py --latency 0.05 --window 8 --docs-per-request 4
+
+    # Record the responses of a live CoreNLP server, then replay them
+    python test/ParserBenchmark.py --record responses.json.gz
+    python test/ParserBenchmark.py --responses responses.json.gz
+
+    # Fail (e.g. in CI) below a throughput
+    python test/ParserBenchmark.py --min-docs-per-sec 50
+"""
+import argparse, gzip, hashlib, json, os, re, sys, tempfile, threading, time
+import requests
+from multiprocessing import Process, Value
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+from contextlib import contextmanager
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+
+ROOT = os.environ.get('SNORKELHOME', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class PhaseTimer(object):
+    """Thread-safe accumulator of the time spent in each phase"""
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.lock   = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.totals[phase] += seconds
+
+    @contextmanager
+    def time(self, phase):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - t)
+
+    def wrap(self, phase, fn):
+        def timed(*args, **kwargs):
+            with self.time(phase):
+                return fn(*args, **kwargs)
+        return timed
+
+    def wrap_iter(self, phase, fn):
+        """Times a generator function, excluding the time its consumer spends between items"""
+        def timed(*args, **kwargs):
+            it = iter(fn(*args, **kwargs))
+            while True:
+                with self.time(phase):
+                    try:
+                        x = next(it)
+                    except StopIteration:
+                        return
+                yield x
+        return timed
+
+
+def synthesize_response(text, version='3.6.0'):
+    """A response in CoreNLP's JSON format, with all the fields a real response has, for text"""
+    dep_key = {'3.6.0': 'basic-dependencies', '3.7.0': 'basicDependencies'}[version]
+    sents, toks = [], []
+    for m in re.finditer(r'\w+|[^\w\s]|\n\s*\n', text, re.U):
+        w = m.group()
+        if not w.strip():
+            if len(toks) > 0:
+                sents.append(toks)
+                toks = []
+            continue
+        toks.append({'word': w, 'originalText': w, 'lemma': w.lower(), 'characterOffsetBegin': m.start(),
+                     'characterOffsetEnd': m.end(), 'pos': 'NN', 'ner': 'O', 'speaker': 'PER0',
+                     'before': ' ', 'after': ' '})
+        if w in ('.', '!', '?'):
+            sents.append(toks)
+            toks = []
+    if len(toks) > 0:
+        sents.append(toks)
+
+    blocks = []
+    for i, toks in enumerate(sents):
+        for k, t in enumerate(toks):
+            t['index'] = k + 1
+        deps = [{'dep': 'ROOT' if k == 0 else 'dep', 'governor': 0 if k == 0 else k, 'governorGloss': 'ROOT' if k == 0
+                 else toks[k - 1]['word'], 'dependent': k + 1, 'dependentGloss': t['word']} for k, t in enumerate(toks)]
+        tree = '(ROOT\n  (S\n' + '\n'.join('    (NN %s)' % t['word'] for t in toks) + '))'
+        block = {'index': i, 'parse': tree, dep_key: deps, 'tokens': toks}
+        for key in (['collapsed-dependencies', 'collapsed-ccprocessed-dependencies'] if version == '3.6.0'
+                    else ['enhancedDependencies', 'enhancedPlusPlusDependencies']):
+            block[key] = deps
+        blocks.append(block)
+    return json.dumps({'sentences': blocks}, indent=2)
+
+
+def request_key(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def load_responses(path):
+    with gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb') as f:
+        return json.load(f)
+
+
+def save_responses(responses, path):
+    with gzip.open(path, 'wb') if path.endswith('.gz') else open(path, 'wb') as f:
+        json.dump(responses, f)
+
+
+class MockCoreNLPHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        body   = self.rfile.read(int(self.headers['Content-Length']))
+        key    = request_key(body)
+        if key in server.responses:
+            content = server.responses[key]
+        else:
+            content = synthesize_response(body.decode('utf-8'), server.version)
+        with server.n_requests.get_lock():
+            server.n_requests.value += 1
+        if key in server.recorded:
+            with server.n_replayed.get_lock():
+                server.n_replayed.value += 1
+        time.sleep(server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class MockCoreNLPServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server standing in for CoreNLP, replaying responses after latency seconds"""
+    daemon_threads = True
+
+    def __init__(self, port, responses, recorded, latency, version, n_requests, n_replayed):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockCoreNLPHandler)
+        self.responses  = responses
+        self.recorded   = recorded
+        self.latency    = latency
+        self.version    = version
+        self.n_requests = n_requests
+        self.n_replayed = n_replayed
+
+
+def _serve(*args):
+    MockCoreNLPServer(*args).serve_forever()
+
+
+class CaptureConnection(object):
+    """Stands in for a requests session, capturing the bodies of the requests a parser would send"""
+    def __init__(self):
+        self.bodies = []
+
+    def post(self, url, data=None, **kwargs):
+        self.bodies.append(data)
+        return self
+
+    content = ''
+
+
+def benchmark_parser_class():
+    """StanfordCoreNLPServer talking to a MockCoreNLPServer, with its parsing phases timed"""
+    from snorkel.parsers import StanfordCoreNLPServer
+
+    class BenchmarkCoreNLPServer(StanfordCoreNLPServer):
+
+        def __init__(self, timer, latency=0.0, **kwargs):
+            self.timer      = timer
+            self.latency    = latency
+            self.mock       = None
+            self.n_requests = Value('i', 0)
+            self.n_replayed = Value('i', 0)
+            super(BenchmarkCoreNLPServer, self).__init__(**kwargs)
+
+        def _start_server(self, force_load=False):
+            self.process_group = None
+
+        def start_mock(self, docs, batch_size, recorded=None):
+            '''
+            Start the stand-in server, with responses to all the requests parsing docs in batches will send
+            :param docs:
+            :param batch_size:
+            :param recorded: recorded responses, by request_key of the request body
+            :return:
+            '''
+            recorded  = recorded or {}
+            responses = {}
+            groups    = [g for i in range(0, len(docs), batch_size) for g in self.group_docs(docs[i:i + batch_size])]
+            for group in groups:
+                conn = CaptureConnection()
+                self.request_docs(group, conn)
+                for body in conn.bodies:
+                    key = request_key(body)
+                    responses[key] = recorded[key].encode('utf-8') if key in recorded \
+                        else synthesize_response(body.decode('utf-8'), self.version)
+
+            self.mock = Process(target=_serve, args=(self.port, responses, set(recorded), self.latency, self.version,
+                                                     self.n_requests, self.n_replayed))
+            self.mock.daemon = True
+            self.mock.start()
+            while True:
+                try:
+                    requests.get('http://127.0.0.1:%d/' % self.port, timeout=1)
+                    break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.1)
+
+            # Time the phases
+            self.request      = self.timer.wrap('http', self.request)
+            self.load_blocks  = self.timer.wrap('decode', self.load_blocks)
+            self.parse_blocks = self.timer.wrap_iter('convert', self.parse_blocks)
+
+        def close(self):
+            if self.mock is not None:
+                self.mock.terminate()
+                self.mock.join()
+                self.mock = None
+
+    return BenchmarkCoreNLPServer
+
+
+def benchmark_corpus_parser_class():
+    """CorpusParser timing the construction and insertion of Sentences"""
+    from snorkel.models import Sentence
+    from snorkel.parsers import CorpusParser, CorpusParserUDF
+
+    class BenchmarkCorpusParserUDF(CorpusParserUDF):
+
+        def __init__(self, timer, **kwargs):
+            super(BenchmarkCorpusParserUDF, self).__init__(**kwargs)
+            self.timer = timer
+            self.session.add    = timer.wrap('insert', self.session.add)
+            self.session.commit = timer.wrap('insert', self.session.commit)
+
+        def apply(self, x, **kwargs):
+            for doc, parts in self.req_handler.parse_docs(x):
+                with self.timer.time('orm'):
+                    parts = self.fn(parts) if self.fn is not None else parts
+                    sentence = Sentence(**parts)
+                yield sentence
+
+    class BenchmarkCorpusParser(CorpusParser):
+
+        def __init__(self, timer, **kwargs):
+            super(BenchmarkCorpusParser, self).__init__(**kwargs)
+            self.udf_class = BenchmarkCorpusParserUDF
+            self.udf_init_kwargs['timer'] = timer
+
+    return BenchmarkCorpusParser
+
+
+def load_corpus(max_docs):
+    from snorkel.parsers import XMLMultiDocPreprocessor
+    preprocessor = XMLMultiDocPreprocessor(path=os.path.join(ROOT, 'test/data/CDR_TestSet.xml'),
+                                           doc='.//document', text='.//passage/text/text()', id='.//id/text()')
+    preprocessor.max_docs = max_docs
+    return list(preprocessor)
+
+
+def record(args):
+    """Parse the corpus with a live CoreNLP server, saving its responses"""
+    from snorkel.parsers import StanfordCoreNLPServer
+    responses = {}
+    parser    = StanfordCoreNLPServer(port=args.port, version=args.version, docs_per_request=args.docs_per_request)
+    request   = parser.request
+
+    def recording_request(document, text, conn):
+        content = request(document, text, conn)
+        if content is not None:
+            body = text.encode('utf-8') if isinstance(text, unicode) else text
+            responses[request_key(body)] = content.decode('utf-8')
+        return content
+
+    parser.request = recording_request
+    conn = parser.connect()
+    n = sum(1 for _ in conn.parse_docs(load_corpus(args.max_docs)))
+    parser.close()
+    save_responses(responses, args.record)
+    print "Recorded %d responses (%d sentences) to %s" % (len(responses), n, args.record)
+
+
+def run(args):
+    from snorkel import SnorkelSession
+    from snorkel.models import Document, Sentence
+
+    timer     = PhaseTimer()
+    parser    = benchmark_parser_class()(timer, latency=args.latency, port=args.port, version=args.version,
+                                         parse_window=args.window, docs_per_request=args.docs_per_request)
+    corpus    = load_corpus(args.max_docs)
+    n_chars   = sum(len(text) for _, text in corpus)
+
+    corpus_parser = benchmark_corpus_parser_class()(timer, parser=parser, batch_size=args.batch_size)
+    parser.start_mock(corpus, corpus_parser.batch_size, load_responses(args.responses) if args.responses else None)
+    t = time.time()
+    corpus_parser.apply(corpus, progress_bar=False)
+    wall = time.time() - t
+
+    session     = SnorkelSession()
+    n_docs      = session.query(Document).count()
+    n_sentences = session.query(Sentence).count()
+    n_requests  = parser.n_requests.value
+    n_replayed  = parser.n_replayed.value
+    parser.close()
+
+    print "=" * 60
+    print "documents:          %d (%d chars)" % (n_docs, n_chars)
+    print "sentences:          %d" % n_sentences
+    print "requests:           %d (%d replayed, latency %.3fs)" % (n_requests, n_replayed, args.latency)
+    print "window / docs/req:  %d / %d" % (args.window, args.docs_per_request)
+    print "wall time:          %.3fs" % wall
+    print "documents / sec:    %.1f" % (n_docs / wall)
+    print "sentences / sec:    %.1f" % (n_sentences / wall)
+    print "-" * 60
+    for phase, label in [('http', 'HTTP (summed over threads)'), ('decode', 'decode'), ('convert', 'convert'),
+                         ('orm', 'ORM construction'), ('insert', 'insert')]:
+        print "%-28s %8.3fs %6.1f%%" % (label, timer.totals[phase], 100.0 * timer.totals[phase] / wall)
+    print "=" * 60
+
+    if args.min_docs_per_sec is not None and n_docs / wall < args.min_docs_per_sec:
+        print "FAILED: %.1f documents / sec < %.1f" % (n_docs / wall, args.min_docs_per_sec)
+        return 1
+    return 0
+
+
+def main():
+    p = argparse.ArgumentParser(description="Offline parser throughput benchmark")
+    p.add_argument('--max-docs', type=int, default=500, help="number of documents of the CDR test set to parse")
+    p.add_argument('--latency', type=float, default=0.0, help="seconds before the stand-in server responds")
+    p.add_argument('--window', type=int, default=1, help="concurrent requests per connection")
+    p.add_argument('--docs-per-request', type=int, default=1)
+    p.add_argument('--batch-size', type=int, default=None, help="documents per CorpusParser batch")
+    p.add_argument('--version', default='3.6.0', help="CoreNLP version of the responses")
+    p.add_argument('--port', type=int, default=12399)
+    p.add_argument('--responses', default=None, help="recorded responses to replay")
+    p.add_argument('--record', default=None, help="record the responses of a live CoreNLP server to this file")
+    p.add_argument('--db', default=None, help="database connection string, by default a scratch SQLite file")
+    p.add_argument('--min-docs-per-sec', type=float, default=None, help="exit with an error below this throughput")
+    args = p.parse_args()
+
+    # The benchmark clears all contexts: never run it against a working database by accident
+    db = args.db
+    if db is None:
+        fd, db_path = tempfile.mkstemp(suffix='.db', prefix='snorkel-benchmark-')
+        os.close(fd)
+        db = 'sqlite:///' + db_path
+    os.environ['SNORKELDB'] = db
+    os.environ.setdefault('SNORKELHOME', ROOT)
+
+    try:
+        return record(args) if args.record else run(args)
+    finally:
+        if args.db is None:
+            os.remove(db_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import os, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import TMP_PATH, make_document, make_sentences, make_span
+from snorkel.models import SnorkelSession, candidate_subclass
+from snorkel.snapshot import CorpusSnapshot, export_snapshot, INT_ATTRIBS, STR_ATTRIBS
+from snorkel.lf_helpers import get_between_tokens, get_left_tokens
+
+ChemicalDisease = candidate_subclass('ChemicalDisease', ['chemical', 'disease'])
+
+TEXTS = [["Aspirin induced gastric ulcers in rats .", "Lithium causes tremor ."],
+         [u"Caf\xe9ine was not linked to nausea ."]]
+
+
+class TestSnapshot(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        sentences   = []
+        for i, texts in enumerate(TEXTS):
+            sentences.extend(make_sentences(make_document('doc%d' % i), texts, entity_cids=None))
+        # Distinct dep_parents, and no entity_cids, so that the round trip checks their order and nulls
+        for sentence in sentences:
+            sentence.dep_parents = range(len(sentence.words))
+        cls.session.add_all(sentences)
+
+        # CIDs as PretaggedCandidateExtractor stores them: MeSH ids, which SQLite keeps as text, and integers
+        pairs = [(sentences[0], 'Aspirin', 'ulcers', u'D001241', u'D014456'),
+                 (sentences[1], 'Lithium', 'tremor', u'D008094', 7),
+                 (sentences[2], u'Caf\xe9ine', 'nausea', None, u'D009325')]
+        for sentence, chemical, disease, chemical_cid, disease_cid in pairs:
+            cls.session.add(ChemicalDisease(chemical=make_span(sentence, chemical), disease=make_span(sentence, disease),
+                                            chemical_cid=chemical_cid, disease_cid=disease_cid, split=0))
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def export(self, name):
+        path = os.path.join(TMP_PATH, name)
+        export_snapshot(self.session, ChemicalDisease, path, split=0)
+        return CorpusSnapshot(path)
+
+    def test_round_trip(self):
+        snapshot   = self.export('snapshot')
+        candidates = self.session.query(ChemicalDisease).order_by(ChemicalDisease.id).all()
+        self.assertEqual(len(snapshot), len(candidates))
+        for c, v in zip(candidates, snapshot):
+            self.assertEqual(v.id, c.id)
+            self.assertEqual(v.get_cids(), c.get_cids())
+            for span, span_view in zip(c.get_contexts(), v.get_contexts()):
+                self.assertEqual(span_view.id, span.id)
+                self.assertEqual(span_view.stable_id, span.stable_id)
+                self.assertEqual(span_view.get_span(), span.get_span())
+                self.assertEqual(span_view.get_word_start(), span.get_word_start())
+            sentence, sentence_view = c.get_parent(), v.get_parent()
+            self.assertEqual(sentence_view.text, sentence.text)
+            self.assertEqual(sentence_view.stable_id, sentence.stable_id)
+            self.assertEqual(sentence_view.document.name, sentence.document.name)
+            for a in INT_ATTRIBS + STR_ATTRIBS:
+                self.assertEqual(getattr(sentence_view, a), getattr(sentence, a))
+            self.assertEqual(list(get_between_tokens(v)), list(get_between_tokens(c)))
+            self.assertEqual(list(get_left_tokens(v[1], window=2)), list(get_left_tokens(c[1], window=2)))
+
+    def test_annotate(self):
+        def LF_causes(c):
+            return 1 if 'causes' in get_between_tokens(c) else 0
+        def LF_not(c):
+            return -1 if 'not' in get_between_tokens(c) else 0
+        snapshot = self.export('snapshot_lfs')
+        X, names = snapshot.annotate([LF_causes, LF_not])
+        self.assertEqual(names, ['LF_causes', 'LF_not'])
+        self.assertEqual(X.todense().tolist(), [[0, 0], [1, 0], [0, -1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import os, re, shutil, sys, tempfile, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import make_document
+from StringIO import StringIO
+from snorkel.models import Document, Sentence, SnorkelSession
+from snorkel.parsers import CorpusParser, ParseCache
+from snorkel.parsers import spacy as spacy_parser
+
+TEXTS = ["Ann met Bob in Paris . He left .", "", "Rain fell ."]
+
+
+class StubToken(object):
+    """A token of a StubDoc, headed by the previous token of its sentence, and typed PERSON if titled"""
+    def __init__(self, doc, i, word, idx, head_i):
+        self.doc       = doc
+        self.i         = i
+        self.word      = word
+        self.idx       = idx
+        self.head_i    = head_i
+        self.lemma_    = word.lower()
+        self.tag_      = 'NN'
+        self.ent_type_ = 'PERSON' if word.istitle() else ''
+        self.dep_      = 'ROOT' if head_i == i else 'dep'
+
+    @property
+    def head(self):
+        return self.doc.tokens[self.head_i]
+
+    def __unicode__(self):
+        return self.word
+
+
+class StubSpan(object):
+    def __init__(self, doc, start, end):
+        self.doc   = doc
+        self.start = start
+        self.end   = end
+        self.text  = doc.text[doc.tokens[start].idx:doc.tokens[end - 1].idx + len(doc.tokens[end - 1].word)]
+
+    def __iter__(self):
+        return iter(self.doc.tokens[self.start:self.end])
+
+
+class StubDoc(object):
+    """A Doc of whitespace-separated tokens, with sentences ending at '.'"""
+    is_parsed = True
+
+    def __init__(self, text):
+        self.text   = text
+        self.tokens = []
+        self.sents  = []
+        start       = 0
+        for m in re.finditer(r'\S+', text):
+            i = len(self.tokens)
+            self.tokens.append(StubToken(self, i, m.group(), m.start(), max(start, i - 1)))
+            if m.group() == '.':
+                self.sents.append(StubSpan(self, start, i + 1))
+                start = i + 1
+
+
+class StubModel(object):
+    """Reads texts batch_size at a time, recording the worker arguments of each pipe() call"""
+    lang = 'en'
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        return StubDoc(text)
+
+    def pipe(self, texts, batch_size, **workers):
+        self.calls.append(workers)
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == batch_size:
+                for text in batch:
+                    yield StubDoc(text)
+                batch = []
+        for text in batch:
+            yield StubDoc(text)
+
+
+class StubSpaCyModule(object):
+    class about(object):
+        __version__ = '2.3.0'
+
+    @staticmethod
+    def load(lang):
+        return StubModel()
+
+
+class TestSpaCy(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.spacy          = getattr(spacy_parser, 'spacy', None)
+        spacy_parser.spacy = StubSpaCyModule
+        cls.session        = SnorkelSession()
+
+    @classmethod
+    def tearDownClass(cls):
+        spacy_parser.spacy = cls.spacy
+        cls.session.close()
+
+    def test_parse_doc(self):
+        """Docs are converted to CoreNLP's format, with integer dep_parents relative to each sentence"""
+        document = Document(name='doc', stable_id='doc::document:0:0')
+        parts    = list(spacy_parser.SpaCy().parse(document, TEXTS[0]))
+        self.assertEqual([p['text'] for p in parts], ["Ann met Bob in Paris .", "He left ."])
+        self.assertEqual([p['position'] for p in parts], [0, 1])
+        self.assertEqual(parts[1]['words'], [u'He', u'left', u'.'])
+        self.assertEqual(parts[1]['lemmas'], [u'he', u'left', u'.'])
+        self.assertEqual(parts[1]['char_offsets'], [0, 3, 8])
+        self.assertEqual([p['dep_parents'] for p in parts], [[0, 1, 2, 3, 4, 5], [0, 1, 2]])
+        self.assertTrue(all(type(i) is int for p in parts for i in p['dep_parents']))
+        self.assertEqual(parts[1]['dep_labels'], ['ROOT', 'dep', 'dep'])
+        self.assertEqual(parts[0]['ner_tags'], ['PERSON', 'O', 'PERSON', 'O', 'PERSON', 'O'])
+        self.assertEqual(parts[0]['entity_cids'], ['O'] * 6)
+        self.assertEqual(parts[0]['entity_types'], ['O'] * 6)
+        self.assertEqual([p['stable_id'] for p in parts], ['doc::sentence:0:22', 'doc::sentence:23:32'])
+        self.assertEqual(document.meta, {'abs_sent_offset': {0: 0, 1: 23}})
+        self.assertTrue(all(p['document'] is document for p in parts))
+
+    def test_parse_docs(self):
+        """Documents are streamed through one pipe() call, and attributed to their docs in order"""
+        for version, workers in [('2.3.0', {'n_process': 2}), ('2.1.0', {'n_threads': 2})]:
+            StubSpaCyModule.about.__version__ = version
+            try:
+                parser = spacy_parser.SpaCy(batch_size=2, n_workers=2)
+                docs   = [(make_document('doc%d' % i), text) for i, text in enumerate(TEXTS * 2)]
+                parsed = [(d.name, p['stable_id']) for d, p in parser.connect().parse_docs(iter(docs))]
+            finally:
+                StubSpaCyModule.about.__version__ = '2.3.0'
+            self.assertEqual(parser.model.calls, [workers])
+            self.assertEqual(parsed, [('doc0', 'doc0::sentence:0:22'), ('doc0', 'doc0::sentence:23:32'),
+                                      ('doc2', 'doc2::sentence:0:11'),
+                                      ('doc3', 'doc3::sentence:0:22'), ('doc3', 'doc3::sentence:23:32'),
+                                      ('doc5', 'doc5::sentence:0:11')])
+
+    def test_corpus_parser(self):
+        """A single-threaded CorpusParser calls pipe() once over the corpus, or once per batch with a cache"""
+        cache_path = tempfile.mkdtemp()
+        try:
+            # With a cache, the batch of the last two documents repeats cached texts, and is not parsed
+            for cache, n_calls in [(None, 1), (ParseCache(cache_path), 2)]:
+                parser = spacy_parser.SpaCy(batch_size=2, n_workers=2)
+                docs   = [(make_document('doc%d' % i), text) for i, text in enumerate(TEXTS * 2)]
+                CorpusParser(parser, cache=cache).apply(docs, progress_bar=False)
+                self.assertEqual(len(parser.model.calls), n_calls)
+                self.assertEqual(self.session.query(Sentence).count(), 6)
+        finally:
+            shutil.rmtree(cache_path)
+
+    def test_corpus_parser_progress_bar(self):
+        """The progress bar of a streamed corpus counts documents, and is hidden with progress_bar=False"""
+        for progress_bar in [False, True]:
+            docs   = [(make_document('doc%d' % i), text) for i, text in enumerate(TEXTS * 2)]
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                CorpusParser(spacy_parser.SpaCy(n_workers=2)).apply(iter(docs), count=len(docs),
+                                                                    progress_bar=progress_bar)
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertEqual('100%' in output, progress_bar)
+            self.assertEqual(self.session.query(Sentence).count(), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
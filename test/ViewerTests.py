@@ -0,0 +1,129 @@
+import os, re, sys, unittest
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from db_fixtures import make_document, make_sentences, make_span
+from snorkel.models import GoldLabel, GoldLabelKey, SnorkelSession, StableLabel, candidate_subclass
+
+# The Viewer module can only be imported with IPython and ipywidgets installed
+try:
+    from snorkel import viewer
+except Exception:
+    viewer = None
+
+ChemicalDisease = candidate_subclass('ChemicalDisease', ['chemical', 'disease'])
+
+TEXTS = [["Aspirin induced ulcers and nausea .", "Lithium causes tremor ."],
+         ["Caffeine causes nausea .", "No candidates here .", "Aspirin prevents tremor and ulcers ."]]
+
+# The Candidates of each Sentence, by the positions of their documents and sentences
+PAIRS = [(0, 0, 'Aspirin', 'nausea'), (0, 0, 'Aspirin', 'ulcers'), (0, 1, 'Lithium', 'tremor'),
+         (1, 0, 'Caffeine', 'nausea'), (1, 2, 'Aspirin', 'ulcers'), (1, 2, 'Aspirin', 'tremor')]
+
+
+@unittest.skipUnless(viewer is not None, "The Viewer requires IPython and ipywidgets")
+class TestViewer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        sentences   = [make_sentences(make_document('viewer%d' % i), texts) for i, texts in enumerate(TEXTS)]
+        spans       = {}
+        for i, j, chemical, disease in PAIRS:
+            sentence = sentences[i][j]
+            for word in [chemical, disease]:
+                if (i, j, word) not in spans:
+                    spans[i, j, word] = make_span(sentence, word)
+            cls.session.add(ChemicalDisease(chemical=spans[i, j, chemical], disease=spans[i, j, disease], split=0))
+        cls.session.commit()
+        cls.candidates = cls.session.query(ChemicalDisease).order_by(ChemicalDisease.id).all()
+
+        # Labels of the annotator, some without their stable version; and a label of another annotator
+        key   = GoldLabelKey(name='tester')
+        other = GoldLabelKey(name='other')
+        for k, value, stable in [(0, 1, True), (2, -1, False), (3, -1, True), (5, 1, False)]:
+            c = cls.candidates[k]
+            cls.session.add(GoldLabel(candidate=c, key=key, value=value))
+            if stable:
+                cls.session.add(StableLabel(context_stable_ids=cls.stable_ids(c), annotator_name='tester',
+                                            split=0, value=value))
+        cls.session.add(GoldLabel(candidate=cls.candidates[1], key=other, value=1))
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    @classmethod
+    def stable_ids(cls, c):
+        return '~~'.join(context.stable_id for context in c.get_contexts())
+
+    def tearDown(self):
+        viewer.LABEL_BATCH_SIZE = 500
+
+    def make_viewer(self):
+        # Candidates in another order than by their Sentence
+        return viewer.SentenceNgramViewer(self.candidates[::-1], self.session, n_per_page=2, annotator_name='tester')
+
+    def test_pages(self):
+        """Contexts are paged by id, with the positions of their Candidates, sorted by char_start"""
+        v          = self.make_viewer()
+        candidates = sorted(self.candidates[::-1], key=lambda c: c[0].char_start)
+        contexts   = sorted(set(c[0].get_parent() for c in candidates), key=lambda s: s.id)
+        self.assertEqual(v.candidates, candidates)
+        self.assertEqual(v.contexts, contexts)
+        self.assertEqual([v.get_cid(c) for c in candidates], range(len(candidates)))
+
+        context_cids = [[i for i, c in enumerate(candidates) if c[0].get_parent() == context] for context in contexts]
+        self.assertEqual(v.cids, [context_cids[0:2], context_cids[2:4]])
+
+        # Each page lists its Contexts, tagging the Spans of each Candidate with its position
+        for pid in range(2):
+            html = v.render_page(pid)
+            self.assertIs(v.render_page(pid), html)
+            self.assertEqual(re.findall(r'title="(\d+)"', html), [str(s.id) for s in contexts[2 * pid:2 * pid + 2]])
+            for cids in v.cids[pid]:
+                for cid in cids:
+                    c = v.candidates[cid]
+                    for k in range(2):
+                        self.assertRegexpMatches(html, r'<span class="candidate[^"]* %d-%d[ "][^>]*>%s</span>'
+                                                       % (cid, k, re.escape(c[k].get_span())))
+
+        # Pages after the first are rendered on demand
+        viewer.N_PAGES_PRERENDERED, n_pages = 1, viewer.N_PAGES_PRERENDERED
+        try:
+            v = self.make_viewer()
+        finally:
+            viewer.N_PAGES_PRERENDERED = n_pages
+        self.assertEqual(sorted(v.pages), [0])
+        self.assertIn('viewer-page-pending" id="viewer-page-1"', v.html)
+        v.handle_label_event(None, {'event': 'render_page', 'pid': 1}, None)
+        self.assertEqual(sorted(v.pages), [0, 1])
+
+    def assertLabels(self, v):
+        """The Viewer has the labels which querying them for each Candidate finds"""
+        key        = self.session.query(GoldLabelKey).filter(GoldLabelKey.name == 'tester').one()
+        serialized = []
+        for i, c in enumerate(v.candidates):
+            label = self.session.query(GoldLabel).filter(GoldLabel.key == key) \
+                                                 .filter(GoldLabel.candidate_id == c.id).first()
+            self.assertIs(v.annotations[i], label)
+            if label is None:
+                self.assertIsNone(v.annotations_stable[i])
+                continue
+            stable = self.session.query(StableLabel).filter(StableLabel.annotator_name == 'tester') \
+                                                    .filter(StableLabel.context_stable_ids == self.stable_ids(c)).one()
+            self.assertIs(v.annotations_stable[i], stable)
+            self.assertEqual(stable.value, label.value)
+            serialized.append('%d~~%s' % (i, 'true' if label.value == 1 else 'false'))
+        self.assertEqual(v._labels_serialized, ','.join(serialized))
+        self.assertEqual(len(serialized), 4)
+
+    def test_labels(self):
+        """Existing labels are loaded in batches, and missing stable labels created"""
+        viewer.LABEL_BATCH_SIZE = 3
+        self.assertLabels(self.make_viewer())
+        self.assertEqual(self.session.query(StableLabel).filter(StableLabel.annotator_name == 'tester').count(), 4)
+        self.assertLabels(self.make_viewer())
+
+
+if __name__ == '__main__':
+    unittest.main()
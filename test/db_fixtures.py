@@ -0,0 +1,49 @@
+"""
+Fixtures of the tests which write to a scratch SQLite database. Import this module before snorkel, which
+connects to SNORKELDB when first imported; the database is removed when the tests exit.
+"""
+import atexit, os, shutil, sys, tempfile
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+TMP_PATH = tempfile.mkdtemp()
+os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(TMP_PATH, 'snorkel.db')
+atexit.register(shutil.rmtree, TMP_PATH, True)
+
+from snorkel.models import Document, Sentence, Span, construct_stable_id
+
+
+def make_document(name):
+    return Document(name=name, stable_id='%s::document:0:0' % name, meta={})
+
+
+def make_sentence(document, position, text, char_start=0, **kwargs):
+    """
+    A Sentence of text, tokenized on spaces, starting at char_start in document. Token arrays other than the
+    words and their offsets are placeholders, unless passed as keyword arguments.
+    """
+    words = text.split(' ')
+    n     = len(words)
+    parts = {'document': document, 'position': position, 'text': text, 'words': words,
+             'char_offsets': [sum(len(w) + 1 for w in words[:i]) for i in range(n)],
+             'lemmas': [w.lower() for w in words], 'pos_tags': ['NN'] * n, 'ner_tags': ['O'] * n,
+             'dep_parents': [0] * n, 'dep_labels': ['dep'] * n, 'entity_cids': ['O'] * n,
+             'entity_types': ['O'] * n,
+             'stable_id': construct_stable_id(document, 'sentence', char_start, char_start + len(text))}
+    parts.update(kwargs)
+    return Sentence(**parts)
+
+
+def make_sentences(document, texts, **kwargs):
+    """The Sentences of document, with texts separated by single spaces"""
+    sentences, char_start = [], 0
+    for position, text in enumerate(texts):
+        sentences.append(make_sentence(document, position, text, char_start, **kwargs))
+        char_start += len(text) + 1
+    return sentences
+
+
+def make_span(sentence, word):
+    """The Span of the first occurrence of word in sentence"""
+    start = sentence.text.index(word)
+    return Span(sentence=sentence, char_start=start, char_end=start + len(word) - 1,
+                stable_id=construct_stable_id(sentence, 'span', start, start + len(word) - 1))
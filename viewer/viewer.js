@@ -88,11 +88,41 @@ define('viewer', ["jupyter-js-widgets"], function(widgets) {
                 }
             });
 
+            // Pages not rendered up front are sent by the Viewer on request
+            this.model.on('msg:custom', this.handleMessage, this);
+
             // Show the first page and highlight the first candidate
             this.$el.find("#viewer-page-0").show();
             this.switchCandidate(0);
         },
 
+        // Insert a page rendered on request, and mark its labeled candidates
+        handleMessage: function(content) {
+            if (content.event != 'page') { return; }
+            var page = this.$el.find("#viewer-page-"+content.pid);
+            page.replaceWith(content.html);
+            var pid  = this.pid;
+            var cxid = this.cxid;
+            var cid  = this.cid;
+            this.pid = content.pid;
+            for (var j=0; j < this.cids[this.pid].length; j++) {
+                this.cxid = j;
+                for (var k=0; k < this.cids[this.pid][j].length; k++) {
+                    this.cid = k;
+                    if (this.cids[this.pid][j][k] in this.labels) {
+                        this.markCurrentCandidate(false);
+                    }
+                }
+            }
+            this.pid  = pid;
+            this.cxid = cxid;
+            this.cid  = cid;
+            if (content.pid == this.pid) {
+                this.$el.find("#viewer-page-"+this.pid).show();
+                this.switchCandidate(0);
+            }
+        },
+
         // Get candidate selector for currently selected candidate, escaping id properly
         getCandidate: function() {
             return this.$el.find("."+this.cids[this.pid][this.cxid][this.cid]);
@@ -245,6 +275,11 @@ define('viewer', ["jupyter-js-widgets"], function(widgets) {
             }
             this.$el.find("#viewer-page-"+this.pid).show();
 
+            // Request the page if it has not been rendered yet
+            if (this.$el.find("#viewer-page-"+this.pid).hasClass("viewer-page-pending")) {
+                this.send({event: 'render_page', pid: this.pid});
+            }
+
             // Show pagination
             this.$el.find("#page").html(this.pid);
 